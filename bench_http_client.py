@@ -0,0 +1,92 @@
+"""
+Benchmark: sequential GETs to one host, a new connection per request (bare requests.get)
+vs. pooled keep-alive connections (services.http_client.http_get).
+
+By default runs against a local keep-alive server that adds --handshake-ms to every new
+connection (a stand-in for the TCP+TLS setup of a real CDN host); pass --url to measure
+a real host instead (e.g. an fbcdn image URL).
+
+Usage:
+    python bench_http_client.py [--requests 50] [--handshake-ms 60] [--url https://...]
+"""
+import argparse
+import statistics
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from services.http_client import http_get
+
+PAYLOAD = b"\xff\xd8" + b"x" * 20_000
+
+
+def start_local_server(handshake_ms: float) -> str:
+    """Keep-alive HTTP server on a free port; returns its URL."""
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"  # keep connections open between requests
+        disable_nagle_algorithm = True  # headers and body go out as separate writes
+
+        def setup(self):
+            # Runs once per connection, not per request
+            time.sleep(handshake_ms / 1000)
+            super().setup()
+
+        def do_GET(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "image/jpeg")
+            self.send_header("Content-Length", str(len(PAYLOAD)))
+            self.end_headers()
+            self.wfile.write(PAYLOAD)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}/image.jpg"
+
+
+def time_gets(get, url: str, count: int) -> list:
+    """Per-request latencies in milliseconds."""
+    latencies = []
+    for _ in range(count):
+        start = time.perf_counter()
+        response = get(url, timeout=30)
+        response.raise_for_status()
+        _ = response.content
+        latencies.append((time.perf_counter() - start) * 1000)
+    return latencies
+
+
+def report(name: str, latencies: list):
+    print(f"{name:<22} mean {statistics.mean(latencies):7.1f} ms   "
+          f"median {statistics.median(latencies):7.1f} ms   total {sum(latencies) / 1000:6.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--handshake-ms", type=float, default=60.0)
+    parser.add_argument("--url", default=None)
+    args = parser.parse_args()
+
+    url = args.url or start_local_server(args.handshake_ms)
+    print(f"{args.requests} sequential GETs to {url}")
+
+    bare = time_gets(requests.get, url, args.requests)
+    report("requests.get", bare)
+
+    http_get(url, timeout=30).content  # open the pooled connection outside the timing
+    pooled = time_gets(http_get, url, args.requests)
+    report("http_get (pooled)", pooled)
+
+    print(f"Saved {statistics.mean(bare) - statistics.mean(pooled):.1f} ms per request "
+          f"({1 - statistics.mean(pooled) / statistics.mean(bare):.0%})")
+
+
+if __name__ == "__main__":
+    main()
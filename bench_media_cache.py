@@ -0,0 +1,92 @@
+"""
+Benchmark: media cache lookups per second (cache hits), single thread and under thread fan-out.
+
+Runs against a throwaway cache in a temp directory, never the real ~/.cache/facebook-ads-mcp.
+
+Usage:
+    python bench_media_cache.py [--entries 2000] [--seconds 3] [--threads 1,10,20]
+"""
+import argparse
+import random
+import tempfile
+import threading
+import time
+from pathlib import Path
+
+import services.media_cache_service as mcs
+
+
+def use_temp_cache(root: Path):
+    """Point the cache module at a temp directory (paths are read at call time)."""
+    mcs.CACHE_DIR = root
+    mcs.CACHE_DB_PATH = root / "media_cache.db"
+    mcs.CACHE_IMAGES_DIR = root / "images"
+    mcs.CACHE_VIDEOS_DIR = root / "videos"
+    mcs.CACHE_VARIANTS_DIR = root / "variants"
+
+
+def populate(cache, entries: int) -> list:
+    urls = [f"https://scontent.example.fbcdn.net/v/t39/{i}_n.jpg" for i in range(entries)]
+    payload = b"\xff\xd8" + b"x" * 20_000
+    for url in urls:
+        cache.cache_media(url, payload, "image/jpeg", media_type="image", brand_name="bench", ad_id="1")
+    return urls
+
+
+def run_lookups(cache, urls: list, threads: int, seconds: float) -> float:
+    """Returns cache-hit lookups per second across all threads."""
+    counts = [0] * threads
+    errors = []
+    stop_at = time.perf_counter() + seconds
+
+    def worker(slot: int):
+        rnd = random.Random(slot)
+        n = 0
+        try:
+            while time.perf_counter() < stop_at:
+                if cache.get_cached_media(rnd.choice(urls), media_type="image") is None:
+                    raise RuntimeError("unexpected cache miss")
+                n += 1
+        except Exception as e:  # e.g. "database is locked"
+            errors.append(str(e))
+        counts[slot] = n
+
+    pool = [threading.Thread(target=worker, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for t in pool:
+        t.start()
+    for t in pool:
+        t.join()
+    elapsed = time.perf_counter() - start
+
+    if errors:
+        print(f"  {len(errors)} thread(s) failed, first error: {errors[0]}")
+    return sum(counts) / elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=2000)
+    parser.add_argument("--seconds", type=float, default=3.0)
+    parser.add_argument("--threads", default="1,10,20")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory(prefix="media-cache-bench-") as tmp:
+        use_temp_cache(Path(tmp))
+        cache = mcs.MediaCacheService()
+
+        start = time.perf_counter()
+        urls = populate(cache, args.entries)
+        print(f"Populated {args.entries} entries in {time.perf_counter() - start:.2f}s")
+
+        for threads in (int(t) for t in args.threads.split(",")):
+            rate = run_lookups(cache, urls, threads, args.seconds)
+            print(f"{threads:>3} thread(s): {rate:>10,.0f} cache-hit lookups/s")
+
+        # Buffered last_accessed times must land before the temp dir goes away
+        cache.flush_access_times()
+        cache.close()
+
+
+if __name__ == "__main__":
+    main()
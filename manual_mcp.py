@@ -3,7 +3,9 @@ import sys
 import os
 import json
 import builtins
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor
 
 # 1. SETUP LOGGING & I/O
 # Redirect stderr to a log file for debugging
@@ -156,7 +158,14 @@ def get_tools_list():
                 "properties": {
                     "media_url": {"type": "string"},
                     "brand_name": {"type": "string"},
-                    "ad_id": {"type": "string"}
+                    "ad_id": {"type": "string"},
+                    "ad_text": {"type": "string"},
+                    "video_mode": {
+                        "type": "string",
+                        "enum": ["upload", "frames", "auto"],
+                        "description": "upload = whole video (most detail); frames = keyframes + audio sent inline, much faster; auto = frames for short videos"
+                    },
+                    "num_frames": {"type": "integer", "description": "Keyframes in frames mode (default 8)"}
                 },
                 "required": ["media_url"]
             }
@@ -169,6 +178,14 @@ def get_tools_list():
                  "properties": {},
              }
         },
+        {
+             "name": "get_gemini_key_status",
+             "description": "Get the state of every Gemini API key (healthy / cooling_down / exhausted) with per-key request, 429, error and token metrics.",
+             "inputSchema": {
+                 "type": "object",
+                 "properties": {},
+             }
+        },
         {
              "name": "search_cached_media",
              "description": "Find previously analyzed ad media (images and videos) in cache.",
@@ -195,18 +212,19 @@ def get_tools_list():
         },
         {
             "name": "retry_failed_gemini_analysis",
-            "description": "Retry Gemini analysis for ads that have failed or missing analysis in a local JSON file.",
+            "description": "Retry Gemini analysis for ads that have failed or missing analysis in a local JSON file. With batch_mode the analyses run as Gemini Batch API jobs (offline: no RPM pressure, can take hours) - e.g. after search_ads_final with analyze_media=false.",
              "inputSchema": {
                  "type": "object",
                  "properties": {
-                    "json_file_path": {"type": "string"}
+                    "json_file_path": {"type": "string"},
+                    "batch_mode": {"type": "boolean", "description": "Use Gemini Batch API jobs instead of interactive requests"}
                  },
                  "required": ["json_file_path"]
              }
         },
         {
             "name": "clean_results_file",
-            "description": "Removes all 'white' stub ad cards from a JSON results file. Reads the file, deletes every card whose raw_analysis contains the word 'white', and saves the result.",
+            "description": "Removes all 'white' stub ad cards from a JSON results file. Reads the file, deletes every card whose offer is 'white' (older text-only analyses: raw_analysis contains the word 'white'), and saves the result.",
             "inputSchema": {
                 "type": "object",
                 "properties": {
@@ -225,35 +243,139 @@ def get_tools_list():
     ]
     return tools_info
 
-def call_tool(name, arguments):
+def call_tool(name, arguments, progress_callback=None, cancel_event=None):
     # Dispatch manual calls
     if name == "get_meta_platform_id":
         return mcp_library.get_meta_platform_id(**arguments)
     elif name == "search_ads_final":
         # Map new tool name to the library function
-        return mcp_library.search_facebook_ads(**arguments)
+        return mcp_library.search_facebook_ads(**arguments, progress_callback=progress_callback, cancel_event=cancel_event)
     elif name == "get_meta_ads_external_only":
         return mcp_library.get_meta_ads_external_only(**arguments)
     elif name == "get_fanpage_ads":
-        return mcp_library.get_fanpage_ads(**arguments)
+        return mcp_library.get_fanpage_ads(**arguments, progress_callback=progress_callback, cancel_event=cancel_event)
     elif name == "analyze_ad_image":
         return mcp_library.analyze_ad_image(**arguments)
     elif name == "analyze_ad_video":
         return mcp_library.analyze_ad_video(**arguments)
     elif name == "get_cache_stats":
         return mcp_library.get_cache_stats(**arguments)
+    elif name == "get_gemini_key_status":
+        return mcp_library.get_gemini_key_status(**arguments)
     elif name == "search_cached_media":
         return mcp_library.search_cached_media(**arguments)
     elif name == "cleanup_media_cache":
         return mcp_library.cleanup_media_cache(**arguments)
     elif name == "retry_failed_gemini_analysis":
-        return mcp_library.retry_failed_gemini_analysis(**arguments)
+        return mcp_library.retry_failed_gemini_analysis(**arguments, cancel_event=cancel_event)
     elif name == "clean_results_file":
         return mcp_library.clean_results_file(**arguments)
     else:
         raise ValueError(f"Unknown tool: {name}")
 
-# 4. MAIN LOOP
+# 4. RESPONSE WRITER
+# Tool calls finish on worker threads in any order, so every write to stdout
+# goes through one lock to keep JSON-RPC lines from interleaving.
+stdout_lock = threading.Lock()
+
+def send_message(message):
+    """Serialize a JSON-RPC message and write it to stdout as a single line."""
+    try:
+        message_bytes = json.dumps(message).encode('utf-8') + b"\n"
+        with stdout_lock:
+            sys.stdout.buffer.write(message_bytes)
+            sys.stdout.buffer.flush()
+        return True
+    except Exception as e:
+        log(f"Failed to send message: {e}")
+        return False
+
+# 5. CONCURRENT TOOL DISPATCHER
+# Max number of tools/call requests running at the same time (configurable via .env).
+# Calls above the limit are rejected immediately instead of queueing behind long searches.
+try:
+    MAX_INFLIGHT_CALLS = max(1, int(os.getenv("MCP_MAX_INFLIGHT_CALLS", "4")))
+except ValueError:
+    MAX_INFLIGHT_CALLS = 4
+log(f"Max in-flight tool calls: {MAX_INFLIGHT_CALLS}")
+
+inflight_slots = threading.BoundedSemaphore(MAX_INFLIGHT_CALLS)
+tool_executor = ThreadPoolExecutor(max_workers=MAX_INFLIGHT_CALLS, thread_name_prefix="mcp-tool")
+
+# Cancellation tokens of running calls, keyed by request id (set on notifications/cancelled)
+cancel_events = {}
+cancel_events_lock = threading.Lock()
+
+def cancel_tool_call(request_id, reason=None):
+    """Signals a running tool call to stop. Unknown or finished ids are ignored."""
+    with cancel_events_lock:
+        event = cancel_events.get(request_id)
+    if event is None:
+        log(f"Cancellation for unknown or finished request id={request_id} ignored")
+        return
+    log(f"Cancelling request id={request_id}: {reason or 'no reason given'}")
+    event.set()
+
+def make_progress_callback(progress_token):
+    """Returns a callback that sends MCP notifications/progress for the given token."""
+    def report(progress, total=None, message=None):
+        params = {"progressToken": progress_token, "progress": progress}
+        if total is not None:
+            params["total"] = total
+        if message:
+            params["message"] = message
+        send_message({
+            "jsonrpc": "2.0",
+            "method": "notifications/progress",
+            "params": params
+        })
+    return report
+
+def run_tool_call(msg_id, name, args, progress_token=None, cancel_event=None):
+    """Runs a single tools/call on a worker thread and sends its response keyed by id."""
+    try:
+        log(f"Calling tool: {name} (id={msg_id}) with args: {args}")
+        # Progress is only reported when the client asked for it via _meta.progressToken
+        progress_callback = make_progress_callback(progress_token) if progress_token is not None else None
+        result_data = call_tool(name, args, progress_callback=progress_callback, cancel_event=cancel_event)
+
+        # Format result for MCP (wrap in content list)
+        content = []
+        content.append({"type": "text", "text": json.dumps(result_data, default=str, ensure_ascii=False)})
+
+        response = {
+            "jsonrpc": "2.0",
+            "id": msg_id,
+            "result": {
+                "content": content,
+                "isError": False
+            }
+        }
+    except Exception as e:
+        log(f"Tool error (id={msg_id}): {e}")
+        traceback.print_exc(file=sys.stderr)
+        response = {
+            "jsonrpc": "2.0",
+            "id": msg_id,
+            "error": {
+                "code": -32000,
+                "message": str(e)
+            }
+        }
+    finally:
+        with cancel_events_lock:
+            cancel_events.pop(msg_id, None)
+        inflight_slots.release()
+
+    # Per MCP spec no response is sent for a cancelled request (partial results are already saved)
+    if cancel_event is not None and cancel_event.is_set():
+        log(f"Request id={msg_id} ({name}) was cancelled, response suppressed")
+        return
+
+    if send_message(response):
+        log(f"Sent response for tools/call {name} (id={msg_id})")
+
+# 6. MAIN LOOP
 log("Entering main loop...")
 while True:
     try:
@@ -319,34 +441,30 @@ while True:
             params = request.get("params", {})
             name = params.get("name")
             args = params.get("arguments", {})
-            
-            try:
-                log(f"Calling tool: {name} with args: {args}")
-                result_data = call_tool(name, args)
-                
-                # Format result for MCP (wrap in content list)
-                content = []
-                content.append({"type": "text", "text": json.dumps(result_data, default=str, ensure_ascii=False)})
-
-                response = {
-                    "jsonrpc": "2.0",
-                    "id": msg_id,
-                    "result": {
-                        "content": content,
-                        "isError": False
-                    }
-                }
-            except Exception as e:
-                log(f"Tool error: {e}")
-                traceback.print_exc(file=sys.stderr)
-                response = {
-                    "jsonrpc": "2.0",
-                    "id": msg_id,
-                    "error": {
-                        "code": -32000,
-                        "message": str(e)
-                    }
+            progress_token = (params.get("_meta") or {}).get("progressToken")
+
+            if inflight_slots.acquire(blocking=False):
+                cancel_event = threading.Event()
+                with cancel_events_lock:
+                    cancel_events[msg_id] = cancel_event
+                # Response is sent by the worker thread when the tool finishes
+                tool_executor.submit(run_tool_call, msg_id, name, args, progress_token, cancel_event)
+                continue
+
+            log(f"Rejected tool call {name} (id={msg_id}): {MAX_INFLIGHT_CALLS} calls already in flight")
+            response = {
+                "jsonrpc": "2.0",
+                "id": msg_id,
+                "error": {
+                    "code": -32000,
+                    "message": f"Server busy: {MAX_INFLIGHT_CALLS} tool calls already in flight. Retry later."
                 }
+            }
+
+        elif method == "notifications/cancelled":
+            params = request.get("params", {})
+            cancel_tool_call(params.get("requestId"), params.get("reason"))
+            continue
 
         elif method == "ping":
             response = {
@@ -361,16 +479,15 @@ while True:
             continue
 
         # Send Response
-        if response:
-            try:
-                response_str = json.dumps(response)
-                response_bytes = response_str.encode('utf-8') + b"\n"
-                sys.stdout.buffer.write(response_bytes)
-                sys.stdout.buffer.flush()
-                log(f"Sent response for {method}")
-            except Exception as e:
-                log(f"Failed to send response: {e}")
+        if response and send_message(response):
+            log(f"Sent response for {method}")
 
     except Exception as e:
         log(f"Loop error: {e}")
         break
+
+# The client is gone: cancel running calls (they save partial results) and exit
+with cancel_events_lock:
+    for event in cancel_events.values():
+        event.set()
+tool_executor.shutdown(wait=False, cancel_futures=True)
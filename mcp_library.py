@@ -1,15 +1,23 @@
 
 from services.scrapecreators_service import get_platform_id, get_ads, get_scrapecreators_api_key, get_platform_ids_batch, get_ads_batch, CreditExhaustedException, RateLimitException, search_ads_by_keyword, parse_fb_ads, ADS_API_URL, check_credit_status
-from services.media_cache_service import media_cache, image_cache
-from services.gemini_service import configure_gemini, upload_video_to_gemini, analyze_video_with_gemini, cleanup_gemini_file, analyze_videos_batch_with_gemini, upload_videos_batch_to_gemini, cleanup_gemini_files_batch, get_gemini_api_key, analyze_image_with_gemini, key_manager
-from typing import Dict, Any, List, Optional, Union
+from services.media_cache_service import media_cache, image_cache, MAX_VIDEO_FILE_MB, DOWNLOAD_CHUNK_SIZE, MediaTooLargeException
+from services.http_client import http_get
+from services.image_variant_service import preprocessing_enabled, variant_key, make_variant
+from services.video_frames_service import VIDEO_MODE, resolve_video_mode, extract_video_frames
+from services.pipeline_service import AsyncPipeline, Stage
+from services.gemini_service import configure_gemini, upload_video_to_gemini, analyze_video_with_gemini, cleanup_gemini_file, analyze_videos_batch_with_gemini, upload_videos_batch_to_gemini, cleanup_gemini_files_batch, get_gemini_api_key, analyze_image_with_gemini, key_manager, AnalysisCancelledException, GEMINI_MODEL_NAME, BATCH_PROMPT_VERSION
+from services.gemini_service import IMAGE_CARD_FIELDS, VIDEO_ANALYSIS_FIELDS, parse_json_answer, card_fields, structured_analysis
+from typing import Dict, Any, List, Optional, Union, Callable
 from collections import defaultdict, Counter
-import requests
+from contextlib import nullcontext
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+import asyncio
 import base64
 import os
 import json
 import logging
 import threading
+import time
 from dotenv import load_dotenv
 import sys
 from datetime import datetime
@@ -26,6 +34,27 @@ if not os.path.exists(env_path):
     env_path = os.path.join(os.path.dirname(os.path.dirname(__file__)), '.env')
 load_dotenv(env_path)
 
+# Async pipeline stage limits (max items in flight per stage)
+PIPELINE_FETCH_CONCURRENCY = int(os.getenv("PIPELINE_FETCH_CONCURRENCY", "4"))
+PIPELINE_DOWNLOAD_CONCURRENCY = int(os.getenv("PIPELINE_DOWNLOAD_CONCURRENCY", "20"))
+PIPELINE_ANALYZE_CONCURRENCY = int(os.getenv("PIPELINE_ANALYZE_CONCURRENCY", "10"))
+# Media files downloading at once across all groups: a group's cards download in parallel
+# on this shared pool, so a 12-card carousel doesn't take 12 sequential round trips
+PIPELINE_MEDIA_DOWNLOAD_CONCURRENCY = int(os.getenv("PIPELINE_MEDIA_DOWNLOAD_CONCURRENCY", "40"))
+# Groups whose videos are uploading / processing / being analyzed in the background
+PIPELINE_VIDEO_CONCURRENCY = int(os.getenv("PIPELINE_VIDEO_CONCURRENCY", "50"))
+
+# Part of the analysis cache key (with content hash, model and ad text): bump when a prompt changes
+IMAGE_PROMPT_VERSION = "image-v1"
+VIDEO_PROMPT_VERSION = "video-v2-json"
+VIDEO_FRAMES_PROMPT_VERSION = "video-frames-v2-json"
+# Plain-text analyses made before structured output are still reused (no new Gemini call)
+LEGACY_PROMPT_VERSIONS = {
+    BATCH_PROMPT_VERSION: ("batch-v1",),
+    VIDEO_PROMPT_VERSION: ("video-v1",),
+    VIDEO_FRAMES_PROMPT_VERSION: ("video-frames-v1",),
+}
+
 # Gemini quota tracking is now handled by key_manager (Round-Robin) in gemini_service.py
 
 # Check Gemini availability
@@ -166,8 +195,41 @@ def filter_ad(ad: Dict[str, Any]) -> bool:
     return True
 
 
+def parse_card_analyses(batch_text: str, num_cards: int) -> List[Dict[str, Any]]:
+    """
+    Per-card analysis dicts of a batch answer. Structured (JSON) answers are read in one pass
+    (fields + rendered raw_analysis), plain "CARD X:" text goes through the regex parser.
+    Missing cards get the "Analysis for card N not found" text, so a retry picks them up.
+    """
+    cards = card_fields(parse_json_answer(batch_text), num_cards)
+    if cards is None:
+        return [{'raw_analysis': text} for text in _parse_card_text(batch_text, num_cards)]
+    return [structured_analysis(card, IMAGE_CARD_FIELDS) if card is not None
+            else {'raw_analysis': f"Analysis for card {i} not found in batch response."}
+            for i, card in enumerate(cards, 1)]
+
+
 def parse_batch_response(batch_text: str, num_cards: int) -> List[str]:
-    """Parses Gemini batch response into individual analyses. Robust for various formats."""
+    """Parses Gemini batch response into individual analyses (raw_analysis text per card)."""
+    return [analysis['raw_analysis'] for analysis in parse_card_analyses(batch_text, num_cards)]
+
+
+def parse_video_analysis(text: str) -> Dict[str, Any]:
+    """Analysis dict of a video answer: structured fields + raw_analysis, or just the plain text."""
+    data = parse_json_answer(text)
+    if isinstance(data, dict) and data.get('offer') is not None:
+        return structured_analysis(data, VIDEO_ANALYSIS_FIELDS)
+    return {"raw_analysis": text}
+
+
+def _is_failed_analysis(text: Optional[str]) -> bool:
+    """Error / placeholder texts that must not be cached as an analysis (a retry redoes them)."""
+    text = str(text or '').strip()
+    return not text or text.startswith("Error") or "not found in batch response" in text.lower()
+
+
+def _parse_card_text(batch_text: str, num_cards: int) -> List[str]:
+    """Parses a plain-text "CARD X:" answer into individual analyses. Robust for various formats."""
     import re
     if not batch_text:
         return [f"Error: Empty response from Gemini"] * num_cards
@@ -206,101 +268,433 @@ def parse_batch_response(batch_text: str, num_cards: int) -> List[str]:
             
     return parts
 
-def analyze_ad_media_batch(ads: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    """Analyzes a group of ads (cards for same ID) using Gemini batching."""
-    if not ads:
-        return ads
-        
-    import requests
-    from services.gemini_service import analyze_images_batch_with_gemini
-    
-    ad_text = ads[0].get('body', '')
-    
-    # Use ThreadPoolExecutor for concurrent image downloads
-    from concurrent.futures import ThreadPoolExecutor
-    
+
+class PipelineProgress:
+    """
+    Thread-safe progress counters for the group-processing pipeline.
+    Reports groups done / total, Gemini analyses in flight, Gemini requests sent and cache hits through
+    an optional callback (MCP notifications/progress) and as PROGRESS: lines in the log.
+    """
+
+    REPORT_INTERVAL_SECONDS = 1.0
+
+    def __init__(self, total_groups: int = 0, callback: Optional[Callable[..., None]] = None, label: str = ""):
+        self._lock = threading.Lock()
+        self._callback = callback
+        self._label = label
+        self._last_report_at = 0.0
+        self.total_groups = total_groups
+        self.groups_done = 0
+        self.gemini_in_flight = 0
+        self.gemini_calls = 0
+        self.cache_hits = 0
+        self.images_downscaled = 0
+        self.image_bytes_saved = 0
+
+    def add_total(self, groups: int):
+        """Adds newly fetched groups to the total (fetch runs as a pipeline stage)."""
+        with self._lock:
+            self.total_groups += groups
+        self.report(force=True)
+
+    def group_done(self):
+        with self._lock:
+            self.groups_done += 1
+            done = self.groups_done
+        if done % 10 == 0 or done == self.total_groups:
+            print(f"PROGRESS: {self._label}Processed {done}/{self.total_groups} groups...", file=sys.stderr)
+        self.report(force=done == self.total_groups)
+
+    def cache_hit(self):
+        with self._lock:
+            self.cache_hits += 1
+
+    def image_downscaled(self, bytes_saved: int):
+        with self._lock:
+            self.images_downscaled += 1
+            self.image_bytes_saved += bytes_saved
+
+    def gemini_started(self):
+        """An analysis is waiting for / running on Gemini (not necessarily its own request)."""
+        with self._lock:
+            self.gemini_in_flight += 1
+
+    def gemini_finished(self):
+        with self._lock:
+            self.gemini_in_flight -= 1
+
+    def gemini_request(self):
+        """One generateContent request sent (a packed image request counts once)."""
+        with self._lock:
+            self.gemini_calls += 1
+
+    def snapshot(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "groups_done": self.groups_done,
+                "total_groups": self.total_groups,
+                "gemini_in_flight": self.gemini_in_flight,
+                "gemini_calls": self.gemini_calls,
+                "cache_hits": self.cache_hits,
+                "images_downscaled": self.images_downscaled,
+                "image_mb_saved": round(self.image_bytes_saved / (1024 * 1024), 2),
+            }
+
+    def report(self, force: bool = False):
+        """Sends a progress update to the callback, throttled to one per REPORT_INTERVAL_SECONDS."""
+        if not self._callback:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if not force and now - self._last_report_at < self.REPORT_INTERVAL_SECONDS:
+                return
+            self._last_report_at = now
+        stats = self.snapshot()
+        message = (f"{self._label}groups {stats['groups_done']}/{stats['total_groups']}, "
+                   f"Gemini in flight: {stats['gemini_in_flight']}, "
+                   f"Gemini calls: {stats['gemini_calls']}, cache hits: {stats['cache_hits']}, "
+                   f"image MB saved: {stats['image_mb_saved']}")
+        try:
+            self._callback(stats['groups_done'], stats['total_groups'], message)
+        except Exception as e:
+            logger.warning(f"Progress callback failed: {e}")
+
+
+def _raise_if_cancelled(cancel_event: Optional[threading.Event], ad_id: Any = None):
+    """Raises AnalysisCancelledException if the tool call was cancelled by the client."""
+    if cancel_event is not None and cancel_event.is_set():
+        raise AnalysisCancelledException(f"Analysis cancelled (Ad ID {ad_id})")
+
+
+def _prepare_image_for_gemini(img: Dict[str, Any], progress: Optional[PipelineProgress] = None) -> Dict[str, Any]:
+    """
+    Swaps in a downscaled, re-encoded variant of the image (cached next to the original)
+    when it is meaningfully smaller. content_hash stays the original's (analysis cache key).
+    """
+    content_hash = img.get('content_hash')
+    if not preprocessing_enabled() or not content_hash:
+        return img
+    key = variant_key()
+    try:
+        variant = media_cache.get_variant(content_hash, key)
+        if variant is None:
+            made = make_variant(img['bytes'])
+            variant = media_cache.store_variant(content_hash, key, *(made or (None, None)))
+        if not variant['file_path']:
+            return img
+        variant_bytes = media_cache.map_file(variant['file_path'])
+    except Exception as e:
+        print(f"DEBUG: Image preprocessing skipped for {img.get('url')}: {e}", file=sys.stderr)
+        return img
+
+    if progress:
+        progress.image_downscaled(len(img['bytes']) - len(variant_bytes))
+    return dict(img, bytes=variant_bytes, mime_type=variant['content_type'], payload_key=f"{content_hash}:{key}")
+
+
+def _group_media_urls(ads: List[Dict[str, Any]]) -> List[str]:
+    """Stripped image/video URLs of a list of ads (cache lookup keys)."""
+    return [ad['media_url'].strip() for ad in ads
+            if ad.get('media_type') in ('IMAGE', 'VIDEO') and ad.get('media_url')]
+
+
+_media_download_pool = ThreadPoolExecutor(max_workers=max(1, PIPELINE_MEDIA_DOWNLOAD_CONCURRENCY),
+                                          thread_name_prefix="media-download")
+
+
+def _download_group_media(ads: List[Dict[str, Any]], progress: Optional[PipelineProgress] = None,
+                          cancel_event: Optional[threading.Event] = None,
+                          cached_media: Optional[Dict[str, Optional[Dict[str, Any]]]] = None,
+                          cached_media_lock: Optional[threading.Lock] = None) -> List[Optional[Dict[str, Any]]]:
+    """
+    Download stage: loads the images of an ad group (cache first) and pre-caches its videos.
+    Returns one entry per ad: {'bytes', 'mime_type', 'url', 'content_hash'} for downloaded images, None otherwise.
+    The group's files download in parallel on the shared media download pool.
+
+    cached_media is the result of one get_cached_media_batch() over the whole search; URLs it
+    doesn't cover (or maps to False) fall back to a single lookup. New images of the group are
+    cached in one transaction. cached_media_lock guards cached_media when it is shared by workers.
+    """
+    from pathlib import Path
+
+    def lookup(murl, media_type):
+        cached = cached_media.get(murl, False) if cached_media is not None else False
+        if cached is not False:  # Covered by the batched lookup (None = known miss)
+            return cached if cached and cached.get('media_type') == media_type else None
+        return media_cache.get_cached_media(murl, media_type=media_type)
+
+    new_images = []
+
     def download_image(ad):
-        murl = ad.get('media_url', '')
+        murl = ad.get('media_url', '').strip()
         if ad.get('media_type') == 'IMAGE' and murl:
             try:
                 # Check cache first
-                from services.media_cache_service import media_cache
-                from pathlib import Path
-                cached = media_cache.get_cached_media(murl.strip(), media_type='image')
+                cached = lookup(murl, 'image')
                 if cached and Path(cached['file_path']).exists():
+                    if progress:
+                        progress.cache_hit()
+                    # Memory-mapped: encoded for Gemini straight from the page cache
+                    image_bytes = media_cache.map_file(cached['file_path'])
                     return {
-                        'bytes': Path(cached['file_path']).read_bytes(),
-                        'mime_type': cached.get('content_type', 'image/jpeg')
+                        'bytes': image_bytes,
+                        'mime_type': cached.get('content_type', 'image/jpeg'),
+                        'url': murl,
+                        'content_hash': cached.get('content_hash') or media_cache.compute_content_hash(image_bytes)
                     }
                 
-                resp = requests.get(murl, timeout=10)
+                resp = http_get(murl, timeout=10)
                 if resp.status_code == 200:
                     c_type = resp.headers.get('content-type', 'image/jpeg')
-                    # Save to cache
-                    media_cache.cache_media(
-                        url=murl.strip(),
-                        media_data=resp.content,
-                        content_type=c_type,
-                        media_type='image',
-                        brand_name=ad.get('page_name'),
-                        ad_id=ad.get('ad_id')
-                    )
+                    # Saved to cache with the rest of the group below
+                    new_images.append({
+                        'url': murl,
+                        'media_data': resp.content,
+                        'content_type': c_type,
+                        'media_type': 'image',
+                        'brand_name': ad.get('page_name'),
+                        'ad_id': ad.get('ad_id')
+                    })
                     return {
                         'bytes': resp.content,
-                        'mime_type': c_type
+                        'mime_type': c_type,
+                        'url': murl,
+                        'content_hash': media_cache.compute_content_hash(resp.content)
                     }
             except Exception as e:
                 print(f"Error downloading/caching image {murl}: {e}", file=sys.stderr)
+        elif ad.get('media_type') == 'VIDEO' and murl:
+            # Videos are only cached here; upload + analysis happen in the analyze stage
+            cached = lookup(murl, 'video')
+            if cached and Path(cached['file_path']).exists():
+                if progress:
+                    progress.cache_hit()
+                return None
+            try:
+                _download_video_to_cache(murl, brand_name=ad.get('page_name'), ad_id=ad.get('ad_id'))
+            except Exception as e:
+                print(f"Error downloading/caching video {murl}: {e}", file=sys.stderr)
         return None
 
-    with ThreadPoolExecutor(max_workers=10) as executor:
-        images_to_batch = list(executor.map(download_image, ads))
+    def fetch(ad):
+        if cancel_event is not None and cancel_event.is_set():
+            return None
+        img = download_image(ad)
+        return _prepare_image_for_gemini(img, progress) if img else None
+
+    futures = [_media_download_pool.submit(fetch, ad) for ad in ads]
+    try:
+        images_to_batch = [future.result() for future in futures]
+        _raise_if_cancelled(cancel_event, ads[0].get('ad_id') if ads else None)
+    finally:
+        # Keep what was downloaded even if the group is cancelled halfway
+        wait(futures)
+        if new_images:
+            try:
+                media_cache.cache_media_batch(new_images)
+            except Exception as e:
+                print(f"Error caching {len(new_images)} images: {e}", file=sys.stderr)
+            if cached_media is not None:
+                # The search-wide lookup said "miss"; later groups must see the new rows. False
+                # ("not covered, look it up") instead of removing the entry, so a lookup of a later
+                # source that ran before this write can't put the stale miss back (setdefault)
+                with cached_media_lock or nullcontext():
+                    for item in new_images:
+                        cached_media[item['url']] = False
+    return images_to_batch
+
+
+def _reusable_analysis(content_hash: Optional[str], media_type: str, prompt_version: str,
+                       ad_text: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Cached analysis of the same creative or a near-duplicate (resized / recompressed re-upload)
+    made with the same prompt version (or its LEGACY_PROMPT_VERSIONS), model and ad text. Returns the analysis dict
+    (near-duplicates marked with their source), or None.
+    """
+    if not content_hash:
+        return None
+    for version in (prompt_version,) + LEGACY_PROMPT_VERSIONS.get(prompt_version, ()):
+        try:
+            match = media_cache.find_similar_analysis(content_hash, media_type, version, GEMINI_MODEL_NAME, ad_text)
+        except Exception as e:
+            print(f"DEBUG: Near-duplicate lookup failed: {e}", file=sys.stderr)
+            return None
+        if (match and isinstance(match['analysis_results'], dict)
+                and not _is_failed_analysis(match['analysis_results'].get('raw_analysis'))):
+            break
+    else:
+        return None
+    analysis = dict(match['analysis_results'])
+    analysis.pop('should_exclude', None)
+    if match['content_hash'] != content_hash:
+        analysis['reused_from'] = {'content_hash': match['content_hash'], 'distance': match['distance']}
+    return analysis
+
+
+def _reusable_video_analysis(content_hash: Optional[str], ad_text: Optional[str] = None,
+                             video_mode: Optional[str] = None) -> Optional[Dict[str, Any]]:
+    """
+    Cached video analysis. A full-upload analysis is good for any mode; a frames-mode
+    analysis (lower fidelity) is only reused when frames mode may be used for this call.
+    """
+    analysis = _reusable_analysis(content_hash, 'video', VIDEO_PROMPT_VERSION, ad_text)
+    if analysis is None and (video_mode or VIDEO_MODE).lower() != 'upload':
+        analysis = _reusable_analysis(content_hash, 'video', VIDEO_FRAMES_PROMPT_VERSION, ad_text)
+    return analysis
+
+
+def _apply_video_result(ad: Dict[str, Any], video_res: Dict[str, Any]):
+    if video_res.get('success'):
+        ad['media_analysis'] = video_res.get('analysis', {})
+    else:
+        error_msg = video_res.get('error', 'Unknown video analysis error')
+        print(f"DEBUG: Video analysis FAILED for Ad ID {ad['ad_id']}: {error_msg}", file=sys.stderr)
+        ad['media_analysis'] = {
+            'analysis_error': error_msg
+        }
+
+
+def _mark_group_failed(group: List[Dict[str, Any]], error: Exception):
+    """Records error on every ad of a group that has no analysis yet."""
+    for ad in group:
+        if not ad.get('media_analysis'):
+            ad['media_analysis'] = {'analysis_error': str(error)}
+
+
+def _is_fresh_video_analysis(video_res: Dict[str, Any]) -> bool:
+    """True if the result came from a Gemini request (not the cache / a failed download)."""
+    return bool(video_res.get('success') and video_res.get('analysis') and not video_res.get('cached'))
+
+
+def _track_video_future(progress: PipelineProgress, future: Future):
+    """
+    Counts a submitted video analysis in progress: in flight until its Future completes
+    (already-done Futures, e.g. cache hits, never are), a request only if Gemini answered it.
+    """
+    def count_request(done: Future):
+        if not done.cancelled() and done.exception() is None and _is_fresh_video_analysis(done.result()):
+            progress.gemini_request()
+
+    if not future.done():
+        progress.gemini_started()
+        future.add_done_callback(lambda _: progress.gemini_finished())
+    future.add_done_callback(count_request)
+
+
+def _store_image_analyses(images: List[Dict[str, Any]], analyses: List[Dict[str, Any]], ad_text: str):
+    """Stores per creative so later copies (any URL, any near-duplicate) can reuse it."""
+    for img, analysis in zip(images, analyses):
+        if not _is_failed_analysis(analysis.get('raw_analysis')) and img.get('url'):
+            try:
+                media_cache.store_analysis(img['content_hash'], BATCH_PROMPT_VERSION, GEMINI_MODEL_NAME,
+                                           ad_text, analysis)
+                media_cache.update_analysis_results(img['url'], analysis)
+            except Exception as e:
+                print(f"DEBUG: Failed to cache analysis for {img['url']}: {e}", file=sys.stderr)
 
-    actual_images = [img for img in images_to_batch if img is not None]
-    print(f"DEBUG: Successfully downloaded {len(actual_images)}/{len(ads)} images for Ad ID {ads[0]['ad_id']}", file=sys.stderr)
-    
-    # Get a fixed key for this ad group to avoid 403 errors in threads and respect RPM
-    assigned_key = get_gemini_api_key()
 
+def _analyze_group_media(ads: List[Dict[str, Any]], images_to_batch: List[Optional[Dict[str, Any]]],
+                         progress: Optional[PipelineProgress] = None,
+                         cancel_event: Optional[threading.Event] = None,
+                         video_jobs: Optional[List[tuple]] = None) -> List[Dict[str, Any]]:
+    """
+    Analyze stage: one batched Gemini request for the group's images (shared with other
+    small groups analyzed at the same time, see ImageBatchPacker), videos one by one.
+    Every request takes its key from the key_manager scheduler (paced by per-key RPM/TPM).
+    Creatives already analyzed (same content or a perceptual near-duplicate) reuse that
+    analysis instead of a new Gemini call.
+    Fills ad['media_analysis'] for every ad in the group. If video_jobs is given, videos are
+    only submitted and (ad, Future) pairs are appended to it; the caller applies the results
+    (_apply_video_result) when the futures complete.
+    """
+    from services.gemini_service import image_batch_packer
+
+    _raise_if_cancelled(cancel_event, ads[0].get('ad_id'))
+
+    ad_text = ads[0].get('body', '')
+    downloaded = [img for img in images_to_batch if img is not None]
+    print(f"DEBUG: Successfully downloaded {len(downloaded)}/{len(ads)} images for Ad ID {ads[0]['ad_id']}", file=sys.stderr)
+
+    # Near-duplicates of analyzed creatives skip Gemini; only the rest goes into the batch
+    reused = {}
+    for img in downloaded:
+        analysis = _reusable_analysis(img.get('content_hash'), 'image', BATCH_PROMPT_VERSION, ad_text)
+        if analysis:
+            reused[id(img)] = analysis
+    actual_images = [img for img in downloaded if id(img) not in reused]
+    if reused:
+        print(f"DEBUG: Reusing analysis of {len(reused)} near-duplicate image(s) for Ad ID {ads[0]['ad_id']}", file=sys.stderr)
+    
     parsed_analyses = []
     if actual_images:
-        print(f"DEBUG: [Thread {threading.get_ident()}] Batching {len(actual_images)} images for Ad ID {ads[0]['ad_id']} using key ...{assigned_key[-6:]}", file=sys.stderr)
+        print(f"DEBUG: [Thread {threading.get_ident()}] Batching {len(actual_images)} images for Ad ID {ads[0]['ad_id']}", file=sys.stderr)
         
-        batch_text = analyze_images_batch_with_gemini(actual_images, ad_text, api_key=assigned_key)
+        if progress:
+            progress.gemini_started()
+        try:
+            batch_text = image_batch_packer.analyze(ads[0]['ad_id'], actual_images, ad_text, cancel_event,
+                                                    on_request=progress.gemini_request if progress else None)
+        finally:
+            if progress:
+                progress.gemini_finished()
         print(f"--- GEMINI RAW START (ID: {ads[0].get('ad_id')}) ---\n{batch_text}\n--- GEMINI RAW END ---", file=sys.stderr)
         
-        parsed_analyses = parse_batch_response(batch_text, len(actual_images))
+        parsed_analyses = parse_card_analyses(batch_text, len(actual_images))
+        _store_image_analyses(actual_images, parsed_analyses, ad_text)
         
     img_counter = 0
     for i, ad in enumerate(ads):
-        if images_to_batch[i] is not None:
-            analysis_text = parsed_analyses[img_counter] if img_counter < len(parsed_analyses) else ""
+        img = images_to_batch[i]
+        if img is not None and id(img) in reused:
+            ad['media_analysis'] = {'image_analysis': reused[id(img)]}
+        elif img is not None:
+            analysis = parsed_analyses[img_counter] if img_counter < len(parsed_analyses) else {'raw_analysis': ""}
             ad['media_analysis'] = {
-                'image_analysis': {'raw_analysis': analysis_text}
+                'image_analysis': analysis
             }
             img_counter += 1
         else:
-            # If it's a video, analyze individually with SAME key
+            # If it's a video, analyze individually (upload + analysis share one key)
             if ad.get('media_type') == 'VIDEO':
                 murl = ad.get('media_url', '')
-                if murl:
-                    print(f"DEBUG: [Thread {threading.get_ident()}] Analyzing VIDEO for Ad ID {ad['ad_id']} with key ...{assigned_key[-6:]}", file=sys.stderr)
-                    # Use existing library for upload (still okay), but REST for analysis
-                    video_res = analyze_ad_video(
-                        media_url=murl, 
-                        brand_name=ad.get('page_name'), 
-                        ad_id=ad['ad_id'], 
-                        ad_text=ad.get('body', ''),
-                        api_key=assigned_key # NEW: Pass key to avoid global conflict
-                    )
-                    if video_res.get('success'):
-                        ad['media_analysis'] = video_res.get('analysis', {})
-                    else:
-                        error_msg = video_res.get('error', 'Unknown video analysis error')
-                        print(f"DEBUG: Video analysis FAILED for Ad ID {ad['ad_id']}: {error_msg}", file=sys.stderr)
-                        ad['media_analysis'] = {
-                            'analysis_error': error_msg
-                        }
+                cached_video = media_cache.get_cached_media(murl.strip(), media_type='video') if murl else None
+                reused_video = _reusable_video_analysis(cached_video and cached_video.get('content_hash'),
+                                                        ad.get('body', ''))
+                if reused_video:
+                    print(f"DEBUG: Reusing analysis of near-duplicate VIDEO for Ad ID {ad['ad_id']}", file=sys.stderr)
+                    ad['media_analysis'] = reused_video
+                elif murl:
+                    _raise_if_cancelled(cancel_event, ad.get('ad_id'))
+                    print(f"DEBUG: [Thread {threading.get_ident()}] Analyzing VIDEO for Ad ID {ad['ad_id']}", file=sys.stderr)
+                    if video_jobs is not None:
+                        # Upload + ACTIVE wait + analysis continue in the background
+                        future = submit_ad_video_analysis(
+                            media_url=murl,
+                            brand_name=ad.get('page_name'),
+                            ad_id=ad['ad_id'],
+                            ad_text=ad.get('body', ''),
+                            cancel_event=cancel_event
+                        )
+                        if progress:
+                            _track_video_future(progress, future)
+                        video_jobs.append((ad, future))
+                        continue
+                    if progress:
+                        progress.gemini_started()
+                    try:
+                        video_res = analyze_ad_video(
+                            media_url=murl, 
+                            brand_name=ad.get('page_name'), 
+                            ad_id=ad['ad_id'], 
+                            ad_text=ad.get('body', ''),
+                            cancel_event=cancel_event
+                        )
+                    finally:
+                        if progress:
+                            progress.gemini_finished()
+                    if progress and _is_fresh_video_analysis(video_res):
+                        progress.gemini_request()
+                    _apply_video_result(ad, video_res)
             elif ad.get('media_type') == 'IMAGE':
                 ad['media_analysis'] = {
                     'analysis_error': 'IMAGE analysis SKIPPED (download failed)'
@@ -312,6 +706,21 @@ def analyze_ad_media_batch(ads: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     
     return ads
 
+
+def analyze_ad_media_batch(ads: List[Dict[str, Any]], progress: Optional[PipelineProgress] = None, cancel_event: Optional[threading.Event] = None) -> List[Dict[str, Any]]:
+    """
+    Analyzes a group of ads (cards for same ID) using Gemini batching.
+    Thin sync wrapper over the download and analyze pipeline stages.
+    Raises AnalysisCancelledException between steps if cancel_event is set.
+    """
+    if not ads:
+        return ads
+
+    _raise_if_cancelled(cancel_event, ads[0].get('ad_id'))
+    cached_media = media_cache.get_cached_media_batch(_group_media_urls(ads))
+    images_to_batch = _download_group_media(ads, progress, cancel_event, cached_media)
+    return _analyze_group_media(ads, images_to_batch, progress, cancel_event)
+
 def detect_heuristics(ads: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
     """Detects URL and format anomalies in a group of ads and adds *** markers."""
     if len(ads) <= 1:
@@ -379,9 +788,6 @@ def analyze_media_func(ad: dict, analyze_media: bool) -> Dict[str, Any]:
             else:
                 error = result.get('error', 'Unknown error')
                 analysis_result['analysis_error'] = error
-                error_str = str(error).lower()
-                if any(keyword in error_str for keyword in ['quota', 'resource exhausted', 'credit', 'rate limit', '429', '503', 'exceeded', 'leaked', '403']):
-                    key_manager.mark_key_dead()
         
         elif media_type.upper() in ('IMAGE', 'DCO', 'CAROUSEL', 'DPA', 'MULTI_IMAGES'):
             result = analyze_ad_image(media_urls=media_url, brand_name=None, ad_id=ad_id, ad_text=ad_text)
@@ -396,17 +802,11 @@ def analyze_media_func(ad: dict, analyze_media: bool) -> Dict[str, Any]:
             else:
                 error = result.get('error', 'Unknown error')
                 analysis_result['analysis_error'] = error
-                error_str = str(error).lower()
-                if any(keyword in error_str for keyword in ['quota', 'resource exhausted', 'credit', 'rate limit', '429', '503', 'exceeded', 'leaked', '403']):
-                    key_manager.mark_key_dead()
         else:
             analysis_result['analysis_error'] = f"Unsupported media type: {media_type}"
     
     except Exception as e:
-        error_str = str(e).lower()
         analysis_result['analysis_error'] = str(e)
-        if any(keyword in error_str for keyword in ['quota', 'resource exhausted', 'credit', 'rate limit', '429', '503']):
-            key_manager.mark_key_dead()
     
     return analysis_result
 
@@ -521,6 +921,140 @@ def filter_new_ads(ads: list, existing_keys: set, max_ads: int = None) -> list:
     
     return new_ads
 
+def _run_ads_pipeline(sources: list, fetch_ads: Callable, filter_group: Callable, analyze_media: bool,
+                      progress: PipelineProgress, cancel_event: Optional[threading.Event] = None) -> tuple:
+    """
+    Runs fetch → filter → download → Gemini analyze → persist on the async pipeline engine.
+    Every stage has its own concurrency limit (PIPELINE_*_CONCURRENCY), so downloads and
+    Gemini calls scale independently instead of nesting thread pools.
+
+    Args:
+        sources: Fetch inputs (a search query or page IDs)
+        fetch_ads: fetch_ads(source) -> list of parsed ads
+        filter_group: filter_group(ad_id, group) -> filtered group (empty list drops it)
+        analyze_media: Run the download + analyze stages
+        progress: Progress counters (total grows as sources are fetched)
+        cancel_event: When set, pending groups are dropped
+
+    Returns:
+        Tuple of (processed ads in source/group order, number of ads fetched)
+    """
+    fetched_lock = threading.Lock()
+    fetched = [0]
+    # One batched cache lookup per fetched source (the whole search for a query),
+    # shared by every download worker instead of one SQLite query per image
+    cached_media: Dict[str, Optional[Dict[str, Any]]] = {}
+
+    def fetch_stage(item):
+        source_idx, source = item
+        try:
+            ads = fetch_ads(source)
+        except Exception as e:
+            # One bad source must not cost the other sources their results
+            logger.error(f"Fetching ads for {source!r} failed: {e}")
+            return []
+        with fetched_lock:
+            fetched[0] += len(ads)
+        if analyze_media and ads:
+            try:
+                lookup = media_cache.get_cached_media_batch(_group_media_urls(ads))
+            except Exception as e:
+                # Download workers fall back to per-URL lookups for URLs missing from the map
+                logger.error(f"Media cache lookup failed: {e}")
+                lookup = {}
+            with fetched_lock:
+                # Entries already in the map are as new or newer (written by download workers)
+                for url, row in lookup.items():
+                    cached_media.setdefault(url, row)
+        # Group ads by ad_id to process all cards (variants) together
+        groups = defaultdict(list)
+        for ad in ads:
+            groups[ad['ad_id']].append(ad)
+        progress.add_total(len(groups))
+        return [((source_idx, group_idx), ad_id, group) for group_idx, (ad_id, group) in enumerate(groups.items())]
+
+    def filter_stage(item):
+        key, ad_id, group = item
+        group = filter_group(ad_id, group)
+        if not group:
+            progress.group_done()
+            return None
+        return key, ad_id, group
+
+    # A failing group is persisted with an analysis_error (retry_failed_gemini_analysis picks it
+    # up later) instead of failing the whole run; only cancellation drops groups
+    def download_stage(item):
+        key, ad_id, group = item
+        try:
+            return key, ad_id, group, _download_group_media(group, progress, cancel_event, cached_media, fetched_lock)
+        except AnalysisCancelledException:
+            raise
+        except Exception as e:
+            logger.error(f"Media download failed for Ad ID {ad_id}: {e}")
+            _mark_group_failed(group, e)
+            return key, ad_id, group, None
+
+    def analyze_stage(item):
+        key, ad_id, group, images_to_batch = item
+        video_jobs = []
+        if images_to_batch is None:
+            return key, ad_id, group, video_jobs
+        try:
+            return key, ad_id, _analyze_group_media(group, images_to_batch, progress, cancel_event, video_jobs), video_jobs
+        except AnalysisCancelledException:
+            raise
+        except Exception as e:
+            logger.error(f"Media analysis failed for Ad ID {ad_id}: {e}")
+            _mark_group_failed(group, e)
+            # Videos already submitted still get applied by the video stage
+            return key, ad_id, group, video_jobs
+
+    async def video_stage(item):
+        # Awaits background video analyses on the event loop: no thread is held while
+        # videos upload and wait for ACTIVE, so dozens can be in flight at once
+        key, ad_id, group, video_jobs = item
+        for ad, future in video_jobs:
+            try:
+                video_res = await asyncio.wrap_future(future)
+            except (AnalysisCancelledException, asyncio.CancelledError):
+                # Keep the group's finished cards and videos for the partial results
+                ad['media_analysis'] = {'analysis_error': 'cancelled'}
+                continue
+            except Exception as e:
+                logger.error(f"Video analysis failed for Ad ID {ad_id}: {e}")
+                ad['media_analysis'] = {'analysis_error': str(e)}
+                continue
+            _apply_video_result(ad, video_res)
+        return key, ad_id, group
+
+    def persist_stage(item):
+        key, ad_id, group = item
+        progress.group_done()
+        return key, group
+
+    stages = [
+        Stage("fetch", fetch_stage, concurrency=PIPELINE_FETCH_CONCURRENCY, fan_out=True),
+        Stage("filter", filter_stage, inline=True),
+    ]
+    if analyze_media:
+        stages.append(Stage("download", download_stage, concurrency=PIPELINE_DOWNLOAD_CONCURRENCY))
+        stages.append(Stage("analyze", analyze_stage, concurrency=PIPELINE_ANALYZE_CONCURRENCY))
+        stages.append(Stage("videos", video_stage, concurrency=PIPELINE_VIDEO_CONCURRENCY))
+    # Persist keeps groups that finished analysis before a cancellation (partial results)
+    stages.append(Stage("persist", persist_stage, inline=True, finish_on_cancel=True))
+
+    pipeline = AsyncPipeline(stages, cancel_event=cancel_event, drop_exceptions=(AnalysisCancelledException,))
+    results = pipeline.run_sync(list(enumerate(sources)))
+
+    stats = progress.snapshot()
+    if stats['images_downscaled']:
+        print(f"DEBUG: Downscaled {stats['images_downscaled']} images for Gemini, "
+              f"{stats['image_mb_saved']} MB less to upload", file=sys.stderr)
+
+    # Groups finish out of order; restore the original source/group order
+    results.sort(key=lambda r: r[0])
+    return [ad for _, group in results for ad in group], fetched[0]
+
 # --- EXPORTED TOOLS ---
 
 def get_meta_platform_id(brand_names: Union[str, List[str]]) -> Dict[str, Any]:
@@ -580,7 +1114,9 @@ def search_facebook_ads(
     append_mode: bool = False,
     max_ads: Optional[int] = None,
     apply_filtering: bool = True,
-    start_date: Optional[str] = None
+    start_date: Optional[str] = None,
+    progress_callback: Optional[Callable[..., None]] = None,
+    cancel_event: Optional[threading.Event] = None
 ) -> Dict[str, Any]:
     """
     Unified function to search for Facebook ads with media analysis and filtering.
@@ -597,9 +1133,10 @@ def search_facebook_ads(
         max_ads: Limit saved ads count.
         apply_filtering: Enable domain/content logic filtering.
         start_date: Filter: ads that started after (YYYY-MM-DD).
+        progress_callback: Optional callable(progress, total, message) for MCP progress notifications.
+        cancel_event: Optional event set by the server on notifications/cancelled.
+                      Pending groups are dropped and partial results are saved.
     """
-    key_manager.reset_all()
-
     if not query or not query.strip():
         return {"success": False, "message": "Missing query", "results": [], "count": 0}
 
@@ -614,34 +1151,22 @@ def search_facebook_ads(
         
         logging.info(f"Fetching {req_limit} ads from API")
         
-        ads = search_ads_by_keyword(
-            query=query,
-            limit=req_limit,
-            country=country,
-            active_status=active_status,
-            media_type=media_type,
-            trim=False,
-            start_date=start_date
-        )
-        
-        if not ads:
-             return {"success": True, "message": f"No ads found for query: {query}", "results": [], "count": 0}
-
-        # Add search_query to each ad (fixes null issue)
-        for ad in ads:
-            ad['search_query'] = query
-
-        # 1. Group ads by ad_id to process all cards (variants) together
-        groups = defaultdict(list)
-        for ad in ads:
-            groups[ad['ad_id']].append(ad)
-        
-        # 2. Process each group in parallel (Stable Multi-threading + REST API)
-        from concurrent.futures import ThreadPoolExecutor
-        final_processed_ads = []
+        def fetch_ads(search_query):
+            ads = search_ads_by_keyword(
+                query=search_query,
+                limit=req_limit,
+                country=country,
+                active_status=active_status,
+                media_type=media_type,
+                trim=False,
+                start_date=start_date
+            )
+            # Add search_query to each ad (fixes null issue)
+            for ad in ads:
+                ad['search_query'] = search_query
+            return ads
         
-        def process_single_group(group_data):
-            ad_id, group = group_data
+        def filter_group(ad_id, group):
             if apply_filtering:
                 # 1. Structural filtering first (fast)
                 group = [ad for ad in group if filter_ad(ad)]
@@ -658,24 +1183,16 @@ def search_facebook_ads(
             if len(group) > 12:
                 print(f"DEBUG: Auto-skipping ad_id {ad_id}. Contains {len(group)} variants (>12), which indicates a 'white' advertiser.", file=sys.stderr)
                 return []
-            
-            if analyze_media and group:
-                group = analyze_ad_media_batch(group)
             return group
 
-        # ThreadPool works fine now because we use direct REST API with fixed keys
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            group_list = list(groups.items())
-            total_groups = len(group_list)
-            print(f"DEBUG: Processing {total_groups} groups in threads (Isolation via REST API)...", file=sys.stderr)
-            
-            processed_groups = list(executor.map(process_single_group, group_list))
-            
-            for idx, group in enumerate(processed_groups, 1):
-                if idx % 10 == 0 or idx == total_groups:
-                    print(f"PROGRESS: Processed {idx}/{total_groups} groups...", file=sys.stderr)
-                for ad in group:
-                    final_processed_ads.append(ad)
+        # Groups flow through bounded stages (REST API with fixed keys keeps threads isolated)
+        progress = PipelineProgress(callback=progress_callback)
+        print(f"DEBUG: Processing groups on async pipeline (fetch → filter → download → analyze → persist)...", file=sys.stderr)
+        final_processed_ads, total_found = _run_ads_pipeline([query], fetch_ads, filter_group, analyze_media, progress, cancel_event)
+        cancelled = cancel_event is not None and cancel_event.is_set()
+
+        if total_found == 0 and not cancelled:
+             return {"success": True, "message": f"No ads found for query: {query}", "results": [], "count": 0}
         
         # Format results without deduplication so that ALL variants (cards) are kept
         formatted_ads = [convert_ad_to_file_format(ad) for ad in final_processed_ads]
@@ -735,13 +1252,26 @@ def search_facebook_ads(
              # Let's keep saved_count as total items in file for clarity to user
              pass
 
+        if cancelled:
+            return {
+                "success": False,
+                "cancelled": True,
+                "message": f"Search cancelled. Saved {len(formatted_ads)} partial results to {saved_filepath}.",
+                "results": formatted_ads,
+                "count": len(formatted_ads),
+                "total_found": total_found,
+                "saved_file": saved_filepath,
+                "pipeline_stats": progress.snapshot()
+            }
+
         return {
             "success": True,
             "message": f"Found {len(formatted_ads)} ads (FIXED). Saved to {saved_filepath}.",
             "results": formatted_ads,
             "count": len(formatted_ads), # Return count of found ads in this run
-            "total_found": len(ads),
-            "saved_file": saved_filepath
+            "total_found": total_found,
+            "saved_file": saved_filepath,
+            "pipeline_stats": progress.snapshot()
         }
 
     except Exception as e:
@@ -817,7 +1347,7 @@ def _fetch_all_ads_from_page(page_id: str, limit: int = 50, country: Optional[st
             params['cursor'] = cursor
             
         try:
-            response = requests.get(ADS_API_URL, headers=headers, params=params, timeout=30)
+            response = http_get(ADS_API_URL, headers=headers, params=params, timeout=30)
             total_requests += 1
             check_credit_status(response)
             if response.status_code != 200:
@@ -848,14 +1378,16 @@ def get_fanpage_ads(
     target_file: Optional[str] = None,
     append_mode: bool = False,
     max_ads: Optional[int] = None,
-    apply_filtering: bool = True
+    apply_filtering: bool = True,
+    progress_callback: Optional[Callable[..., None]] = None,
+    cancel_event: Optional[threading.Event] = None
 ) -> Dict[str, Any]:
     """
     Unified fanpage tool: fetch all ads by page ID(s), filter, analyze media with Gemini, save to file.
     Full pipeline analogous to search_facebook_ads but using page IDs instead of keyword search.
+    progress_callback: Optional callable(progress, total, message) for MCP progress notifications.
+    cancel_event: Optional event set on notifications/cancelled; pending groups are dropped, partial results saved.
     """
-    key_manager.reset_all()
-
     if not platform_ids:
         return {"success": False, "message": "Missing platform_ids", "results": [], "count": 0}
 
@@ -876,56 +1408,32 @@ def get_fanpage_ads(
 
         fetch_limit = limit if limit else 50
 
-        # Fetch ads from all pages
-        all_ads = []
-        for pid in platform_list:
+        # Fetch ads from all pages (fetch is the first pipeline stage, pages run in parallel)
+        def fetch_ads(pid):
             # Use our custom fetcher with filter_inactive=False
             page_ads = _fetch_all_ads_from_page(pid, fetch_limit, country)
             logging.info(f"Fetched {len(page_ads)} ads from page {pid} (including potentially processed/recent)")
-            all_ads.extend(page_ads)
-
-        if not all_ads:
-            return {"success": True, "message": "No ads found for given platform IDs", "results": [], "count": 0}
-
-        # Tag each ad with its source
-        for ad in all_ads:
-            ad['search_query'] = f"fanpage:{ad.get('page_id', 'unknown')}"
-
-        # Group ads by ad_id to process all cards (variants) together
-        groups = defaultdict(list)
-        for ad in all_ads:
-            groups[ad['ad_id']].append(ad)
+            # Tag each ad with its source
+            for ad in page_ads:
+                ad['search_query'] = f"fanpage:{ad.get('page_id', 'unknown')}"
+            return page_ads
 
-        # Process each group in parallel (same pipeline as search_facebook_ads)
-        from concurrent.futures import ThreadPoolExecutor
-        final_processed_ads = []
-
-        def process_single_group(group_data):
-            ad_id, group = group_data
+        def filter_group(ad_id, group):
             if apply_filtering:
                 group = [ad for ad in group if filter_ad(ad)]
                 if not group:
                     return []
                 group = detect_heuristics(group)
-                if not group:
-                    return []
-
-            if analyze_media and group:
-                group = analyze_ad_media_batch(group)
             return group
 
-        with ThreadPoolExecutor(max_workers=10) as executor:
-            group_list = list(groups.items())
-            total_groups = len(group_list)
-            print(f"DEBUG: [Fanpage] Processing {total_groups} groups in threads...", file=sys.stderr)
+        # Same pipeline as search_facebook_ads
+        progress = PipelineProgress(callback=progress_callback, label="[Fanpage] ")
+        print(f"DEBUG: [Fanpage] Processing {len(platform_list)} page(s) on async pipeline...", file=sys.stderr)
+        final_processed_ads, total_found = _run_ads_pipeline(platform_list, fetch_ads, filter_group, analyze_media, progress, cancel_event)
+        cancelled = cancel_event is not None and cancel_event.is_set()
 
-            processed_groups = list(executor.map(process_single_group, group_list))
-
-            for idx, group in enumerate(processed_groups, 1):
-                if idx % 10 == 0 or idx == total_groups:
-                    print(f"PROGRESS: Processed {idx}/{total_groups} groups...", file=sys.stderr)
-                for ad in group:
-                    final_processed_ads.append(ad)
+        if total_found == 0 and not cancelled:
+            return {"success": True, "message": "No ads found for given platform IDs", "results": [], "count": 0}
 
         # Format results
         formatted_ads = [convert_ad_to_file_format(ad) for ad in final_processed_ads]
@@ -963,13 +1471,26 @@ def get_fanpage_ads(
                 logging.error(f"Saving failed: {save_err}")
                 saved_filepath = f"ERROR_SAVING: {save_err}"
 
+        if cancelled:
+            return {
+                "success": False,
+                "cancelled": True,
+                "message": f"Fanpage processing cancelled. Saved {len(formatted_ads)} partial results to {saved_filepath}.",
+                "results": formatted_ads,
+                "count": len(formatted_ads),
+                "total_found": total_found,
+                "saved_file": saved_filepath,
+                "pipeline_stats": progress.snapshot()
+            }
+
         return {
             "success": True,
             "message": f"Found {len(formatted_ads)} ads from fanpage(s). Saved to {saved_filepath}.",
             "results": formatted_ads,
             "count": len(formatted_ads),
-            "total_found": len(all_ads),
-            "saved_file": saved_filepath
+            "total_found": total_found,
+            "saved_file": saved_filepath,
+            "pipeline_stats": progress.snapshot()
         }
 
     except Exception as e:
@@ -989,14 +1510,14 @@ def analyze_ad_image(media_urls: Union[str, List[str]], brand_name: Optional[str
          return {"success": False, "message": "All Gemini API keys exhausted", "error": "Quota exhausted"}
 
     try:
-        # Check cache (skip if ad_text provided — context changes the analysis)
-        if not ad_text:
-            cached_data = image_cache.get_cached_image(media_url.strip())
-            if cached_data and cached_data.get('analysis_results'):
-                return {"success": True, "cached": True, "analysis": cached_data['analysis_results']}
+        # Check cache: analyses are keyed by content + prompt version + model + ad_text
+        cached_data = image_cache.get_cached_image(media_url.strip())
+        cached_analysis = _reusable_analysis(cached_data and cached_data.get('content_hash'), 'image', IMAGE_PROMPT_VERSION, ad_text)
+        if cached_analysis:
+            return {"success": True, "cached": True, "analysis": cached_analysis}
         
         # Download
-        response = requests.get(media_url.strip(), timeout=30)
+        response = http_get(media_url.strip(), timeout=30)
         response.raise_for_status()
         
         image_bytes = response.content
@@ -1013,6 +1534,12 @@ def analyze_ad_image(media_urls: Union[str, List[str]], brand_name: Optional[str
             ad_id=ad_id
         )
 
+        # Same creative already analyzed under another (signed) URL: reuse the content's analysis
+        content_hash = image_cache.compute_content_hash(image_bytes)
+        cached_analysis = _reusable_analysis(content_hash, 'image', IMAGE_PROMPT_VERSION, ad_text)
+        if cached_analysis:
+            return {"success": True, "cached": True, "analysis": cached_analysis}
+
         image_data_b64 = base64.b64encode(image_bytes).decode('utf-8')
 
         if not GEMINI_AVAILABLE:
@@ -1031,14 +1558,18 @@ def analyze_ad_image(media_urls: Union[str, List[str]], brand_name: Optional[str
 1. ОФФЕР: [Название бренда, препарата и форма (например, 'Grovi Gel гель'). Если препарат виден, но имя не читается — 'неизвестный [препарат/форма]'. Если это белая заглушка/white page — 'white'].
 2. СОДЕРЖАНИЕ: [Максимально детально: ВЕСЬ ТЕКСТ на картинке, все люди и персонажи, их действия, позы, одежда, окружающая обстановка и все объекты].
 """
-        raw_analysis = analyze_image_with_gemini(model, image_bytes, analysis_prompt, mime_type=content_type)
+        prepared = _prepare_image_for_gemini({'bytes': image_bytes, 'mime_type': content_type,
+                                              'content_hash': content_hash, 'url': media_url})
+        raw_analysis = analyze_image_with_gemini(model, prepared['bytes'], analysis_prompt, mime_type=prepared['mime_type'])
         
         analysis_result = {
             "raw_analysis": raw_analysis
         }
         
-        # Update cache with analysis
-        image_cache.update_analysis_results(media_url.strip(), analysis_result)
+        # Update cache with analysis (errors are not cached: they would shadow near-duplicate hits)
+        if not _is_failed_analysis(raw_analysis):
+            image_cache.update_analysis_results(media_url.strip(), analysis_result)
+            image_cache.store_analysis(content_hash, IMAGE_PROMPT_VERSION, GEMINI_MODEL_NAME, ad_text, analysis_result)
         
         return {
             "success": True, 
@@ -1049,113 +1580,199 @@ def analyze_ad_image(media_urls: Union[str, List[str]], brand_name: Optional[str
         }
 
     except Exception as e:
-        error_str = str(e).lower()
-        if any(keyword in error_str for keyword in ['quota', 'resource exhausted', 'credit', 'rate limit', '429', '503']):
-            key_manager.mark_key_dead()
         return {"success": False, "error": str(e)}
 
-def analyze_ad_video(media_url: str, brand_name: str = None, ad_id: str = None, ad_text: str = None, api_key: Optional[str] = None, model: Optional[Any] = None) -> Dict[str, Any]:
-    """Downloads a video and performs Gemini analysis with fixed key to avoid 403."""
+def _download_video_to_cache(media_url: str, brand_name: str = None, ad_id: str = None) -> str:
+    """Returns the local path of a cached video, downloading it into the media cache if needed."""
+    cached_data = media_cache.get_cached_media(media_url.strip(), media_type='video')
+    if cached_data:
+        return cached_data['file_path']
+
+    # Streamed to a temp file in chunks: memory per download stays at DOWNLOAD_CHUNK_SIZE
+    with http_get(media_url.strip(), timeout=60, stream=True) as resp:
+        resp.raise_for_status()
+        content_type = resp.headers.get('content-type', '').lower()
+
+        declared_size = int(resp.headers.get('content-length') or 0)
+        if declared_size > MAX_VIDEO_FILE_MB * 1024 * 1024:
+            raise MediaTooLargeException(f"Video too large ({declared_size / (1024 * 1024):.0f} MB > {MAX_VIDEO_FILE_MB:.0f} MB)")
+
+        return media_cache.cache_media_stream(
+            url=media_url.strip(),
+            chunks=resp.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE),
+            content_type=content_type,
+            media_type='video',
+            brand_name=brand_name,
+            ad_id=ad_id
+        )
+
+def _video_analysis_prompt(ad_text: Optional[str]) -> str:
+    ad_text_block = f"""ТЕКСТ ОБЪЯВЛЕНИЯ:
+{ad_text[:2000]}
+
+""" if ad_text else ""
+
+    return f"""{ad_text_block}Проанализируй видео рекламы. Ответ - JSON с полями ниже, сжато в информационном стиле без вступлений:
+
+- offer: [Название бренда, препарата и форма. Если бренд не читается — 'неизвестный [препарат/форма]'. Если это видео-заглушка/white page — 'white'].
+- scenes: [ПОЛНОЕ описание визуала: кто в кадре, что делает, какие действия совершаются. Нужен ПОЛНЫЙ СКРИПТ БЕЗ ТЕКСТА на экране].
+- format: [Длительность. Повторяется ли один статичный кадр дольше 60 секунд после динамических кадров?]
+- hook: [Описание первых 5 секунд: визуальная зацепка и основной смысловой посыл].
+- voiceover: [Если есть — переведи на русский и напиши ДОСЛОВНО ВЕСЬ ТЕКСТ озвучки (полная транскрипция всех слов)].
+- people: [Возраст, пол, эмоции, национальность, одежда, детально что делают].
+- cta: [Текст CTA или "нет"].
+"""
+
+
+def _store_video_analysis(media_url: str, content_hash: Optional[str], prompt_version: str,
+                          ad_text: Optional[str], analysis_result: Dict[str, Any]):
+    if _is_failed_analysis(analysis_result.get('raw_analysis')):
+        return
+    media_cache.update_analysis_results(media_url.strip(), analysis_result)
+    if content_hash:
+        media_cache.store_analysis(content_hash, prompt_version, GEMINI_MODEL_NAME, ad_text, analysis_result)
+
+
+def _done_future(result: Dict[str, Any]) -> Future:
+    future = Future()
+    future.set_result(result)
+    return future
+
+
+def submit_ad_video_analysis(media_url: str, brand_name: str = None, ad_id: str = None, ad_text: str = None,
+                             api_key: Optional[str] = None, cancel_event: Optional[threading.Event] = None,
+                             video_mode: Optional[str] = None, num_frames: Optional[int] = None) -> Future:
+    """
+    Non-blocking analyze_ad_video: returns a Future with the same result dict.
+
+    Cache checks, the download and frames mode run in the calling thread (the Future is
+    already done). In upload mode the video goes to video_analysis_queue: the upload, the
+    wait for ACTIVE and the analysis request happen in the background, so one caller can
+    keep many videos in flight. The Future raises AnalysisCancelledException if
+    cancel_event is set before the analysis finishes; cancelling it stops the job.
+    """
     try:
         if not media_url:
-            return {"success": False, "error": "No media_url provided"}
+            return _done_future({"success": False, "error": "No media_url provided"})
         
         # 1. Download to cache
         if key_manager.all_exhausted:
-            return {"success": False, "message": "All Gemini API keys exhausted"}
+            return _done_future({"success": False, "message": "All Gemini API keys exhausted"})
 
-        # Check cache (only if no ad_text context)
-        if not ad_text:
-            cached_data = media_cache.get_cached_media(media_url.strip(), media_type='video')
-            if cached_data and cached_data.get('analysis_results'):
-                return {"success": True, "cached": True, "analysis": cached_data['analysis_results']}
+        # Check cache: analyses are keyed by content + prompt version + model + ad_text
+        cached_data = media_cache.get_cached_media(media_url.strip(), media_type='video')
+        cached_analysis = _reusable_video_analysis(cached_data and cached_data.get('content_hash'), ad_text, video_mode)
+        if cached_analysis:
+            return _done_future({"success": True, "cached": True, "analysis": cached_analysis})
         
         # Download (if not cached file existed but no analysis)
-        video_path = None
+        video_path = _download_video_to_cache(media_url, brand_name=brand_name, ad_id=ad_id)
+
+        # Same creative already analyzed under another (signed) URL: reuse the content's analysis
         cached_data = media_cache.get_cached_media(media_url.strip(), media_type='video')
-        if cached_data:
-            video_path = cached_data['file_path']
-        else:
-            resp = requests.get(media_url.strip(), timeout=60)
-            resp.raise_for_status()
-            content_type = resp.headers.get('content-type', '').lower()
-            
-            video_path = media_cache.cache_media(
-                url=media_url.strip(),
-                media_data=resp.content,
-                content_type=content_type,
-                media_type='video',
-                brand_name=brand_name,
-                ad_id=ad_id
-            )
+        content_hash = cached_data.get('content_hash') if cached_data else None
+        cached_analysis = _reusable_video_analysis(content_hash, ad_text, video_mode)
+        if cached_analysis:
+            return _done_future({"success": True, "cached": True, "analysis": cached_analysis})
             
         if not GEMINI_AVAILABLE:
-             return {"success": True, "cached": False, "message": "Gemini not available, video cached but not analyzed"}
+             return _done_future({"success": True, "cached": False, "message": "Gemini not available, video cached but not analyzed"})
 
         # Perform Analysis
-        from services.gemini_service import configure_gemini, upload_video_to_gemini, analyze_video_with_gemini
-        
-        # Local model for upload/wait session
-        if not model:
-            # Important: Ensure the global config for THIS thread's upload session is correct
-            import google.generativeai as genai
-            genai.configure(api_key=api_key or get_gemini_api_key())
-            model = genai.GenerativeModel('gemini-3.1-flash-lite')
-        
-        # Upload to Gemini (now REST-based and takes api_key)
-        gemini_file = upload_video_to_gemini(video_path, api_key=api_key)
-        
-        ad_text_block = f"""ТЕКСТ ОБЪЯВЛЕНИЯ:
-{ad_text[:2000]}
+        from services.gemini_service import analyze_video_frames_with_gemini, video_analysis_queue, resolve_future
+
+        extracted = None
+        if resolve_video_mode(video_mode, video_path) == 'frames':
+            extracted = extract_video_frames(video_path, num_frames)
+            if extracted is None:
+                print(f"DEBUG: Frame extraction failed for {media_url[:60]}, uploading the video instead", file=sys.stderr)
+
+        analysis_prompt = _video_analysis_prompt(ad_text)
+        if extracted:
+            # Frames mode: keyframes + audio inline in one request, any key will do
+            _raise_if_cancelled(cancel_event, ad_id)
+            duration = extracted['duration']
+            frames_intro = (f"Видео передано как {len(extracted['frames'])} кадров по порядку (с таймкодами)"
+                            + (" и аудиодорожка" if extracted['audio'] else ", звука нет")
+                            + (f". Длительность: {duration:.0f} с." if duration else ".") + "\n\n")
+            raw_analysis = analyze_video_frames_with_gemini(extracted['frames'], extracted['audio'], frames_intro + analysis_prompt,
+                                                            duration=duration, api_key=api_key, cancel_event=cancel_event)
+            analysis_result = parse_video_analysis(raw_analysis)
+            analysis_result["video_mode"] = "frames"
+            _store_video_analysis(media_url, content_hash, VIDEO_FRAMES_PROMPT_VERSION, ad_text, analysis_result)
+            return _done_future({"success": True, "cached": False, "analysis": analysis_result})
+
+        # Upload mode: upload from the cached file (streamed), the queue analyzes once it is ACTIVE.
+        # Upload and analysis share one key: an uploaded file is only visible to its own key (else 403).
+        # With the content hash, a still-valid earlier upload of the same bytes is reused instead.
+        video_mime = (cached_data or {}).get('content_type') or 'video/mp4'
+        raw_future = video_analysis_queue.submit(video_path, analysis_prompt, api_key=api_key, cancel_event=cancel_event,
+                                                 mime_type=video_mime if video_mime.startswith('video/') else 'video/mp4',
+                                                 content_hash=content_hash)
+    except AnalysisCancelledException:
+        raise
+    except Exception as e:
+        return _done_future({"success": False, "error": str(e)})
 
-""" if ad_text else ""
-        
-        analysis_prompt = f"""{ad_text_block}Проанализируй видео рекламы. Отвечай по этой структуре сжато в информационном стиле без вступлений:
-
-1. ОФФЕР: [Название бренда, препарата и форма. Если бренд не читается — 'неизвестный [препарат/форма]'. Если это видео-заглушка/white page — 'white'].
-2. СЦЕНЫ: [ПОЛНОЕ описание визуала: кто в кадре, что делает, какие действия совершаются. Нужен ПОЛНЫЙ СКРИПТ БЕЗ ТЕКСТА на экране].
-3. ФОРМАТ: [Длительность. Повторяется ли один статичный кадр дольше 60 секунд после динамических кадров?]
-4. ХУК: [Описание первых 5 секунд: визуальная зацепка и основной смысловой посыл].
-5. ОЗВУЧКА: [Если есть — переведи на русский и напиши ДОСЛОВНО ВЕСЬ ТЕКСТ озвучки (полная транскрипция всех слов)].
-6. ЛЮДИ: [Возраст, пол, эмоции, национальность, одежда, детально что делают].
-7. ПРИЗЫВ К ДЕЙСТВИЮ: [Текст CTA или "нет"].
-"""
-        # Call REST-based analysis passing the SAME key to avoid 403
-        raw_analysis = analyze_video_with_gemini(model, gemini_file, analysis_prompt, api_key=api_key)
-        
-        # Cleanup remote file
+    result_future = Future()
+
+    def finish(done: Future):
+        if done.cancelled():
+            result_future.cancel()
+            return
         try:
-            cleanup_gemini_file(gemini_file.name)
-        except:
-             pass
+            analysis_result = parse_video_analysis(done.result())
+            _store_video_analysis(media_url, content_hash, VIDEO_PROMPT_VERSION, ad_text, analysis_result)
+        except AnalysisCancelledException as e:
+            resolve_future(result_future, exc=e)
+            return
+        except Exception as e:
+            resolve_future(result_future, {"success": False, "error": str(e)})
+            return
+        resolve_future(result_future, {"success": True, "cached": False, "analysis": analysis_result})
 
-        analysis_result = {
-            "raw_analysis": raw_analysis
-        }
-        
-        # Update cache
-        media_cache.update_analysis_results(media_url.strip(), analysis_result)
-        
-        return {
-             "success": True,
-             "cached": False,
-             "analysis": analysis_result
-        }
+    raw_future.add_done_callback(finish)
+    result_future.add_done_callback(lambda f: raw_future.cancel() if f.cancelled() else None)
+    return result_future
 
-    except Exception as e:
-        error_str = str(e).lower()
-        if any(keyword in error_str for keyword in ['quota', 'resource exhausted', 'credit', 'rate limit', '429', '503']):
-            key_manager.mark_key_dead()
-        return {"success": False, "error": str(e)}
+
+def analyze_ad_video(media_url: str, brand_name: str = None, ad_id: str = None, ad_text: str = None, api_key: Optional[str] = None, model: Optional[Any] = None,
+                     cancel_event: Optional[threading.Event] = None, video_mode: Optional[str] = None,
+                     num_frames: Optional[int] = None) -> Dict[str, Any]:
+    """
+    Downloads a video and performs Gemini analysis with fixed key to avoid 403.
+    Re-raises AnalysisCancelledException if cancel_event is set while waiting for the upload.
+
+    video_mode: 'upload' (whole video via the Files API), 'frames' (num_frames keyframes + audio
+    track sent inline: no upload / ACTIVE polling, slightly less detail) or 'auto' (frames for
+    videos up to GEMINI_FRAMES_MAX_SECONDS). None = GEMINI_VIDEO_MODE. Falls back to 'upload'
+    without ffmpeg.
+    model is accepted for compatibility; all Gemini calls go through REST.
+    """
+    future = submit_ad_video_analysis(media_url, brand_name=brand_name, ad_id=ad_id, ad_text=ad_text, api_key=api_key,
+                                      cancel_event=cancel_event, video_mode=video_mode, num_frames=num_frames)
+    if cancel_event is not None:
+        # Wakes up immediately on cancellation instead of waiting for the background job
+        while not future.done():
+            if cancel_event.wait(0.5):
+                future.cancel()
+                raise AnalysisCancelledException(f"Video analysis cancelled for ad {ad_id}")
+    return future.result()
 
 def analyze_ad_videos_batch(media_urls: List[str], brand_names: Optional[List[str]] = None, ad_ids: Optional[List[str]] = None) -> Dict[str, Any]:
-    # Simplified batch implementation iterating single calls for robustness in this manual version
-    # or implementing true batch if critical. For now, let's just loop to ensure function exists and works.
-    results = {}
+    # Every video is submitted first, so uploads / processing overlap instead of running one by one
+    futures = {}
     for i, url in enumerate(media_urls):
         bn = brand_names[i] if brand_names and i < len(brand_names) else None
         aid = ad_ids[i] if ad_ids and i < len(ad_ids) else None
-        results[url] = analyze_ad_video(url, bn, aid)
+        futures[url] = submit_ad_video_analysis(url, bn, aid)
+
+    results = {}
+    for url, future in futures.items():
+        try:
+            results[url] = future.result()
+        except Exception as e:
+            results[url] = {"success": False, "error": str(e)}
     
     return {"success": True, "results": results}
 
@@ -1168,6 +1785,10 @@ def get_cache_stats() -> Dict[str, Any]:
     except Exception as e:
         return {"success": False, "error": str(e)}
 
+def get_gemini_key_status() -> Dict[str, Any]:
+    """Per-key state (healthy / cooling_down / exhausted) and usage metrics of the Gemini key pool."""
+    return {"success": True, "status": key_manager.get_status()}
+
 def search_cached_media(brand_name: Optional[str] = None, has_people: Optional[bool] = None, color_contains: Optional[str] = None, media_type: Optional[str] = None, limit: Optional[int] = 20) -> Dict[str, Any]:
     try:
         results = media_cache.search_cached_media(brand_name, has_people, color_contains, media_type)
@@ -1184,8 +1805,8 @@ def cleanup_media_cache(max_age_days: Optional[int] = 30) -> Dict[str, Any]:
 
 def clean_results_file(filename: str, overwrite: bool = True) -> Dict[str, Any]:
     """
-    Reads a JSON results file, removes all ad cards where raw_analysis contains 'white',
-    and saves the cleaned version.
+    Reads a JSON results file, removes all ad cards whose offer is 'white' (the structured
+    offer field; older text-only analyses: raw_analysis contains 'white'), and saves the cleaned version.
 
     Args:
         filename: Name of the file in the results/ directory (e.g. 'DE_Prostatitis.json').
@@ -1213,6 +1834,7 @@ def clean_results_file(filename: str, overwrite: bool = True) -> Dict[str, Any]:
 
     for ad in ads:
         raw = None
+        offer = None
 
         ma = ad.get('media_analysis')
         if isinstance(ma, dict):
@@ -1223,12 +1845,14 @@ def clean_results_file(filename: str, overwrite: bool = True) -> Dict[str, Any]:
 
             # VIDEO: media_analysis.raw_analysis
             raw = ma.get('raw_analysis')
+            offer = ma.get('offer')
 
             # IMAGE (batch): media_analysis.image_analysis.raw_analysis
             if raw is None:
                 img = ma.get('image_analysis')
                 if isinstance(img, dict):
                     raw = img.get('raw_analysis')
+                    offer = img.get('offer')
         else:
             # No media_analysis at all → keep
             kept.append(ad)
@@ -1239,8 +1863,12 @@ def clean_results_file(filename: str, overwrite: bool = True) -> Dict[str, Any]:
             kept.append(ad)
             continue
 
-        # Check if raw_analysis contains 'white' (case-insensitive)
-        if 'white' in str(raw).lower():
+        if offer is not None:
+            is_white = str(offer).strip(" '\"").lower() == 'white'
+        else:
+            # Text-only analysis: check if raw_analysis contains 'white' (case-insensitive)
+            is_white = 'white' in str(raw).lower()
+        if is_white:
             removed += 1
         else:
             kept.append(ad)
@@ -1268,8 +1896,140 @@ def clean_results_file(filename: str, overwrite: bool = True) -> Dict[str, Any]:
     }
 
 
-def retry_failed_gemini_analysis(json_file_path: str) -> Dict[str, Any]:
-    """Retry Gemini analysis for ads that have failed or missing analysis in a local JSON file."""
+def _batch_analyze_ads(ads: List[Dict[str, Any]], cancel_event: Optional[threading.Event] = None,
+                       on_results: Optional[Callable[[], None]] = None) -> Dict[str, int]:
+    """
+    Offline analysis through the Gemini Batch API: every pending image group and video
+    becomes one request of a batch job, and the answers are merged back into
+    ad['media_analysis'] (and the analysis cache) when the jobs finish.
+    Cached analyses are applied directly. Batch jobs have their own quota, so they don't
+    compete with interactive requests for RPM; they can take minutes to hours.
+    Each job's answers are merged as soon as the job finishes, then on_results is called
+    (e.g. to save the file), so a cancel or crash only loses the jobs still running.
+
+    Returns:
+        Counters: requests, cached, analyzed, failed
+    """
+    from services.gemini_service import (build_image_batch_body, build_generate_content_body, generate_content_text,
+                                         json_output_config, VIDEO_ANALYSIS_SCHEMA)
+    from services.gemini_batch_service import run_batch, ensure_uploaded, video_part
+
+    stats = {'requests': 0, 'cached': 0, 'analyzed': 0, 'failed': 0}
+    # One key owns the jobs and every uploaded video they reference
+    api_key = get_gemini_api_key()
+    cached_media = media_cache.get_cached_media_batch(_group_media_urls(ads))
+    groups = defaultdict(list)
+    for ad in ads:
+        groups[ad.get('ad_id', 'unknown')].append(ad)
+
+    requests = []
+    handlers: Dict[str, Callable[[str], None]] = {}
+    request_ads: Dict[str, List[Dict[str, Any]]] = {}
+    pending_videos = []  # (ad, content_hash, video_path, mime_type, ad_text)
+
+    for aid, group in groups.items():
+        _raise_if_cancelled(cancel_event, aid)
+        # Results files keep the ad text as 'ad_text', fresh ads as 'body'
+        ad_text = group[0].get('body') or group[0].get('ad_text') or ''
+        images = _download_group_media(group, None, cancel_event, cached_media)
+
+        pending_images = []
+        for ad, img in zip(group, images):
+            if img is not None:
+                reused = _reusable_analysis(img.get('content_hash'), 'image', BATCH_PROMPT_VERSION, ad_text)
+                if reused:
+                    ad['media_analysis'] = {'image_analysis': reused}
+                    stats['cached'] += 1
+                else:
+                    pending_images.append((ad, img))
+            elif ad.get('media_type') == 'VIDEO' and ad.get('media_url'):
+                murl = ad['media_url']
+                try:
+                    video_path = _download_video_to_cache(murl, brand_name=ad.get('page_name'), ad_id=ad.get('ad_id'))
+                except Exception as e:
+                    ad['media_analysis'] = {'analysis_error': f"Video download failed: {e}"}
+                    stats['failed'] += 1
+                    continue
+                cached_video = media_cache.get_cached_media(murl.strip(), media_type='video') or {}
+                reused = _reusable_video_analysis(cached_video.get('content_hash'), ad_text, 'upload')
+                if reused:
+                    ad['media_analysis'] = reused
+                    stats['cached'] += 1
+                else:
+                    video_mime = cached_video.get('content_type') or 'video/mp4'
+                    pending_videos.append((ad, cached_video.get('content_hash'), video_path,
+                                           video_mime if video_mime.startswith('video/') else 'video/mp4', ad_text))
+
+        if pending_images:
+            key = f"images:{aid}"
+            requests.append((key, build_image_batch_body([img for _, img in pending_images], ad_text)))
+            request_ads[key] = [ad for ad, _ in pending_images]
+
+            def apply_images(text, pending=pending_images, ad_text=ad_text):
+                parsed = parse_card_analyses(text, len(pending))
+                _store_image_analyses([img for _, img in pending], parsed, ad_text)
+                for (ad, _), analysis in zip(pending, parsed):
+                    ad['media_analysis'] = {'image_analysis': analysis}
+            handlers[key] = apply_images
+
+    # Videos are referenced by URI, so they must be uploaded (or still registered) under the job's key
+    files = ensure_uploaded([(h, path, mime) for _, h, path, mime, _ in pending_videos if h], api_key)
+    for i, (ad, content_hash, video_path, mime_type, ad_text) in enumerate(pending_videos):
+        gemini_file = files.get(content_hash)
+        if gemini_file is None or isinstance(gemini_file, Exception):
+            ad['media_analysis'] = {'analysis_error': f"Video upload failed: {gemini_file or 'no content hash'}"}
+            stats['failed'] += 1
+            continue
+        key = f"video:{i}:{ad.get('ad_id')}"
+        requests.append((key, build_generate_content_body([{"text": _video_analysis_prompt(ad_text)}, video_part(gemini_file)],
+                                                          generation_config=json_output_config(VIDEO_ANALYSIS_SCHEMA))))
+        request_ads[key] = [ad]
+
+        def apply_video(text, ad=ad, content_hash=content_hash, ad_text=ad_text):
+            analysis_result = parse_video_analysis(text)
+            _store_video_analysis(ad['media_url'], content_hash, VIDEO_PROMPT_VERSION, ad_text, analysis_result)
+            ad['media_analysis'] = analysis_result
+        handlers[key] = apply_video
+
+    if not requests:
+        return stats
+
+    stats['requests'] = len(requests)
+    print(f"DEBUG: Submitting {len(requests)} Gemini batch requests for {len(ads)} ads", file=sys.stderr)
+
+    def apply_results(job_results):
+        for key, result in job_results.items():
+            error_msg = result.get('error', 'No batch response')
+            if 'response' in result:
+                try:
+                    handlers[key](generate_content_text(result['response']))
+                    stats['analyzed'] += 1
+                    continue
+                except Exception as e:
+                    error_msg = f"Unreadable batch response: {e}"
+            print(f"DEBUG: Batch request {key} FAILED: {error_msg}", file=sys.stderr)
+            stats['failed'] += 1
+            # The ads keep an analysis_error, so the next retry picks them up again
+            for ad in request_ads[key]:
+                ad['media_analysis'] = {'analysis_error': f"Batch analysis failed: {error_msg}"}
+        if on_results is not None:
+            on_results()
+
+    run_batch(requests, api_key, cancel_event=cancel_event, on_results=apply_results)
+    return stats
+
+
+def retry_failed_gemini_analysis(json_file_path: str, batch_mode: bool = False,
+                                  cancel_event: Optional[threading.Event] = None) -> Dict[str, Any]:
+    """
+    Retry Gemini analysis for ads that have failed or missing analysis in a local JSON file.
+
+    batch_mode: submit everything as Gemini Batch API jobs and wait for them (offline runs:
+    no RPM pressure on the keys, results can take minutes to hours) instead of
+    interactive requests group by group.
+    cancel_event: stops the retry (and cancels running batch jobs); whatever was
+    analyzed so far is still written back to the file.
+    """
     import json
     import time
     from pathlib import Path
@@ -1298,7 +2058,7 @@ def retry_failed_gemini_analysis(json_file_path: str) -> Dict[str, Any]:
             else:
                 # Catch the fallback parsed strings like 'Analysis for card 2 not found in batch response.'
                 raw_text = ma.get('raw_analysis') or ma.get('image_analysis', {}).get('raw_analysis', '')
-                if "not found in batch response" in str(raw_text).lower():
+                if _is_failed_analysis(raw_text):
                     is_failed = True
                 
             if is_failed:
@@ -1308,6 +2068,33 @@ def retry_failed_gemini_analysis(json_file_path: str) -> Dict[str, Any]:
             return {"success": True, "message": "No failed ads found. Nothing to retry."}
             
         logger.info(f"Found {len(failed_ads)} ads to retry Gemini analysis.")
+
+        def save_results():
+            # Write-then-rename: a crash mid-write must not corrupt the results file
+            tmp_path = f"{json_file_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump(data, f, ensure_ascii=False, indent=4)
+            os.replace(tmp_path, json_file_path)
+
+        if batch_mode:
+            try:
+                batch_stats = _batch_analyze_ads(failed_ads, cancel_event, on_results=save_results)
+            except AnalysisCancelledException as e:
+                save_results()
+                return {
+                    "success": False,
+                    "cancelled": True,
+                    "message": f"Batch retry cancelled ({e}). Answers received so far were saved to {json_file_path}.",
+                    "retried_count": len(failed_ads)
+                }
+            save_results()
+            return {
+                "success": True,
+                "message": f"Batch-analyzed {len(failed_ads)} ads: {batch_stats['analyzed']} requests answered, "
+                           f"{batch_stats['cached']} from cache, {batch_stats['failed']} failed.",
+                "retried_count": len(failed_ads),
+                "batch_stats": batch_stats
+            }
         
         # Group ads by ad_id
         ad_groups = {}
@@ -1317,14 +2104,23 @@ def retry_failed_gemini_analysis(json_file_path: str) -> Dict[str, Any]:
                 ad_groups[aid] = []
             ad_groups[aid].append(ad)
             
-        for aid, group_ads in ad_groups.items():
-            logger.info(f"Retrying analysis for Ad Group {aid} ({len(group_ads)} ads)")
-            analyze_ad_media_batch(group_ads)
-            time.sleep(2)
-            
+        try:
+            for aid, group_ads in ad_groups.items():
+                _raise_if_cancelled(cancel_event, aid)
+                logger.info(f"Retrying analysis for Ad Group {aid} ({len(group_ads)} ads)")
+                analyze_ad_media_batch(group_ads, cancel_event=cancel_event)
+                time.sleep(2)
+        except AnalysisCancelledException as e:
+            save_results()
+            return {
+                "success": False,
+                "cancelled": True,
+                "message": f"Retry cancelled ({e}). Groups analyzed so far were saved to {json_file_path}.",
+                "retried_count": len(failed_ads)
+            }
+
         # Overwrite JSON
-        with open(json_file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=4)
+        save_results()
             
         return {
             "success": True,
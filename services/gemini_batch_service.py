@@ -0,0 +1,237 @@
+import os
+import json
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from services.http_client import http_get, http_post
+from services.gemini_service import (
+    GEMINI_API_BASE, GEMINI_MODEL_NAME, VIDEO_UPLOAD_CONCURRENCY, AnalysisCancelledException,
+    GeminiFile, StreamingJsonBody, file_poller, gemini_file_registry, start_video_upload,
+)
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+# Inline batch requests are limited to 20 MB per job; keep headroom for the JSON around them
+BATCH_MAX_MB = float(os.getenv("GEMINI_BATCH_MAX_MB", "18"))
+BATCH_MAX_REQUESTS = int(os.getenv("GEMINI_BATCH_MAX_REQUESTS", "500"))
+# Seconds between status checks of running jobs (they take minutes to hours)
+BATCH_POLL_INTERVAL = float(os.getenv("GEMINI_BATCH_POLL_INTERVAL", "30"))
+# Jobs still running after this long are cancelled (Gemini's own target is 24h)
+BATCH_TIMEOUT_HOURS = float(os.getenv("GEMINI_BATCH_TIMEOUT_HOURS", "24"))
+
+# Terminal job states (the API reports them as BATCH_STATE_* or JOB_STATE_*)
+_DONE_STATES = ("SUCCEEDED", "FAILED", "CANCELLED", "EXPIRED")
+
+
+# ============================================================
+#  Batch jobs (batchGenerateContent with inline requests)
+# ============================================================
+
+def build_batch_body(display_name: str, requests: List[Tuple[str, StreamingJsonBody]]) -> StreamingJsonBody:
+    """
+    batchGenerateContent body. Every request is a generateContent body (streamed, images are
+    base64-encoded while sending) tagged with its key in metadata.
+    """
+    segments: list = [b'{"batch":{"display_name":' + json.dumps(display_name).encode()
+                      + b',"input_config":{"requests":{"requests":[']
+    for i, (key, body) in enumerate(requests):
+        if i:
+            segments.append(b",")
+        segments.append(b'{"request":')
+        segments.extend(body.segments)
+        segments.append(b',"metadata":{"key":' + json.dumps(key).encode() + b'}}')
+    segments.append(b"]}}}}")
+    return StreamingJsonBody(segments)
+
+
+def pack_requests(requests: List[Tuple[str, StreamingJsonBody]], max_requests: int = BATCH_MAX_REQUESTS,
+                  max_mb: float = BATCH_MAX_MB) -> List[List[Tuple[str, StreamingJsonBody]]]:
+    """Splits requests into jobs under the per-job request count and size limits (in order)."""
+    max_bytes = int(max_mb * 1024 * 1024)
+    jobs: List[List[Tuple[str, StreamingJsonBody]]] = []
+    current: List[Tuple[str, StreamingJsonBody]] = []
+    size = 0
+    for key, body in requests:
+        if current and (len(current) >= max_requests or size + len(body) > max_bytes):
+            jobs.append(current)
+            current, size = [], 0
+        if len(body) > max_bytes:
+            logger.warning(f"Batch request {key} is {len(body) / (1024 * 1024):.1f} MB, over the per-job limit")
+        current.append((key, body))
+        size += len(body)
+    if current:
+        jobs.append(current)
+    return jobs
+
+
+def create_batch_job(requests: List[Tuple[str, StreamingJsonBody]], api_key: str, display_name: str) -> str:
+    """Submits one batch job and returns its name ("batches/abc")."""
+    body = build_batch_body(display_name, requests)
+    resp = http_post(f"{GEMINI_API_BASE}/v1beta/models/{GEMINI_MODEL_NAME}:batchGenerateContent?key={api_key}",
+                     headers={"Content-Type": "application/json"}, data=body, timeout=300)
+    if resp.status_code != 200:
+        raise Exception(f"Batch job creation failed ({resp.status_code}): {resp.text[:500]}")
+    name = resp.json().get("name")
+    if not name:
+        raise Exception("Batch job created but no name returned")
+    logger.info(f"Created Gemini batch job {name} with {len(requests)} requests")
+    return name
+
+
+def get_batch_job(name: str, api_key: str) -> Dict[str, Any]:
+    resp = http_get(f"{GEMINI_API_BASE}/v1beta/{name}?key={api_key}", timeout=60)
+    if resp.status_code != 200:
+        raise Exception(f"Batch status check failed ({resp.status_code}): {resp.text[:500]}")
+    return resp.json()
+
+
+def cancel_batch_job(name: str, api_key: str):
+    try:
+        http_post(f"{GEMINI_API_BASE}/v1beta/{name}:cancel?key={api_key}", timeout=60)
+    except Exception as e:
+        logger.warning(f"Failed to cancel batch job {name}: {e}")
+
+
+def batch_job_state(job: Dict[str, Any]) -> str:
+    """Short state of a job: PENDING, RUNNING, SUCCEEDED, FAILED, CANCELLED or EXPIRED."""
+    state = (job.get("metadata") or {}).get("state") or job.get("state") or ""
+    for prefix in ("BATCH_STATE_", "JOB_STATE_"):
+        if state.startswith(prefix):
+            return state[len(prefix):]
+    return state or ("SUCCEEDED" if job.get("done") else "PENDING")
+
+
+def batch_job_responses(job: Dict[str, Any], keys: List[str]) -> Dict[str, Dict[str, Any]]:
+    """
+    Inline responses of a finished job by request key: {'response': generateContent JSON}
+    or {'error': message}. Responses without a metadata key are matched by position.
+    """
+    container = job.get("response") or (job.get("metadata") or {}).get("output") or job.get("dest") or {}
+    inlined = container.get("inlinedResponses") or []
+    if isinstance(inlined, dict):
+        inlined = inlined.get("inlinedResponses") or []
+
+    results = {}
+    for i, item in enumerate(inlined):
+        key = (item.get("metadata") or {}).get("key") or (keys[i] if i < len(keys) else None)
+        if key is None:
+            continue
+        if item.get("error"):
+            results[key] = {"error": item["error"].get("message", str(item["error"]))}
+        else:
+            results[key] = {"response": item.get("response") or {}}
+    return results
+
+
+def run_batch(requests: List[Tuple[str, StreamingJsonBody]], api_key: str, display_name: str = "ads-analysis",
+              cancel_event: Optional[threading.Event] = None,
+              on_results: Optional[Callable[[Dict[str, Dict[str, Any]]], None]] = None) -> Dict[str, Dict[str, Any]]:
+    """
+    Runs requests as Batch API jobs and waits for all of them.
+
+    Args:
+        requests: (key, generateContent body) pairs; keys must be unique
+        api_key: Key that owns the jobs (and every file referenced by the requests)
+        display_name: Job name prefix shown in AI Studio
+        cancel_event: When set, running jobs are cancelled and AnalysisCancelledException is raised
+        on_results: Called with the results of each finished (or failed) job as soon as they are known,
+            so callers can apply and save them before the remaining jobs end or get cancelled
+
+    Returns:
+        Result per request key: {'response': ...} or {'error': ...}. Every key is present.
+    """
+    results: Dict[str, Dict[str, Any]] = {}
+    running: Dict[str, List[str]] = {}  # job name -> request keys
+
+    def finish(job_results: Dict[str, Dict[str, Any]]):
+        results.update(job_results)
+        if on_results is not None:
+            on_results(job_results)
+
+    for i, chunk in enumerate(pack_requests(requests)):
+        keys = [key for key, _ in chunk]
+        try:
+            running[create_batch_job(chunk, api_key, f"{display_name}-{i + 1}")] = keys
+        except Exception as e:
+            logger.error(str(e))
+            finish({key: {"error": str(e)} for key in keys})
+
+    deadline = time.monotonic() + BATCH_TIMEOUT_HOURS * 3600
+    while running:
+        if cancel_event is not None and cancel_event.wait(BATCH_POLL_INTERVAL):
+            for name in running:
+                cancel_batch_job(name, api_key)
+            raise AnalysisCancelledException(f"Batch analysis cancelled ({len(running)} jobs running)")
+        if cancel_event is None:
+            time.sleep(BATCH_POLL_INTERVAL)
+
+        timed_out = time.monotonic() > deadline
+        for name, keys in list(running.items()):
+            try:
+                job = get_batch_job(name, api_key)
+            except Exception as e:
+                logger.warning(str(e))
+                continue
+            state = batch_job_state(job)
+            if state not in _DONE_STATES and not timed_out:
+                continue
+
+            del running[name]
+            if state not in _DONE_STATES:
+                cancel_batch_job(name, api_key)
+                state = "TIMED OUT"
+            logger.info(f"Gemini batch job {name} finished: {state}")
+            responses = batch_job_responses(job, keys) if state == "SUCCEEDED" else {}
+            finish({key: responses.get(key) or {"error": f"Batch job {name} {state.lower()}"} for key in keys})
+    return results
+
+
+# ============================================================
+#  Video files for batch requests
+# ============================================================
+
+def ensure_uploaded(videos: List[Tuple[str, str, str]], api_key: str) -> Dict[str, Any]:
+    """
+    ACTIVE remote files for batch requests, all owned by api_key (the key of the batch job).
+    Reuses registered uploads; new uploads run in parallel and are registered for reuse.
+
+    Args:
+        videos: (content_hash, local path, mime type) tuples
+
+    Returns:
+        content_hash -> GeminiFile, or the Exception that prevented the upload
+    """
+    files: Dict[str, Any] = {}
+    to_upload = []
+    for content_hash, path, mime_type in videos:
+        if content_hash in files:
+            continue
+        hit = gemini_file_registry.lookup(content_hash, api_key)
+        if hit is not None:
+            files[content_hash] = hit[0]
+        else:
+            files[content_hash] = None
+            to_upload.append((content_hash, path, mime_type))
+
+    def upload(item):
+        content_hash, path, mime_type = item
+        gemini_file = file_poller.watch(start_video_upload(path, api_key, mime_type), api_key).result()
+        gemini_file_registry.register(content_hash, api_key, gemini_file, mime_type)
+        return gemini_file
+
+    with ThreadPoolExecutor(max_workers=max(1, VIDEO_UPLOAD_CONCURRENCY), thread_name_prefix="gemini-batch-upload") as pool:
+        futures = {item[0]: pool.submit(upload, item) for item in to_upload}
+        for content_hash, future in futures.items():
+            try:
+                files[content_hash] = future.result()
+            except Exception as e:
+                files[content_hash] = e
+    return files
+
+
+def video_part(gemini_file: GeminiFile) -> Dict[str, Any]:
+    return {"file_data": {"mime_type": "video/mp4", "file_uri": gemini_file.uri}}
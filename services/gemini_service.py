@@ -1,12 +1,21 @@
 import os
+import re
 import sys
+import json
+import base64
+import hashlib
 import logging
 import threading
-import requests
+import time
+from collections import OrderedDict
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from datetime import datetime, timedelta, timezone
 import google.generativeai as genai
 from google.generativeai.types import File
-from typing import Optional, List, Dict, Any, Set
+from typing import Optional, List, Dict, Any, Set, Tuple, Iterator, Union, Callable
 from dotenv import load_dotenv
+from services.http_client import http_get, http_post, http_delete
+from services.media_cache_service import media_cache
 
 # Load environment variables early
 load_dotenv()
@@ -15,27 +24,193 @@ load_dotenv()
 logger = logging.getLogger(__name__)
 
 
+class AnalysisCancelledException(Exception):
+    """Raised when the client cancels a running tool call (cancel_event is set)."""
+    pass
+
+
 # ============================================================
-#  Gemini Key Manager — Round-Robin rotation
+#  Gemini model + per-key rate limits
 # ============================================================
 
+# Model used for every generateContent call (REST and SDK)
+GEMINI_MODEL_NAME = os.getenv("GEMINI_MODEL", "gemini-3.1-flash-lite")
+# REST endpoint root (point it at a local fake server to test uploads / batch jobs offline)
+GEMINI_API_BASE = os.getenv("GEMINI_API_BASE", "https://generativelanguage.googleapis.com").rstrip("/")
+
+# Per-key limits for each model (requests per minute / tokens per minute).
+# Unknown models fall back to DEFAULT_MODEL_LIMITS; GEMINI_RPM_PER_KEY / GEMINI_TPM_PER_KEY override both.
+MODEL_RATE_LIMITS = {
+    "gemini-3.1-flash-lite": {"rpm": 15, "tpm": 250_000},
+    "gemini-2.5-flash-lite": {"rpm": 15, "tpm": 250_000},
+    "gemini-2.5-flash": {"rpm": 10, "tpm": 250_000},
+    "gemini-2.5-pro": {"rpm": 5, "tpm": 250_000},
+}
+DEFAULT_MODEL_LIMITS = {"rpm": 10, "tpm": 250_000}
+
+
+def get_model_limits(model_name: str = GEMINI_MODEL_NAME) -> Dict[str, int]:
+    """Returns {'rpm', 'tpm'} for a model, with env overrides applied."""
+    limits = dict(MODEL_RATE_LIMITS.get(model_name, DEFAULT_MODEL_LIMITS))
+    if os.getenv("GEMINI_RPM_PER_KEY"):
+        limits["rpm"] = int(os.getenv("GEMINI_RPM_PER_KEY"))
+    if os.getenv("GEMINI_TPM_PER_KEY"):
+        limits["tpm"] = int(os.getenv("GEMINI_TPM_PER_KEY"))
+    return limits
+
+
+# How long a caller may block waiting for a key with free budget before giving up
+KEY_WAIT_TIMEOUT = float(os.getenv("GEMINI_KEY_WAIT_TIMEOUT", "90"))
+# Longest single wait while a cancellable caller waits for a key slot
+KEY_WAIT_SLICE = 1.0
+
+# Rough token estimates used to reserve TPM before a request (corrected afterwards from usageMetadata)
+PROMPT_TOKENS_ESTIMATE = 1_000
+IMAGE_TOKENS_ESTIMATE = 600    # image input (~258) + its share of the answer
+VIDEO_TOKENS_ESTIMATE = 12_000  # ~40s of video at ~300 tokens/s
+AUDIO_TOKENS_PER_SECOND = 32
+
+
+def estimate_request_tokens(images: int = 0, videos: int = 0, audio_seconds: float = 0) -> int:
+    """Rough token cost of one generateContent call, used to reserve TPM budget."""
+    return (PROMPT_TOKENS_ESTIMATE + images * IMAGE_TOKENS_ESTIMATE + videos * VIDEO_TOKENS_ESTIMATE
+            + int(audio_seconds * AUDIO_TOKENS_PER_SECOND))
+
+
+class TokenBucket:
+    """
+    Classic token bucket: holds up to `capacity` tokens, refills continuously at
+    capacity per minute. Not thread-safe on its own — GeminiKeyManager guards it.
+    """
+
+    def __init__(self, per_minute: int):
+        self.capacity = float(max(1, per_minute))
+        self.rate = self.capacity / 60.0  # tokens per second
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, amount: float, now: float) -> float:
+        """Seconds until `amount` tokens are available (0 if available now)."""
+        self._refill(now)
+        # A single request bigger than the bucket only needs a full bucket
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def consume(self, amount: float, now: float):
+        self._refill(now)
+        self.tokens -= amount
+
+    def adjust(self, delta: float):
+        """Give back (delta > 0) or charge extra (delta < 0) tokens after the real cost is known."""
+        self.tokens = min(self.capacity, self.tokens + delta)
+
+    def fraction_left(self, now: float) -> float:
+        self._refill(now)
+        return max(0.0, self.tokens) / self.capacity
+
+
+# ============================================================
+#  Gemini Key Manager — budget-aware scheduler with key states
+# ============================================================
+
+# Cooldown after a 429 without a Retry-After hint (doubles on every consecutive 429, capped)
+DEFAULT_COOLDOWN = float(os.getenv("GEMINI_KEY_COOLDOWN", "60"))
+MAX_COOLDOWN = 15 * 60
+
+KEY_HEALTHY = "healthy"
+KEY_COOLING_DOWN = "cooling_down"
+KEY_EXHAUSTED = "exhausted"
+
+
+def next_daily_reset() -> float:
+    """Unix time of the next daily quota reset (Gemini resets daily quotas at midnight Pacific time)."""
+    try:
+        from zoneinfo import ZoneInfo
+        tz = ZoneInfo("America/Los_Angeles")
+    except Exception:  # No tz database (e.g. Windows without tzdata): assume PST
+        tz = timezone(timedelta(hours=-8))
+    now = datetime.now(tz)
+    midnight = (now + timedelta(days=1)).replace(hour=0, minute=0, second=0, microsecond=0)
+    return midnight.timestamp()
+
+
+class KeyState:
+    """Rate-limit buckets, health state and metrics of one API key. Guarded by GeminiKeyManager's lock."""
+
+    def __init__(self, key: str, index: int, limits: Dict[str, int]):
+        self.key = key
+        self.index = index
+        self.rpm = TokenBucket(limits["rpm"])
+        self.tpm = TokenBucket(limits["tpm"])
+        self.cooldown_until = 0.0   # time.monotonic() deadline of a 429 cooldown
+        self.exhausted_until = 0.0  # time.time() of the daily reset (or manual reset_all)
+        self.consecutive_429 = 0
+        # Metrics
+        self.requests = 0
+        self.successes = 0
+        self.rate_limited = 0
+        self.errors = 0
+        self.tokens_used = 0
+        self.last_error: Optional[str] = None
+
+    @property
+    def label(self) -> str:
+        return f"#{self.index + 1} (***{self.key[-6:]})"
+
+    def state(self, now: float) -> str:
+        if self.exhausted_until > time.time():
+            return KEY_EXHAUSTED
+        if self.cooldown_until > now:
+            return KEY_COOLING_DOWN
+        return KEY_HEALTHY
+
+    def budget_left(self, now: float) -> float:
+        """Share of the key's budget still available right now (the tighter of RPM and TPM)."""
+        return min(self.rpm.fraction_left(now), self.tpm.fraction_left(now))
+
+    def wait_time(self, tokens: int, now: float) -> float:
+        """Seconds until this key can take a request of `tokens` (cooldown included)."""
+        return max(
+            self.cooldown_until - now,
+            self.rpm.wait_time(1, now),
+            self.tpm.wait_time(tokens, now),
+            0.0,
+        )
+
+
 class GeminiKeyManager:
     """
-    Manages multiple Gemini API keys with Round-Robin rotation.
+    Manages multiple Gemini API keys and paces requests across them.
     - Loads keys from GEMINI_API_KEYS env var (comma-separated).
     - Falls back to single GEMINI_API_KEY or --gemini-api-key CLI arg.
-    - Rotates to the next key on every call to get_next_key().
-    - Marks keys as dead on quota errors, skips them in rotation.
+    - Every key has its own RPM and TPM token bucket (limits per model, see MODEL_RATE_LIMITS).
+    - acquire_key() hands out the healthy key with the most remaining budget and blocks
+      (up to KEY_WAIT_TIMEOUT, or until the caller's cancel_event is set) instead of failing
+      when every key is momentarily spent.
+    - Each key is healthy, cooling down until T (429, revived automatically using the
+      Retry-After hint) or exhausted for the day (daily quota / invalid key).
+    - All state lives behind one lock; the "last used key" is tracked per thread.
     - Dynamic: works with any number of keys (1, 5, 12, 22...).
     """
 
-    def __init__(self):
+    def __init__(self, model_name: str = GEMINI_MODEL_NAME):
         self._keys: List[str] = []
-        self._dead_keys: Set[int] = set()
         self._current_index: int = -1
-        self._last_used_key: Optional[str] = None
+        self._cond = threading.Condition()
+        self._local = threading.local()
         self._load_keys()
 
+        self.limits = get_model_limits(model_name)
+        self._states = [KeyState(key, i, self.limits) for i, key in enumerate(self._keys)]
+        if self._keys:
+            logger.info(f"Gemini rate limits per key ({model_name}): {self.limits['rpm']} RPM, {self.limits['tpm']} TPM")
+
     def _load_keys(self):
         """Load keys from environment. Priority: GEMINI_API_KEYS > CLI arg > GEMINI_API_KEY."""
         # 1. Try comma-separated list (primary)
@@ -69,64 +244,260 @@ class GeminiKeyManager:
 
     @property
     def alive_keys(self) -> int:
-        return len(self._keys) - len(self._dead_keys)
+        """Keys that are healthy or cooling down (i.e. will be usable again today)."""
+        now = time.monotonic()
+        with self._cond:
+            return sum(1 for s in self._states if s.state(now) != KEY_EXHAUSTED)
 
     @property
     def all_exhausted(self) -> bool:
         return self.alive_keys <= 0
 
+    @property
+    def keys(self) -> List[str]:
+        return list(self._keys)
+
+    def is_alive(self, key: str) -> bool:
+        """False if the key is unknown or exhausted for the day."""
+        state = self._state_for(key)
+        if state is None:
+            return False
+        with self._cond:
+            return state.state(time.monotonic()) != KEY_EXHAUSTED
+
     @property
     def last_used_key(self) -> Optional[str]:
-        return self._last_used_key
+        """Key most recently handed out to the CURRENT thread."""
+        return getattr(self._local, "key", None)
+
+    def _state_for(self, key: Optional[str]) -> Optional[KeyState]:
+        if key is None:
+            key = self.last_used_key
+        if key is None:
+            return None
+        try:
+            return self._states[self._keys.index(key)]
+        except ValueError:
+            return None
+
+    def _usable(self) -> List[KeyState]:
+        # Start after the last handed-out key so equal budgets still rotate round-robin
+        n = self.total_keys
+        start = self._current_index + 1
+        now = time.monotonic()
+        ordered = [self._states[(start + i) % n] for i in range(n)]
+        return [s for s in ordered if s.state(now) != KEY_EXHAUSTED]
+
+    def _hand_out(self, state: KeyState) -> str:
+        self._current_index = state.index
+        self._local.key = state.key
+        return state.key
+
+    def _take(self, state: KeyState, tokens: int, now: float) -> str:
+        state.rpm.consume(1, now)
+        state.tpm.consume(tokens, now)
+        state.requests += 1
+        return self._hand_out(state)
 
     def get_next_key(self) -> Optional[str]:
         """
-        Returns the next alive API key using Round-Robin.
-        Returns None if all keys are exhausted.
+        Returns the healthy key with the most remaining budget (or the one whose cooldown ends
+        first), without reserving anything — use it to pick a key for uploads; request functions
+        reserve via acquire_key/reserve. Returns None if all keys are exhausted.
         """
-        if not self._keys or self.all_exhausted:
-            logger.warning("All Gemini API keys are exhausted!")
-            return None
-
-        for _ in range(self.total_keys):
-            self._current_index = (self._current_index + 1) % self.total_keys
-            if self._current_index not in self._dead_keys:
-                key = self._keys[self._current_index]
-                self._last_used_key = key
-                logger.info(f"Using Gemini key #{self._current_index + 1}/{self.total_keys} (***{key[-6:]})")
-                return key
+        with self._cond:
+            candidates = self._usable() if self._keys else []
+            if not candidates:
+                logger.warning("All Gemini API keys are exhausted!")
+                return None
+
+            now = time.monotonic()
+            healthy = [s for s in candidates if s.state(now) == KEY_HEALTHY]
+            if healthy:
+                state = max(healthy, key=lambda s: s.budget_left(now))
+            else:
+                state = min(candidates, key=lambda s: s.cooldown_until)
+            logger.info(f"Using Gemini key {state.label}/{self.total_keys}")
+            return self._hand_out(state)
+
+    def _wait(self, seconds: float, cancel_event: Optional[threading.Event]):
+        """Waits on the condition in slices of at most KEY_WAIT_SLICE so a cancellation is seen quickly."""
+        if cancel_event is not None and cancel_event.is_set():
+            raise AnalysisCancelledException("Cancelled while waiting for a Gemini key slot")
+        self._cond.wait(min(seconds, KEY_WAIT_SLICE) if cancel_event is not None else seconds)
+
+    def acquire_key(self, tokens: int = PROMPT_TOKENS_ESTIMATE, timeout: Optional[float] = None,
+                    cancel_event: Optional[threading.Event] = None) -> Optional[str]:
+        """
+        Reserves one request + `tokens` on the healthy key with the most remaining budget.
+        Blocks until some key has budget (at most `timeout`, default KEY_WAIT_TIMEOUT);
+        keys cooling down are waited for like any other spent key.
 
-        return None
+        Returns:
+            The API key, or None if all keys are exhausted or the wait timed out.
 
-    def mark_key_dead(self, key: Optional[str] = None):
+        Raises:
+            AnalysisCancelledException: cancel_event was set while waiting
         """
-        Mark a key as exhausted. If no key provided, marks the last used key.
+        deadline = time.monotonic() + (KEY_WAIT_TIMEOUT if timeout is None else timeout)
+        with self._cond:
+            while True:
+                candidates = self._usable() if self._keys else []
+                if not candidates:
+                    logger.warning("All Gemini API keys are exhausted!")
+                    return None
+
+                now = time.monotonic()
+                ready = [s for s in candidates if s.wait_time(tokens, now) == 0]
+                if ready:
+                    state = max(ready, key=lambda s: s.budget_left(now))
+                    key = self._take(state, tokens, now)
+                    logger.info(f"Using Gemini key {state.label}/{self.total_keys}")
+                    return key
+
+                wait = min(s.wait_time(tokens, now) for s in candidates)
+                if now + wait > deadline:
+                    logger.warning(f"No Gemini key has budget within {KEY_WAIT_TIMEOUT:.0f}s")
+                    return None
+                # Woken early by record_usage() refunds or key state changes
+                self._wait(wait, cancel_event)
+
+    def reserve(self, key: str, tokens: int = PROMPT_TOKENS_ESTIMATE, timeout: Optional[float] = None,
+                cancel_event: Optional[threading.Event] = None) -> bool:
         """
-        if key is None:
-            key = self._last_used_key
-        if key is None:
+        Reserves one request + `tokens` on a SPECIFIC key (e.g. the key that uploaded a video file).
+        Blocks until that key has budget (or its cooldown ends).
+        Returns False if the key is exhausted/unknown or the wait timed out.
+        Raises AnalysisCancelledException if cancel_event is set while waiting.
+        """
+        deadline = time.monotonic() + (KEY_WAIT_TIMEOUT if timeout is None else timeout)
+        with self._cond:
+            state = self._state_for(key)
+            if state is None:
+                return False
+            while True:
+                now = time.monotonic()
+                if state.state(now) == KEY_EXHAUSTED:
+                    return False
+                wait = state.wait_time(tokens, now)
+                if wait == 0:
+                    self._take(state, tokens, now)
+                    return True
+                if now + wait > deadline:
+                    logger.warning(f"Gemini key {state.label} has no budget within {KEY_WAIT_TIMEOUT:.0f}s")
+                    return False
+                self._wait(wait, cancel_event)
+
+    def record_usage(self, key: str, reserved_tokens: int, used_tokens: Optional[int]):
+        """
+        Corrects the TPM bucket once the real token count is known (usageMetadata.totalTokenCount).
+        Over-estimates are refunded and wake up waiting callers; under-estimates are charged.
+        """
+        if used_tokens is None:
             return
+        with self._cond:
+            state = self._state_for(key)
+            if state is None:
+                return
+            state.tpm.adjust(reserved_tokens - used_tokens)
+            state.tokens_used += used_tokens
+            if used_tokens < reserved_tokens:
+                self._cond.notify_all()
+
+    def report_success(self, key: str):
+        """A request on this key succeeded: the 429 backoff starts over."""
+        with self._cond:
+            state = self._state_for(key)
+            if state is not None:
+                state.successes += 1
+                state.consecutive_429 = 0
+
+    def report_rate_limited(self, key: Optional[str] = None, retry_after: Optional[float] = None, daily: bool = False):
+        """
+        Handles a 429 for a key (defaults to the current thread's last key).
+        - daily=True: the day's quota is gone, the key is exhausted until the daily reset.
+        - otherwise the key cools down for retry_after seconds (Retry-After / RetryInfo),
+          or an exponential backoff starting at DEFAULT_COOLDOWN, and is revived automatically.
+        """
+        with self._cond:
+            state = self._state_for(key)
+            if state is None:
+                return
+            state.rate_limited += 1
+            if daily:
+                state.exhausted_until = next_daily_reset()
+                logger.warning(f"Gemini key {state.label} hit its DAILY quota, exhausted until reset. Alive: {self.alive_keys}/{self.total_keys}")
+            else:
+                state.consecutive_429 += 1
+                if retry_after is None:
+                    retry_after = DEFAULT_COOLDOWN * 2 ** (state.consecutive_429 - 1)
+                retry_after = min(max(retry_after, 1.0), MAX_COOLDOWN)
+                state.cooldown_until = max(state.cooldown_until, time.monotonic() + retry_after)
+                logger.warning(f"Gemini key {state.label} rate limited, cooling down for {retry_after:.1f}s")
+            self._cond.notify_all()
+
+    def report_error(self, key: Optional[str], message: str):
+        """Counts a non-quota error for the key's metrics."""
+        with self._cond:
+            state = self._state_for(key)
+            if state is not None:
+                state.errors += 1
+                state.last_error = message[:200]
 
-        try:
-            idx = self._keys.index(key)
-            self._dead_keys.add(idx)
-            logger.warning(f"Gemini key #{idx + 1} (***{key[-6:]}) marked DEAD. Alive: {self.alive_keys}/{self.total_keys}")
-        except ValueError:
-            pass
+    def mark_key_dead(self, key: Optional[str] = None):
+        """
+        Mark a key as exhausted for the day (invalid/leaked key, daily quota).
+        If no key provided, marks the key last used by the current thread.
+        """
+        with self._cond:
+            state = self._state_for(key)
+            if state is None:
+                return
+            state.exhausted_until = next_daily_reset()
+            # Waiters may now have nothing left to wait for
+            self._cond.notify_all()
+        logger.warning(f"Gemini key {state.label} marked EXHAUSTED until daily reset. Alive: {self.alive_keys}/{self.total_keys}")
 
     def reset_all(self):
-        """Reset all keys to alive (call at start of each new search session)."""
-        self._dead_keys.clear()
-        self._current_index = -1
-        self._last_used_key = None
+        """Revive all keys (cooldowns and exhaustion cleared); rate-limit buckets are kept."""
+        with self._cond:
+            for state in self._states:
+                state.cooldown_until = 0.0
+                state.exhausted_until = 0.0
+                state.consecutive_429 = 0
+            self._current_index = -1
+            self._cond.notify_all()
         logger.info(f"All {self.total_keys} Gemini keys reset to alive")
 
     def get_status(self) -> dict:
+        with self._cond:
+            now = time.monotonic()
+            keys = []
+            for state in self._states:
+                key_state = state.state(now)
+                keys.append({
+                    "key": f"***{state.key[-6:]}",
+                    "state": key_state,
+                    "cooldown_left": round(max(0.0, state.cooldown_until - now), 1) if key_state == KEY_COOLING_DOWN else 0,
+                    "exhausted_until": datetime.fromtimestamp(state.exhausted_until).isoformat(timespec="seconds") if key_state == KEY_EXHAUSTED else None,
+                    "requests": state.requests,
+                    "successes": state.successes,
+                    "rate_limited": state.rate_limited,
+                    "errors": state.errors,
+                    "tokens_used": state.tokens_used,
+                    "budget_left": round(state.budget_left(now), 2),
+                    "last_error": state.last_error,
+                })
+        counts = {s: sum(1 for k in keys if k["state"] == s) for s in (KEY_HEALTHY, KEY_COOLING_DOWN, KEY_EXHAUSTED)}
         return {
             "total": self.total_keys,
-            "alive": self.alive_keys,
-            "dead": len(self._dead_keys),
-            "all_exhausted": self.all_exhausted,
+            "alive": self.total_keys - counts[KEY_EXHAUSTED],
+            "healthy": counts[KEY_HEALTHY],
+            "cooling_down": counts[KEY_COOLING_DOWN],
+            "dead": counts[KEY_EXHAUSTED],
+            "all_exhausted": counts[KEY_EXHAUSTED] >= self.total_keys,
+            "limits_per_key": self.limits,
+            "keys": keys,
         }
 
 
@@ -136,7 +507,7 @@ key_manager = GeminiKeyManager()
 
 def get_gemini_api_key() -> str:
     """
-    Get next Gemini API key using Round-Robin rotation.
+    Get the Gemini API key with the most remaining budget (no budget is reserved).
     Backward-compatible wrapper around key_manager.
     """
     key = key_manager.get_next_key()
@@ -145,6 +516,96 @@ def get_gemini_api_key() -> str:
     return key
 
 
+def reserve_gemini_key(api_key: Optional[str], tokens: int, cancel_event: Optional[threading.Event] = None) -> str:
+    """
+    Reserves rate-limit budget for one generateContent call.
+    Waits on the given key (files uploaded with a key can only be used with that key),
+    otherwise picks the best key via the scheduler.
+    Raises AnalysisCancelledException if cancel_event is set while waiting (nothing is sent).
+    """
+    if api_key:
+        if not key_manager.reserve(api_key, tokens, cancel_event=cancel_event):
+            raise Exception(f"Timed out waiting for Gemini key slot (***{api_key[-6:]})")
+        return api_key
+
+    key = key_manager.acquire_key(tokens, cancel_event=cancel_event)
+    if key is None:
+        if key_manager.all_exhausted:
+            raise Exception("All Gemini API keys are exhausted")
+        raise Exception("Timed out waiting for a free Gemini key slot")
+    return key
+
+
+def _used_tokens(res_json: Dict[str, Any]) -> Optional[int]:
+    """Total tokens billed for a generateContent response (None if not reported)."""
+    return (res_json.get('usageMetadata') or {}).get('totalTokenCount')
+
+
+def parse_retry_info(response, res_json: Dict[str, Any]) -> Tuple[Optional[float], bool]:
+    """
+    Extracts rate-limit hints from a Gemini 429.
+
+    Returns:
+        (retry_after seconds or None, daily) — daily is True when a per-day quota was hit
+    """
+    retry_after = None
+    daily = False
+    error = res_json.get('error') or {}
+
+    for detail in error.get('details') or []:
+        detail_type = detail.get('@type', '')
+        if detail_type.endswith('RetryInfo') and detail.get('retryDelay'):
+            # Duration in protobuf JSON form, e.g. "37s" or "0.5s"
+            try:
+                retry_after = float(str(detail['retryDelay']).rstrip('s'))
+            except ValueError:
+                pass
+        elif detail_type.endswith('QuotaFailure'):
+            for violation in detail.get('violations') or []:
+                if 'PerDay' in violation.get('quotaId', ''):
+                    daily = True
+
+    if retry_after is None and response.headers.get('Retry-After'):
+        try:
+            retry_after = float(response.headers['Retry-After'])
+        except ValueError:
+            pass
+
+    if 'per day' in error.get('message', '').lower():
+        daily = True
+    return retry_after, daily
+
+
+def report_gemini_response(api_key: str, response, res_json: Dict[str, Any], reserved_tokens: int = 0) -> bool:
+    """
+    Feeds the outcome of a Gemini REST call back into key_manager (usage, success, cooldown, exhaustion).
+
+    Returns:
+        True if the key hit a quota limit (the caller may retry with another key)
+    """
+    key_manager.record_usage(api_key, reserved_tokens, _used_tokens(res_json))
+    if response.status_code == 200:
+        key_manager.report_success(api_key)
+        return False
+
+    error = res_json.get('error') or {}
+    message = str(error.get('message', response.text))
+    lowered = message.lower()
+    if response.status_code == 429 or error.get('status') == 'RESOURCE_EXHAUSTED' or 'quota' in lowered:
+        retry_after, daily = parse_retry_info(response, res_json)
+        key_manager.report_rate_limited(api_key, retry_after=retry_after, daily=daily)
+        return True
+    if 'api key not valid' in lowered or 'leaked' in lowered or (response.status_code in (401, 403) and 'key' in lowered):
+        key_manager.mark_key_dead(api_key)
+    else:
+        key_manager.report_error(api_key, message)
+    return False
+
+
+def _generate_content_url(api_key: str) -> str:
+    return f"{GEMINI_API_BASE}/v1beta/models/{GEMINI_MODEL_NAME}:generateContent?key={api_key}"
+
+
 def configure_gemini() -> genai.GenerativeModel:
     """
     Configure Gemini API with the next rotated API key and return a model.
@@ -153,42 +614,36 @@ def configure_gemini() -> genai.GenerativeModel:
     api_key = get_gemini_api_key()
     genai.configure(api_key=api_key)
 
-    model = genai.GenerativeModel('gemini-3.1-flash-lite')
+    model = genai.GenerativeModel(GEMINI_MODEL_NAME)
 
     logger.info("Gemini API configured successfully")
     return model
 
 
-def upload_video_to_gemini(video_path: str, api_key: Optional[str] = None) -> Any:
+def start_video_upload(video_path: str, api_key: str, mime_type: str = "video/mp4") -> "GeminiFile":
     """
-    Upload a video file to Gemini File API using REST for thread-safety.
-    
+    Resumable upload of a video to the Gemini File API (REST, thread-safe), without waiting
+    for processing. The file is streamed from disk, so memory use doesn't grow with video size.
+
     Args:
         video_path: Path to the video file to upload
-        api_key: Specific API key to use
-        
+        api_key: Key that owns the file (only this key can use it later)
+        mime_type: MIME type of the video
+
     Returns:
-        A mock-like object with .uri and .name to maintain compatibility
+        GeminiFile with the state reported by the upload (usually PROCESSING)
     """
-    if not api_key:
-        api_key = get_gemini_api_key()
-
-    import os
-    import requests
-    import json
-    import time
-    
     file_size = os.path.getsize(video_path)
     file_name_short = os.path.basename(video_path)
 
     # 1. Initial request to get upload URL (Resumable upload)
     # Using v1beta for File API
-    setup_url = f"https://generativelanguage.googleapis.com/upload/v1beta/files?key={api_key}"
+    setup_url = f"{GEMINI_API_BASE}/upload/v1beta/files?key={api_key}"
     headers = {
         "X-Goog-Upload-Protocol": "resumable",
         "X-Goog-Upload-Command": "start",
         "X-Goog-Upload-Header-Content-Length": str(file_size),
-        "X-Goog-Upload-Header-Content-Type": "video/mp4",
+        "X-Goog-Upload-Header-Content-Type": mime_type,
         "Content-Type": "application/json"
     }
     
@@ -196,8 +651,12 @@ def upload_video_to_gemini(video_path: str, api_key: Optional[str] = None) -> An
     payload = {"file": {"display_name": file_name_short}}
     
     try:
-        resp = requests.post(setup_url, headers=headers, json=payload, timeout=30)
+        resp = http_post(setup_url, headers=headers, json=payload, timeout=30)
         if resp.status_code != 200:
+            try:
+                report_gemini_response(api_key, resp, resp.json())
+            except ValueError:
+                pass
             raise Exception(f"Failed to start upload: {resp.text}")
             
         upload_url = resp.headers.get("X-Goog-Upload-URL")
@@ -211,49 +670,55 @@ def upload_video_to_gemini(video_path: str, api_key: Optional[str] = None) -> An
                 "X-Goog-Upload-Offset": "0",
                 "X-Goog-Upload-Command": "upload, finalize"
             }
-            resp = requests.post(upload_url, headers=headers, data=f, timeout=300)
+            resp = http_post(upload_url, headers=headers, data=f, timeout=300)
             
         if resp.status_code != 200:
             raise Exception(f"Upload failed: {resp.text}")
             
         file_info = resp.json().get("file", {})
         file_name = file_info.get("name") # This is the full resource name like "files/abc"
-        file_uri = file_info.get("uri")
-        
         if not file_name:
             raise Exception("Upload succeeded but no file name returned")
+        return GeminiFile(file_name, file_info.get("uri"), file_info.get("state"),
+                          parse_expiration_time(file_info.get("expirationTime")))
 
-        # 3. Wait for processing (REST version of processing loop)
-        status_url = f"https://generativelanguage.googleapis.com/v1beta/{file_name}?key={api_key}"
-        
-        while True:
-            status_resp = requests.get(status_url, timeout=20)
-            if status_resp.status_code != 200:
-                raise Exception(f"Status check failed: {status_resp.text}")
-                
-            status_info = status_resp.json()
-            state = status_info.get("state")
-            
-            if state == "ACTIVE":
-                logger.info(f"Video {file_name} is ACTIVE")
-                # Create a compatibility object
-                class GeminiFile:
-                    def __init__(self, name, uri):
-                        self.name = name
-                        self.uri = uri
-                return GeminiFile(file_name, file_uri)
-            
-            if state == "FAILED":
-                raise Exception(f"Video processing failed: {status_info.get('error', 'Unknown Error')}")
-                
-            time.sleep(3)
-            
     except Exception as e:
         logger.error(f"REST Video upload failed: {str(e)}")
         raise
 
 
-def analyze_video_with_gemini(model: genai.GenerativeModel, video_file: File, prompt: str, api_key: Optional[str] = None) -> str:
+def upload_video_to_gemini(video_path: str, api_key: Optional[str] = None, cancel_event: Optional[threading.Event] = None,
+                           mime_type: str = "video/mp4") -> "GeminiFile":
+    """
+    Upload a video file to Gemini File API and wait until it is ACTIVE.
+    Readiness is checked by the shared file_poller, not by a sleep loop per upload.
+    
+    Args:
+        video_path: Path to the video file to upload
+        api_key: Specific API key to use
+        cancel_event: Optional event; when set, waiting stops and AnalysisCancelledException is raised
+        mime_type: MIME type of the video
+        
+    Returns:
+        GeminiFile with .uri and .name (compatible with genai File for our REST calls)
+    """
+    if not api_key:
+        api_key = get_gemini_api_key()
+
+    gemini_file = start_video_upload(video_path, api_key, mime_type)
+    active = file_poller.watch(gemini_file, api_key, cancel_event)
+    if cancel_event is not None:
+        # Wakes up immediately on cancellation instead of waiting for the next poll round
+        while not active.done():
+            if cancel_event.wait(0.5):
+                active.cancel()  # The poller deletes the remote file
+                logger.info(f"Upload of {gemini_file.name} cancelled while waiting for ACTIVE state")
+                raise AnalysisCancelledException(f"Video upload cancelled: {os.path.basename(video_path)}")
+    return active.result()
+
+
+def analyze_video_with_gemini(model: genai.GenerativeModel, video_file: File, prompt: str, api_key: Optional[str] = None,
+                              cancel_event: Optional[threading.Event] = None) -> str:
     """
     Analyze a video using direct REST API call for thread-safety.
     
@@ -262,11 +727,12 @@ def analyze_video_with_gemini(model: genai.GenerativeModel, video_file: File, pr
         video_file: Uploaded video file object
         prompt: Analysis prompt
         api_key: The SPECIFIC key that uploaded the file
+        cancel_event: Stops the wait for a key slot (AnalysisCancelledException)
     """
-    if not api_key:
-        api_key = get_gemini_api_key()
+    reserved_tokens = estimate_request_tokens(videos=1)
+    api_key = reserve_gemini_key(api_key, reserved_tokens, cancel_event)
 
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-3.1-flash-lite:generateContent?key={api_key}"
+    url = _generate_content_url(api_key)
     headers = {"Content-Type": "application/json"}
     
     payload = {
@@ -278,12 +744,14 @@ def analyze_video_with_gemini(model: genai.GenerativeModel, video_file: File, pr
                     "file_uri": video_file.uri
                 }}
             ]
-        }]
+        }],
+        "generationConfig": json_output_config(VIDEO_ANALYSIS_SCHEMA)
     }
 
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=60)
+        response = http_post(url, headers=headers, json=payload, timeout=60)
         res_json = response.json()
+        report_gemini_response(api_key, response, res_json, reserved_tokens)
         
         if response.status_code != 200:
             error_details = res_json.get('error', {}).get('message', response.text)
@@ -333,13 +801,13 @@ def analyze_image_with_gemini(model: genai.GenerativeModel, image_bytes: bytes,
     """
     Analyze an image using direct REST API call for thread-safety.
     """
-    if not api_key:
-        api_key = get_gemini_api_key()
+    reserved_tokens = estimate_request_tokens(images=1)
+    api_key = reserve_gemini_key(api_key, reserved_tokens)
 
     import base64
     image_b64 = base64.b64encode(image_bytes).decode('utf-8')
 
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-3.1-flash-lite:generateContent?key={api_key}"
+    url = _generate_content_url(api_key)
     headers = {"Content-Type": "application/json"}
     
     payload = {
@@ -355,8 +823,9 @@ def analyze_image_with_gemini(model: genai.GenerativeModel, image_bytes: bytes,
     }
 
     try:
-        response = requests.post(url, headers=headers, json=payload, timeout=40)
+        response = http_post(url, headers=headers, json=payload, timeout=40)
         res_json = response.json()
+        report_gemini_response(api_key, response, res_json, reserved_tokens)
         
         if response.status_code != 200:
             raise Exception(f"Gemini Image API Error {response.status_code}: {res_json.get('error', {}).get('message')}")
@@ -549,76 +1018,1092 @@ def cleanup_gemini_file(file_name: str):
         logger.warning(f"Failed to cleanup Gemini file {file_name}: {str(e)}")
 
 
-def analyze_images_batch_with_gemini(image_data_list: List[Dict[str, Any]], primary_text: str = "", api_key: Optional[str] = None) -> Optional[str]:
+# ============================================================
+#  Video uploads: background ACTIVE polling + completion queue
+# ============================================================
+#
+# An uploaded video is PROCESSING for 10-60s before it can be used. Instead of every upload
+# holding its thread in a sleep loop, one poller thread checks all pending files per round,
+# and VideoAnalysisQueue starts the analysis request as soon as a file turns ACTIVE.
+
+# Seconds between poll rounds over all pending files
+FILE_POLL_INTERVAL = float(os.getenv("GEMINI_FILE_POLL_INTERVAL", "3"))
+# Give up on a file that isn't ACTIVE after this many seconds
+FILE_ACTIVE_TIMEOUT = float(os.getenv("GEMINI_FILE_ACTIVE_TIMEOUT", "600"))
+# Threads sending video bytes / running analysis requests for VideoAnalysisQueue
+VIDEO_UPLOAD_CONCURRENCY = int(os.getenv("GEMINI_VIDEO_UPLOAD_CONCURRENCY", "8"))
+VIDEO_ANALYZE_CONCURRENCY = int(os.getenv("GEMINI_VIDEO_ANALYZE_CONCURRENCY", "8"))
+# Consecutive failed status checks before a file is given up
+FILE_STATUS_MAX_ERRORS = 3
+# Uploaded files are kept by Gemini for 48h; a reused file must have this much life left
+FILE_RETENTION_SECONDS = 48 * 3600
+FILE_REUSE_MIN_TTL = float(os.getenv("GEMINI_FILE_REUSE_MIN_TTL", "1800"))
+# Registered files nobody used for this long are deleted by the sweeper (frees File API storage)
+FILE_IDLE_SECONDS = float(os.getenv("GEMINI_FILE_IDLE_HOURS", "12")) * 3600
+FILE_SWEEP_INTERVAL = float(os.getenv("GEMINI_FILE_SWEEP_INTERVAL", "900"))
+
+
+class GeminiFile:
+    """Uploaded file: .name ("files/abc") and .uri, like genai's File for our REST calls."""
+
+    def __init__(self, name: str, uri: str, state: Optional[str] = None, expires_at: Optional[float] = None):
+        self.name = name
+        self.uri = uri
+        self.state = state
+        self.expires_at = expires_at  # unix time, from the API's expirationTime
+
+
+def parse_expiration_time(value: Optional[str]) -> Optional[float]:
+    """RFC 3339 expirationTime of the File API ("2024-05-01T12:00:00.123456789Z") as unix time."""
+    if not value:
+        return None
+    try:
+        # Fractions of a second can have 9 digits; they don't matter here
+        return datetime.fromisoformat(value.split(".")[0].rstrip("Z")).replace(tzinfo=timezone.utc).timestamp()
+    except ValueError:
+        return None
+
+
+def delete_gemini_file(file_name: str, api_key: str):
+    """Deletes an uploaded file with the key that owns it (REST, thread-safe)."""
+    try:
+        resp = http_delete(f"{GEMINI_API_BASE}/v1beta/{file_name}?key={api_key}", timeout=20)
+        if resp.status_code not in (200, 404):
+            logger.warning(f"Failed to delete Gemini file {file_name}: {resp.status_code} {resp.text[:200]}")
+    except Exception as e:
+        logger.warning(f"Failed to delete Gemini file {file_name}: {e}")
+
+
+def resolve_future(future: Future, result: Any = None, exc: Optional[BaseException] = None):
+    """Completes a future unless it was cancelled (or completed) in the meantime."""
+    try:
+        if exc is not None:
+            future.set_exception(exc)
+        else:
+            future.set_result(result)
+    except InvalidStateError:
+        pass
+
+
+class _PendingFile:
+    __slots__ = ("file", "api_key", "future", "cancel_event", "deadline", "errors")
+
+    def __init__(self, gemini_file: GeminiFile, api_key: str, future: Future,
+                 cancel_event: Optional[threading.Event], timeout: float):
+        self.file = gemini_file
+        self.api_key = api_key
+        self.future = future
+        self.cancel_event = cancel_event
+        self.deadline = time.monotonic() + timeout
+        self.errors = 0
+
+
+class GeminiFilePoller:
     """
-    Batch image analysis using REST API (Thread-safe).
+    Waits for uploaded files to become ACTIVE on a single background thread.
+
+    watch() returns a Future that resolves with the GeminiFile once it is ACTIVE, or fails
+    (FAILED state, timeout, repeated status errors, AnalysisCancelledException when its
+    cancel_event is set). Cancelling the future stops polling and deletes the remote file.
+    The thread starts on demand and exits when nothing is pending.
     """
-    if not image_data_list:
+
+    def __init__(self, interval: float = FILE_POLL_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._pending: Dict[str, _PendingFile] = {}
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._pending)
+
+    def watch(self, gemini_file: GeminiFile, api_key: str, cancel_event: Optional[threading.Event] = None,
+              timeout: float = FILE_ACTIVE_TIMEOUT) -> Future:
+        future = Future()
+        if gemini_file.state == "ACTIVE":
+            future.set_result(gemini_file)
+            return future
+        with self._lock:
+            self._pending[gemini_file.name] = _PendingFile(gemini_file, api_key, future, cancel_event, timeout)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="gemini-file-poller", daemon=True)
+                self._thread.start()
+        return future
+
+    def _run(self):
+        while True:
+            started = time.monotonic()
+            with self._lock:
+                pending = list(self._pending.values())
+                if not pending:
+                    self._thread = None
+                    return
+            for item in pending:
+                self._check(item)
+            time.sleep(max(0.0, self.interval - (time.monotonic() - started)))
+
+    def _forget(self, item: _PendingFile, delete: bool = False):
+        with self._lock:
+            self._pending.pop(item.file.name, None)
+        if delete:
+            delete_gemini_file(item.file.name, item.api_key)
+
+    def _check(self, item: _PendingFile):
+        name = item.file.name
+        if item.future.cancelled():
+            self._forget(item, delete=True)
+            return
+        if item.cancel_event is not None and item.cancel_event.is_set():
+            logger.info(f"Upload of {name} cancelled while waiting for ACTIVE state")
+            self._forget(item, delete=True)
+            resolve_future(item.future, exc=AnalysisCancelledException(f"Video upload cancelled: {name}"))
+            return
+
+        try:
+            status_resp = http_get(f"{GEMINI_API_BASE}/v1beta/{name}?key={item.api_key}", timeout=20)
+            if status_resp.status_code != 200:
+                raise Exception(f"Status check failed: {status_resp.text}")
+            status_info = status_resp.json()
+        except Exception as e:
+            item.errors += 1
+            if item.errors >= FILE_STATUS_MAX_ERRORS:
+                self._forget(item, delete=True)
+                resolve_future(item.future, exc=e)
+            return
+        item.errors = 0
+
+        state = status_info.get("state")
+        if state == "ACTIVE":
+            logger.info(f"Video {name} is ACTIVE")
+            item.file.state = state
+            item.file.uri = status_info.get("uri") or item.file.uri
+            item.file.expires_at = parse_expiration_time(status_info.get("expirationTime")) or item.file.expires_at
+            self._forget(item)
+            resolve_future(item.future, item.file)
+        elif state == "FAILED":
+            self._forget(item, delete=True)
+            resolve_future(item.future, exc=Exception(f"Video processing failed: {status_info.get('error', 'Unknown Error')}"))
+        elif time.monotonic() > item.deadline:
+            self._forget(item, delete=True)
+            resolve_future(item.future, exc=Exception(f"Video {name} not ACTIVE after {FILE_ACTIVE_TIMEOUT:.0f}s"))
+
+
+class GeminiFileRegistry:
+    """
+    Uploaded videos by (content hash, key), stored in the media cache DB (gemini_files).
+
+    Re-analysing the same bytes (retries, re-runs, prompt changes) reuses a still-valid
+    remote file instead of uploading it again. A background sweeper deletes files nobody
+    used for FILE_IDLE_SECONDS and forgets the ones Gemini has expired, in bulk.
+    """
+
+    def __init__(self):
+        self._sweeper: Optional[threading.Thread] = None
+        self._sweeper_lock = threading.Lock()
+
+    @staticmethod
+    def key_id(api_key: str) -> str:
+        """Fingerprint of a key (the DB never holds the key itself)."""
+        return hashlib.sha256(api_key.encode()).hexdigest()[:16]
+
+    def _keys_by_id(self) -> Dict[str, str]:
+        return {self.key_id(key): key for key in key_manager.keys}
+
+    def lookup(self, content_hash: str, api_key: Optional[str] = None) -> Optional[Tuple[GeminiFile, str]]:
+        """
+        A reusable remote copy of the content: (file, key that owns it), or None.
+        With api_key only that key's copy counts; otherwise any copy on a key that isn't exhausted.
+        """
+        self._ensure_sweeper()
+        keys = self._keys_by_id()
+        for row in media_cache.get_gemini_files(content_hash, time.time() + FILE_REUSE_MIN_TTL):
+            key = keys.get(row['key_id'])
+            if key is None or (api_key and key != api_key) or not key_manager.is_alive(key):
+                continue
+            media_cache.touch_gemini_file(row['file_name'])
+            return GeminiFile(row['file_name'], row['file_uri'], "ACTIVE", row['expires_at']), key
         return None
 
-    if not api_key:
-        api_key = get_gemini_api_key()
+    def register(self, content_hash: str, api_key: str, gemini_file: GeminiFile, mime_type: Optional[str] = None):
+        self._ensure_sweeper()
+        expires_at = gemini_file.expires_at or time.time() + FILE_RETENTION_SECONDS
+        media_cache.store_gemini_file(content_hash, self.key_id(api_key), gemini_file.name, gemini_file.uri,
+                                      mime_type, expires_at)
+
+    def forget(self, file_name: str):
+        media_cache.forget_gemini_files([file_name])
+
+    def sweep(self) -> Dict[str, int]:
+        """Deletes idle remote files and drops registry rows of expired / deleted ones."""
+        now = time.time()
+        rows = media_cache.gemini_files_to_sweep(now + FILE_REUSE_MIN_TTL, now - FILE_IDLE_SECONDS)
+        keys = self._keys_by_id()
+        deleted = 0
+        for row in rows:
+            # Expired files are already gone; files of keys no longer configured can't be deleted
+            key = keys.get(row['key_id'])
+            if row['expires_at'] > now and key is not None:
+                delete_gemini_file(row['file_name'], key)
+                deleted += 1
+        media_cache.forget_gemini_files([row['file_name'] for row in rows])
+        if rows:
+            logger.info(f"Gemini file sweep: deleted {deleted}, forgot {len(rows)} registry entries")
+        return {"deleted": deleted, "forgotten": len(rows)}
+
+    def _ensure_sweeper(self):
+        with self._sweeper_lock:
+            if self._sweeper is None:
+                self._sweeper = threading.Thread(target=self._sweep_loop, name="gemini-file-sweeper", daemon=True)
+                self._sweeper.start()
+
+    def _sweep_loop(self):
+        while True:
+            try:
+                self.sweep()
+            except Exception as e:
+                logger.warning(f"Gemini file sweep failed: {e}")
+            time.sleep(FILE_SWEEP_INTERVAL)
 
-    import base64
-    url = f"https://generativelanguage.googleapis.com/v1beta/models/gemini-3.1-flash-lite:generateContent?key={api_key}"
+
+class _VideoJob:
+    __slots__ = ("result", "video_path", "prompt", "api_key", "mime_type", "cancel_event", "content_hash")
+
+    def __init__(self, result: Future, video_path: str, prompt: str, api_key: Optional[str], mime_type: str,
+                 cancel_event: Optional[threading.Event], content_hash: Optional[str]):
+        self.result = result
+        self.video_path = video_path
+        self.prompt = prompt
+        self.api_key = api_key
+        self.mime_type = mime_type
+        self.cancel_event = cancel_event
+        self.content_hash = content_hash
+
+
+class VideoAnalysisQueue:
+    """
+    Upload → wait for ACTIVE → analyze, without a thread per video.
+
+    Uploads run on a small pool, readiness is tracked by the file poller, and each file's
+    analysis request is queued on the analysis pool the moment it turns ACTIVE. A caller can
+    keep dozens of videos in flight and collect the Futures (raw analysis text) as they complete.
+    Videos with a content_hash are looked up in the file registry first and kept on Gemini for
+    later analyses; others are deleted right after their analysis.
+    """
+
+    def __init__(self, poller: GeminiFilePoller, registry: GeminiFileRegistry,
+                 upload_workers: int = VIDEO_UPLOAD_CONCURRENCY, analyze_workers: int = VIDEO_ANALYZE_CONCURRENCY):
+        self._poller = poller
+        self._registry = registry
+        self._uploads = ThreadPoolExecutor(max_workers=max(1, upload_workers), thread_name_prefix="gemini-upload")
+        self._analyses = ThreadPoolExecutor(max_workers=max(1, analyze_workers), thread_name_prefix="gemini-video")
+
+    def submit(self, video_path: str, prompt: str, api_key: Optional[str] = None, mime_type: str = "video/mp4",
+               cancel_event: Optional[threading.Event] = None, content_hash: Optional[str] = None) -> Future:
+        """
+        Args:
+            video_path: Local video file
+            prompt: Analysis prompt
+            api_key: Key for upload AND analysis (an uploaded file is only visible to its own key)
+            mime_type: MIME type of the video
+            cancel_event: When set, the job stops at its next step (remote file is deleted)
+            content_hash: Content hash of the video; enables remote file reuse
+
+        Returns:
+            Future with the raw analysis text; cancelling it also stops the job
+        """
+        job = _VideoJob(Future(), video_path, prompt, api_key, mime_type, cancel_event, content_hash)
+        if content_hash:
+            hit = self._registry.lookup(content_hash, api_key)
+            if hit is not None:
+                gemini_file, key = hit
+                logger.info(f"Reusing uploaded video {gemini_file.name} for {os.path.basename(video_path)}")
+                self._analyses.submit(self._analyze, job, gemini_file, key, True)
+                return job.result
+        self._uploads.submit(self._upload, job)
+        return job.result
+
+    def _upload(self, job: _VideoJob):
+        if job.result.cancelled():
+            return
+        if job.cancel_event is not None and job.cancel_event.is_set():
+            resolve_future(job.result, exc=AnalysisCancelledException(f"Video upload cancelled: {os.path.basename(job.video_path)}"))
+            return
+        try:
+            api_key = job.api_key or get_gemini_api_key()
+            gemini_file = start_video_upload(job.video_path, api_key, job.mime_type)
+        except Exception as e:
+            resolve_future(job.result, exc=e)
+            return
+
+        active = self._poller.watch(gemini_file, api_key, job.cancel_event)
+        job.result.add_done_callback(lambda f: active.cancel() if f.cancelled() else None)
+        active.add_done_callback(lambda f: self._on_active(f, job, api_key))
+
+    def _on_active(self, active: Future, job: _VideoJob, api_key: str):
+        if active.cancelled():
+            return
+        if active.exception() is not None:
+            resolve_future(job.result, exc=active.exception())
+            return
+        gemini_file = active.result()
+        if job.content_hash:
+            try:
+                self._registry.register(job.content_hash, api_key, gemini_file, job.mime_type)
+            except Exception as e:
+                logger.warning(f"Failed to register Gemini file {gemini_file.name}: {e}")
+        self._analyses.submit(self._analyze, job, gemini_file, api_key, False)
+
+    def _analyze(self, job: _VideoJob, gemini_file: GeminiFile, api_key: str, reused: bool):
+        try:
+            if not job.result.cancelled():
+                resolve_future(job.result, analyze_video_with_gemini(None, gemini_file, job.prompt, api_key=api_key,
+                                                                     cancel_event=job.cancel_event))
+        except Exception as e:
+            if reused and any(f"Error {code}" in str(e) for code in (400, 403, 404)):
+                # Remote copy is gone or unusable: forget it and upload again
+                logger.info(f"Reused Gemini file {gemini_file.name} failed ({e}), uploading again")
+                self._registry.forget(gemini_file.name)
+                self._uploads.submit(self._upload, job)
+                return
+            resolve_future(job.result, exc=e)
+        finally:
+            if not job.content_hash and not reused:
+                delete_gemini_file(gemini_file.name, api_key)
+
+
+# Module-level singletons
+file_poller = GeminiFilePoller()
+gemini_file_registry = GeminiFileRegistry()
+video_analysis_queue = VideoAnalysisQueue(file_poller, gemini_file_registry)
+
+
+# ============================================================
+#  Streamed JSON bodies for inline media
+# ============================================================
+#
+# A batch request used to hold every image three times (raw bytes, base64 str, json.dumps
+# output) plus the encoded body. Now the body is a file-like object that base64-encodes
+# the (memory-mapped) image bytes chunk by chunk while requests sends it, and creatives
+# that repeat across ad groups keep their encoded form in a small LRU.
+
+# Raw bytes encoded per step (multiple of 3, so chunk encodings concatenate without padding)
+B64_CHUNK_SIZE = 3 * 16 * 1024
+# Memory budget for pre-encoded images (0 disables the LRU)
+B64_CACHE_MB = float(os.getenv("GEMINI_B64_CACHE_MB", "64"))
+# Images bigger than this share of the budget are always streamed
+B64_CACHE_MAX_ITEM_SHARE = 0.1
+
+
+class EncodedImageCache:
+    """
+    LRU of base64-encoded images keyed by content hash, bounded by total bytes.
+    An image is only encoded for keeps the second time it is seen, so one-off
+    creatives are streamed and never occupy the cache.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._items: "OrderedDict[str, bytes]" = OrderedDict()
+        self._seen: "OrderedDict[str, None]" = OrderedDict()
+        self._size = 0
+        self.hits = 0
+
+    def get(self, content_hash: str) -> Optional[bytes]:
+        with self._lock:
+            encoded = self._items.get(content_hash)
+            if encoded is not None:
+                self._items.move_to_end(content_hash)
+                self.hits += 1
+            return encoded
+
+    def should_keep(self, content_hash: str, raw_size: int) -> bool:
+        """Records a sighting; True if this image repeats and fits the cache."""
+        encoded_size = 4 * ((raw_size + 2) // 3)
+        if not self.max_bytes or encoded_size > self.max_bytes * B64_CACHE_MAX_ITEM_SHARE:
+            return False
+        with self._lock:
+            if content_hash in self._seen:
+                return True
+            self._seen[content_hash] = None
+            if len(self._seen) > 10000:
+                self._seen.popitem(last=False)
+            return False
+
+    def put(self, content_hash: str, encoded: bytes):
+        with self._lock:
+            if content_hash in self._items:
+                return
+            self._items[content_hash] = encoded
+            self._size += len(encoded)
+            while self._size > self.max_bytes and self._items:
+                _, dropped = self._items.popitem(last=False)
+                self._size -= len(dropped)
+
+
+encoded_image_cache = EncodedImageCache(int(B64_CACHE_MB * 1024 * 1024))
+
+
+class _Base64Segment:
+    """Base64 of a bytes-like object (bytes, mmap, memoryview), produced chunk by chunk."""
+
+    def __init__(self, data):
+        self.view = memoryview(data)
+        self.length = 4 * ((len(self.view) + 2) // 3)
+
+    def __len__(self) -> int:
+        return self.length
+
+    def chunks(self) -> Iterator[bytes]:
+        for start in range(0, len(self.view), B64_CHUNK_SIZE):
+            yield base64.b64encode(self.view[start:start + B64_CHUNK_SIZE])
+
+
+class StreamingJsonBody:
+    """
+    File-like request body built from byte segments and _Base64Segments.
+    requests sends it with a Content-Length (from __len__) by calling read() in blocks;
+    seek()/tell() let urllib3 rewind it for a retry.
+    """
+
+    def __init__(self, segments: List[Union[bytes, _Base64Segment]]):
+        self._segments = segments
+        self._length = sum(len(s) for s in segments)
+        self.seek(0)
+
+    def __len__(self) -> int:
+        return self._length
+
+    @property
+    def segments(self) -> List[Union[bytes, _Base64Segment]]:
+        """The body's segments, e.g. to embed it in a larger streamed body."""
+        return self._segments
+
+    def _iter_chunks(self) -> Iterator[bytes]:
+        for segment in self._segments:
+            if isinstance(segment, _Base64Segment):
+                yield from segment.chunks()
+            else:
+                yield segment
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = 0) -> int:
+        if whence == 2:
+            offset += self._length
+        elif whence == 1:
+            offset += self._pos
+        self._chunks = self._iter_chunks()
+        self._buffer = b""
+        self._offset = 0
+        self._pos = 0
+        if offset:
+            self.read(offset)
+        return self._pos
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            size = self._length - self._pos
+        out = []
+        while size > 0:
+            if self._offset >= len(self._buffer):
+                chunk = next(self._chunks, None)
+                if chunk is None:
+                    break
+                self._buffer, self._offset = chunk, 0
+            piece = self._buffer[self._offset:self._offset + size]
+            self._offset += len(piece)
+            size -= len(piece)
+            out.append(piece)
+        data = b"".join(out)
+        self._pos += len(data)
+        return data
+
+
+def _inline_image_segments(img_data: Dict[str, Any]) -> List[Union[bytes, _Base64Segment]]:
+    """JSON of one inline_data part; the base64 payload comes from the LRU or is streamed."""
+    head = b'{"inline_data":{"mime_type":' + json.dumps(img_data['mime_type']).encode() + b',"data":"'
+    tail = b'"}}'
+    # payload_key identifies the bytes actually sent (e.g. a downscaled variant of the content)
+    content_hash = img_data.get('payload_key') or img_data.get('content_hash')
+    raw = img_data['bytes']
+
+    if content_hash:
+        encoded = encoded_image_cache.get(content_hash)
+        if encoded is None and encoded_image_cache.should_keep(content_hash, len(raw)):
+            encoded = base64.b64encode(raw)
+            encoded_image_cache.put(content_hash, encoded)
+        if encoded is not None:
+            return [head, encoded, tail]
+    return [head, _Base64Segment(raw), tail]
+
+
+def build_generate_content_body(parts: List[Dict[str, Any]], images: List[Dict[str, Any]] = (),
+                                generation_config: Optional[Dict[str, Any]] = None) -> StreamingJsonBody:
+    """
+    generateContent body: the text parts, then "IMAGE n:" + inline_data for each image.
+
+    Args:
+        parts: Leading text parts ({"text": ...})
+        images: Dicts with 'bytes' (any bytes-like, e.g. an mmap), 'mime_type' and optional
+                'content_hash' / 'payload_key' (LRU key of the encoded bytes) and 'label'
+                (text part sent before it instead of "IMAGE n:", e.g. for video keyframes / audio)
+        generation_config: generationConfig of the request (e.g. json_output_config(schema))
+    """
+    pieces: List[List[Union[bytes, _Base64Segment]]] = [[json.dumps(part, ensure_ascii=False).encode()] for part in parts]
+    for i, img_data in enumerate(images):
+        label = img_data.get('label') or f"IMAGE {i+1}:"
+        pieces.append([json.dumps({"text": label}, ensure_ascii=False).encode()])
+        pieces.append(_inline_image_segments(img_data))
+
+    segments: List[Union[bytes, _Base64Segment]] = [b'{"contents":[{"parts":[']
+    for i, piece in enumerate(pieces):
+        if i:
+            segments.append(b",")
+        segments.extend(piece)
+    segments.append(b"]}]")
+    if generation_config:
+        segments.append(b',"generationConfig":' + json.dumps(generation_config, ensure_ascii=False).encode())
+    segments.append(b"}")
+    return StreamingJsonBody(segments)
+
+
+def _send_generate_content(body: StreamingJsonBody, reserved_tokens: int, api_key: Optional[str] = None,
+                           cancel_event: Optional[threading.Event] = None) -> Tuple[Optional[Dict[str, Any]], Optional[str]]:
+    """
+    POSTs a streamed generateContent body. Inline data isn't tied to a key, so on quota
+    errors the request moves on to the next key (the scheduler picks it), at most once per key.
+    Raises AnalysisCancelledException if cancel_event is set while waiting for a key slot.
+
+    Returns:
+        (response JSON, None) on HTTP 200, else (None, error message)
+    """
     headers = {"Content-Type": "application/json"}
+    err_msg = "No Gemini keys"
+    for _ in range(max(1, key_manager.total_keys)):
+        api_key = reserve_gemini_key(api_key, reserved_tokens, cancel_event)
+        body.seek(0)
+        response = http_post(_generate_content_url(api_key), headers=headers, data=body, timeout=120)
+        res_json = response.json()
+        quota_hit = report_gemini_response(api_key, response, res_json, reserved_tokens)
 
-    prompt = f"""
-ПРОАНАЛИЗИРУЙ ЭТИ {len(image_data_list)} КАРТИНКИ ИЗ ОДНОГО ОБЪЯВЛЕНИЯ В ФЕЙСБУКЕ.
-Они могут быть частью одной Карусели или Динамического креатива.
+        if response.status_code == 200:
+            return res_json, None
+        err_msg = res_json.get('error', {}).get('message', 'Unknown Error')
+        if not quota_hit:
+            break
+        api_key = None  # Key is cooling down / exhausted, retry with the next one
+    return None, err_msg
+
+
+def analyze_video_frames_with_gemini(frames: List[Dict[str, Any]], audio: Optional[Dict[str, Any]], prompt: str,
+                                     duration: Optional[float] = None, api_key: Optional[str] = None,
+                                     cancel_event: Optional[threading.Event] = None) -> str:
+    """
+    Video analysis from keyframes + audio track sent inline (no Files API upload / polling).
+
+    Args:
+        frames: Keyframe dicts ('bytes', 'mime_type', 'label') in playback order
+        audio: Audio track dict in the same shape, or None for silent videos
+        prompt: Analysis prompt
+        duration: Video length in seconds (for the token reservation)
+        api_key: Preferred key (any key works, nothing is uploaded)
+        cancel_event: Stops the wait for a key slot (AnalysisCancelledException)
+    """
+    media = list(frames) + ([audio] if audio else [])
+    body = build_generate_content_body([{"text": prompt}], media, json_output_config(VIDEO_ANALYSIS_SCHEMA))
+    reserved_tokens = estimate_request_tokens(images=len(frames), audio_seconds=(duration or 0) if audio else 0)
+
+    try:
+        res_json, err_msg = _send_generate_content(body, reserved_tokens, api_key, cancel_event)
+        if err_msg:
+            raise Exception(f"Gemini API Error: {err_msg}")
+
+        candidates = res_json.get('candidates', [])
+        if not candidates:
+            return "Analysis blocked by Google Safety Filters (Video frames)"
+
+        parts = (candidates[0].get('content') or {}).get('parts') or [{}]
+        text = (parts[0].get('text') or '').strip()
+        if not text:
+            finish_reason = candidates[0].get('finishReason')
+            if finish_reason == 'SAFETY':
+                return "Analysis blocked by Gemini SAFETY filters (Video frames)"
+            return "Error: Gemini returned empty text (Possibly blocked)"
+
+        return text
+
+    except Exception as e:
+        logger.error(f"REST Video frames analysis failed: {str(e)}")
+        raise
+
+
+# ============================================================
+#  Structured (JSON) output
+# ============================================================
+#
+# Image and video analyses are requested with a response schema, so cards, ads and video
+# fields come back as JSON and are read in one pass instead of regex-searching free text
+# per card. raw_analysis keeps the familiar numbered text, rendered from the fields.
+
+# (field, label in raw_analysis) in answer order
+IMAGE_CARD_FIELDS = (("offer", "ОФФЕР"), ("content", "СОДЕРЖАНИЕ"))
+VIDEO_ANALYSIS_FIELDS = (("offer", "ОФФЕР"), ("scenes", "СЦЕНЫ"), ("format", "ФОРМАТ"), ("hook", "ХУК"),
+                         ("voiceover", "ОЗВУЧКА"), ("people", "ЛЮДИ"), ("cta", "ПРИЗЫВ К ДЕЙСТВИЮ"))
+
+_CARD_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"card": {"type": "INTEGER"}, "offer": {"type": "STRING"}, "content": {"type": "STRING"}},
+    "required": ["card", "offer"],
+    "propertyOrdering": ["card", "offer", "content"],
+}
+IMAGE_CARDS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"cards": {"type": "ARRAY", "items": _CARD_SCHEMA}},
+    "required": ["cards"],
+}
+MULTI_AD_CARDS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {"ads": {"type": "ARRAY", "items": {
+        "type": "OBJECT",
+        "properties": {"ad": {"type": "INTEGER"}, "ad_id": {"type": "STRING"},
+                       "cards": {"type": "ARRAY", "items": _CARD_SCHEMA}},
+        "required": ["ad", "cards"],
+        "propertyOrdering": ["ad", "ad_id", "cards"],
+    }}},
+    "required": ["ads"],
+}
+VIDEO_ANALYSIS_SCHEMA = {
+    "type": "OBJECT",
+    "properties": {key: {"type": "STRING"} for key, _ in VIDEO_ANALYSIS_FIELDS},
+    "required": ["offer"],
+    "propertyOrdering": [key for key, _ in VIDEO_ANALYSIS_FIELDS],
+}
+
+
+def json_output_config(schema: Dict[str, Any]) -> Dict[str, Any]:
+    """generationConfig asking for a JSON answer in the given schema."""
+    return {"responseMimeType": "application/json", "responseSchema": schema}
+
+
+def parse_json_answer(text: Optional[str]) -> Any:
+    """JSON of a structured answer, or None (plain text, truncated or blocked answer)."""
+    if not text:
+        return None
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.strip("`").strip()
+        if text.lower().startswith("json"):
+            text = text[4:]
+    try:
+        return json.loads(text)
+    except ValueError:
+        return None
 
-ТВОЯ ЗАДАЧА:
-1. Описать каждую картинку отдельно.
-2. Для каждой картинки начни блок со строки "CARD X:" (где X - номер картинки).
 
+def card_fields(data: Any, num_cards: int) -> Optional[List[Optional[Dict[str, Any]]]]:
+    """
+    Fields per card of a {"cards": [...]} answer in card order (None for missing cards),
+    or None if data isn't such an answer. Cards are matched by their "card" number, else by position.
+    """
+    if not isinstance(data, dict) or not isinstance(data.get('cards'), list):
+        return None
+    result: List[Optional[Dict[str, Any]]] = [None] * num_cards
+    for pos, card in enumerate(c for c in data['cards'] if isinstance(c, dict)):
+        number = card.get('card')
+        idx = number - 1 if isinstance(number, int) and 1 <= number <= num_cards and result[number - 1] is None else pos
+        if idx < num_cards and result[idx] is None:
+            result[idx] = card
+    return result
+
+
+def structured_analysis(fields: Dict[str, Any], labels: Tuple[Tuple[str, str], ...]) -> Dict[str, Any]:
+    """Analysis dict: the fields plus raw_analysis rendered as "1. ОФФЕР: ..." lines (empty fields skipped)."""
+    analysis = {key: str(fields.get(key) or '').strip() for key, _ in labels}
+    analysis['raw_analysis'] = "\n".join(f"{i}. {label}: {analysis[key]}"
+                                         for i, (key, label) in enumerate(labels, 1) if analysis[key])
+    return analysis
+
+
+# Part of the analysis cache key: bump when the card rules / structure below change
+# (the single-ad and multi-ad prompts share them, so their per-card answers are interchangeable)
+BATCH_PROMPT_VERSION = "batch-v2-json"
+
+_CARD_RULES_PROMPT = """
 ПРАВИЛА: 
-1. ОФФЕР это БАДы, препараты, лекарства: мази, гели, капли, капсулы, таблетки, спреи, чаи, порошки для здоровья. ВСЁ ОСТАЛЬНОЕ - ЭТО "white". ВАЖНО: Если ОФФЕР="white", полностью пропусти пункт 2 для этой карточки.
+1. ОФФЕР это БАДы, препараты, лекарства: мази, гели, капли, капсулы, таблетки, спреи, чаи, порошки для здоровья. ВСЁ ОСТАЛЬНОЕ - ЭТО "white". ВАЖНО: Если offer="white", оставь content пустым для этой карточки.
 1.1 Запомни что "white" - это когда креатив продает онлайн-курсы, приложения, услуги врача и клиник, устройства, одежду, животных, растения, еду.
 
-СТРУКТУРА ДЛЯ КАЖДОЙ КАРТОЧКИ:
-CARD X:
-1. ОФФЕР: [Конкретное название бренда, препарата и форма (например, 'Prostovit капсулы'). Если бренд не читается, но это явно медицина — 'неизвестный [препарат/форма]'. Если это белая заглушка/гном/овощ/животное/одежда и не является БАДом, лекарством, препаратом — ОБЯЗАТЕЛЬНО укажи 'white'].
-2. СОДЕРЖАНИЕ: [Максимально детально: ВЕСЬ ТЕКСТ на картинке, все персонажи, их позы, действия, одежда, все визуальные элементы и предметы].
+ПОЛЯ ДЛЯ КАЖДОЙ КАРТОЧКИ:
+- card: номер картинки (X из подписи "IMAGE X:").
+- offer: [Конкретное название бренда, препарата и форма (например, 'Prostovit капсулы'). Если бренд не читается, но это явно медицина — 'неизвестный [препарат/форма]'. Если это белая заглушка/гном/овощ/животное/одежда и не является БАДом, лекарством, препаратом — ОБЯЗАТЕЛЬНО укажи 'white'].
+- content: [Максимально детально: ВЕСЬ ТЕКСТ на картинке, все персонажи, их позы, действия, одежда, все визуальные элементы и предметы].
 """
+
+
+def build_image_batch_body(image_data_list: List[Dict[str, Any]], primary_text: str = "") -> StreamingJsonBody:
+    """generateContent body of the per-card JSON analysis of one ad's images (interactive and Batch API)."""
+    prompt = f"""
+ПРОАНАЛИЗИРУЙ ЭТИ {len(image_data_list)} КАРТИНКИ ИЗ ОДНОГО ОБЪЯВЛЕНИЯ В ФЕЙСБУКЕ.
+Они могут быть частью одной Карусели или Динамического креатива.
+
+ТВОЯ ЗАДАЧА:
+1. Описать каждую картинку отдельно.
+2. Ответ - JSON: в массиве "cards" по объекту на каждую картинку, по порядку.
+""" + _CARD_RULES_PROMPT
     
     parts = [{"text": prompt}]
     if primary_text:
         parts.append({"text": f"AD TEXT FOR CONTEXT: {primary_text}"})
 
-    for i, img_data in enumerate(image_data_list):
-        parts.append({"text": f"IMAGE {i+1}:"})
-        parts.append({
-            "inline_data": {
-                "mime_type": img_data['mime_type'],
-                "data": base64.b64encode(img_data['bytes']).decode('utf-8')
-            }
-        })
+    # Streamed body: images are base64-encoded while sending (or taken from the LRU)
+    return build_generate_content_body(parts, image_data_list, json_output_config(IMAGE_CARDS_SCHEMA))
 
-    payload = {"contents": [{"parts": parts}]}
 
-    try:
-        response = requests.post(url, headers=headers, json=payload, timeout=120)
-        res_json = response.json()
+def generate_content_text(res_json: Dict[str, Any]) -> str:
+    """Answer text of a generateContent response (or the reason it is missing)."""
+    candidates = res_json.get('candidates', [])
+    if not candidates:
+        return "Analysis blocked by Google Safety Filters (Batch - Empty Candidates)"
         
-        if response.status_code != 200:
-            err_msg = res_json.get('error', {}).get('message', 'Unknown Error')
-            if "429" in str(response.status_code) or "quota" in err_msg.lower():
-                key_manager.mark_key_dead(api_key)
-                return analyze_images_batch_with_gemini(image_data_list, primary_text) # Retry with next key
+    parts = (candidates[0].get('content') or {}).get('parts') or [{}]
+    text = (parts[0].get('text') or '').strip()
+    if not text:
+         # Fallback: check if the first candidate has a block reason
+         finish_reason = candidates[0].get('finishReason')
+         if finish_reason:
+              return f"Analysis blocked by Gemini Safety filters (Batch - {finish_reason})"
+         return "Error: Empty response from Gemini (Batch)"
+         
+    return text
+
+
+def analyze_images_batch_with_gemini(image_data_list: List[Dict[str, Any]], primary_text: str = "", api_key: Optional[str] = None,
+                                     cancel_event: Optional[threading.Event] = None) -> Optional[str]:
+    """
+    Batch image analysis using REST API (Thread-safe).
+    Returns the answer text: {"cards": [...]} JSON (parse with card_fields), or an error text.
+    Raises AnalysisCancelledException if cancel_event is set while waiting for a key slot.
+    """
+    if not image_data_list:
+        return None
+
+    body = build_image_batch_body(image_data_list, primary_text)
+    reserved_tokens = estimate_request_tokens(images=len(image_data_list))
+
+    try:
+        res_json, err_msg = _send_generate_content(body, reserved_tokens, api_key, cancel_event)
+        if err_msg:
             return f"Error: {err_msg}"
 
-        candidates = res_json.get('candidates', [])
-        if not candidates:
-            return "Analysis blocked by Google Safety Filters (Batch - Empty Candidates)"
-            
-        text = candidates[0].get('content', {}).get('parts', [{}])[0].get('text', '').strip()
-        if not text:
-             # Fallback: check if the first candidate has a block reason
-             finish_reason = candidates[0].get('finishReason')
-             if finish_reason:
-                  return f"Analysis blocked by Gemini Safety filters (Batch - {finish_reason})"
-             return "Error: Empty response from Gemini (Batch)"
-             
-        return text
+        return generate_content_text(res_json)
+    except AnalysisCancelledException:
+        raise
     except Exception as e:
         return f"Error: {str(e)}"
+
+
+# ============================================================
+#  Multi-ad image packing (several small ad groups per request)
+# ============================================================
+#
+# Most ad groups have one or two cards, so a request per group runs into per-key RPM long
+# before TPM. Groups analyzed at the same time share one request instead: every ad gets its
+# own entry in the answer's "ads" array, which is split back per ad.
+# The number of ads per request adapts to how reliably the answers split: it grows after
+# every clean packed answer and halves when the smoothed parse failure rate gets too high.
+
+# Ceiling of ads per packed request (1 disables packing)
+PACK_MAX_ADS = int(os.getenv("GEMINI_PACK_MAX_ADS", "6"))
+# Image / token budget of one packed request
+PACK_MAX_IMAGES = int(os.getenv("GEMINI_PACK_MAX_IMAGES", "16"))
+PACK_MAX_TOKENS = int(os.getenv("GEMINI_PACK_MAX_TOKENS", "12000"))
+# How long a group waits for others to join its request (only while other groups are being analyzed)
+PACK_LINGER_SECONDS = float(os.getenv("GEMINI_PACK_LINGER_MS", "300")) / 1000
+# Packing backs off while the smoothed share of ads missing from packed answers is above this
+PACK_FAILURE_TARGET = float(os.getenv("GEMINI_PACK_FAILURE_TARGET", "0.1"))
+PACK_START_ADS = 2
+PACK_INCREASE = 0.5
+PACK_FAILURE_ALPHA = 0.2
+# Once backed off to single-ad requests, a pack of two is tried again after this many of them
+PACK_PROBE_EVERY = 20
+
+
+def build_multi_ad_batch_body(sections: List[Tuple[str, List[Dict[str, Any]], str]]) -> StreamingJsonBody:
+    """
+    generateContent body analyzing the cards of several ads in one request.
+
+    Args:
+        sections: (ad_id, images, ad text) per ad. The answer's "ads" array holds one entry per ad
+                  ("ad" = position in sections, from 1) with its "cards" numbered from 1
+    """
+    total = sum(len(images) for _, images, _ in sections)
+    prompt = f"""
+ПРОАНАЛИЗИРУЙ {total} КАРТИНОК ИЗ {len(sections)} РАЗНЫХ ОБЪЯВЛЕНИЙ В ФЕЙСБУКЕ.
+Картинки каждого объявления подписаны "AD N / IMAGE X:", у каждого объявления свой текст для контекста.
+Картинки одного объявления могут быть частью одной Карусели или Динамического креатива.
+
+ТВОЯ ЗАДАЧА:
+1. Ответ - JSON: в массиве "ads" по объекту на каждое объявление по порядку (не пропускай ни одно):
+   "ad" - номер N из подписей, "ad_id" - ID объявления, "cards" - его картинки.
+2. Внутри объявления опиши каждую картинку отдельно; "card" - номер X из подписи "AD N / IMAGE X:".
+3. Не смешивай картинки разных объявлений.
+""" + _CARD_RULES_PROMPT
+
+    labeled = []
+    for n, (ad_id, images, ad_text) in enumerate(sections, 1):
+        header = f"=== AD {n} | ID {ad_id} ==="
+        if ad_text:
+            header += f"\nAD TEXT FOR CONTEXT: {ad_text}"
+        for x, img_data in enumerate(images, 1):
+            label = f"AD {n} / IMAGE {x}:"
+            labeled.append({**img_data, 'label': f"{header}\n{label}" if x == 1 else label})
+    return build_generate_content_body([{"text": prompt}], labeled, json_output_config(MULTI_AD_CARDS_SCHEMA))
+
+
+def split_ad_sections(text: str, ad_ids: List[str]) -> List[Optional[str]]:
+    """
+    Per-ad parts of a packed answer, in pack order; ads missing from the answer get None.
+
+    A JSON answer is split by ad_id (else the "ad" number, else position) into {"cards": [...]}
+    JSON per ad. A plain-text answer is split at its "AD N" header lines.
+    """
+    data = parse_json_answer(text)
+    if isinstance(data, dict) and isinstance(data.get('ads'), list):
+        positions = {ad_id: i for i, ad_id in reversed(list(enumerate(ad_ids)))}
+        sections: List[Optional[str]] = [None] * len(ad_ids)
+        for pos, entry in enumerate(e for e in data['ads'] if isinstance(e, dict)):
+            number = entry.get('ad')
+            idx = positions.get(str(entry.get('ad_id') or '').strip())
+            if idx is None or sections[idx] is not None:
+                idx = number - 1 if isinstance(number, int) and 1 <= number <= len(ad_ids) else pos
+            if idx < len(ad_ids) and sections[idx] is None and isinstance(entry.get('cards'), list):
+                sections[idx] = json.dumps({"cards": entry['cards']}, ensure_ascii=False)
+        return sections
+
+    headers = [re.search(rf"^[ \t#*=_>\-]*AD\s*{n}(?!\d)[^\n]*$", text, re.MULTILINE | re.IGNORECASE)
+               for n in range(1, len(ad_ids) + 1)]
+    starts = sorted(match.start() for match in headers if match)
+    sections = []
+    for match in headers:
+        if match is None:
+            sections.append(None)
+            continue
+        end = next((start for start in starts if start > match.start()), len(text))
+        sections.append(text[match.end():end].strip() or None)
+    return sections
+
+
+def _section_complete(section: Optional[str], num_cards: int) -> bool:
+    if not section:
+        return False
+    cards = card_fields(parse_json_answer(section), num_cards)
+    if cards is not None:
+        return all(card is not None for card in cards)
+    return all(re.search(rf"CARD\s*\**{i}(?!\d)", section, re.IGNORECASE) for i in range(1, num_cards + 1))
+
+
+class _PackItem:
+    __slots__ = ("ad_id", "images", "ad_text", "on_request", "cancel_event", "future")
+
+    def __init__(self, ad_id: str, images: List[Dict[str, Any]], ad_text: str,
+                 on_request: Optional[Callable[[], None]] = None, cancel_event: Optional[threading.Event] = None):
+        self.ad_id = ad_id
+        self.images = images
+        self.ad_text = ad_text
+        self.on_request = on_request
+        self.cancel_event = cancel_event
+        self.future = Future()
+
+
+def _notify_request(items: List[_PackItem]):
+    """Calls each distinct on_request callback of the items once (one request, however many ads of a run it carries)."""
+    callbacks = []
+    for item in items:
+        if item.on_request is not None and item.on_request not in callbacks:
+            callbacks.append(item.on_request)
+    for callback in callbacks:
+        try:
+            callback()
+        except Exception as e:
+            logger.warning(f"on_request callback failed: {e}")
+
+
+class ImageBatchPacker:
+    """
+    Packs the image analyses of concurrently analyzed ad groups into shared Gemini requests.
+
+    There is no dispatcher thread: a caller whose group is still pending when its linger window
+    ends (or that fills the pack) sends the pending groups itself, the others wait for their
+    Future. Ads missing from a packed answer are sent again on their own, and count as parse
+    failures for the pack size (additive increase / multiplicative decrease).
+    """
+
+    def __init__(self, max_ads: int = PACK_MAX_ADS, max_images: int = PACK_MAX_IMAGES,
+                 max_tokens: int = PACK_MAX_TOKENS, linger: float = PACK_LINGER_SECONDS):
+        self.max_ads = max(1, max_ads)
+        self.max_images = max_images
+        self.max_tokens = max_tokens
+        self.linger = linger
+        self._lock = threading.Lock()
+        self._pending: List[_PackItem] = []
+        self._active = 0
+        self._limit = float(min(PACK_START_ADS, self.max_ads))
+        self._failure_rate = 0.0
+        self._solo_since_pack = 0
+
+    @property
+    def limit(self) -> float:
+        """Current (adaptive) number of ads per packed request."""
+        return self._limit
+
+    def analyze(self, ad_id: str, images: List[Dict[str, Any]], ad_text: str = "",
+                cancel_event: Optional[threading.Event] = None,
+                on_request: Optional[Callable[[], None]] = None) -> Optional[str]:
+        """
+        Analysis of one ad's images, like analyze_images_batch_with_gemini (per-card JSON),
+        possibly answered as part of a request shared with other ads.
+
+        Args:
+            on_request: Called once per Gemini request sent for this ad (a packed request calls
+                        each distinct callback once, e.g. PipelineProgress.gemini_request)
+
+        Raises:
+            AnalysisCancelledException: cancel_event was set while the ad was waiting for a pack
+        """
+        if not images:
+            return None
+        item = _PackItem(ad_id, images, ad_text, on_request, cancel_event)
+        if self.max_ads <= 1 or len(images) >= self.max_images:
+            _notify_request([item])
+            return analyze_images_batch_with_gemini(images, ad_text, cancel_event=cancel_event)
+
+        with self._lock:
+            self._active += 1
+            self._pending.append(item)
+            # Nobody else is being analyzed right now: don't hold the group back
+            deadline = time.monotonic() + (0 if self._active == 1 or self._is_full_locked() else self.linger)
+        try:
+            while True:
+                with self._lock:
+                    waiting = item in self._pending
+                    pack = self._take_locked() if waiting and time.monotonic() >= deadline else None
+                if pack:
+                    self._send(pack)
+                    continue
+                try:
+                    return item.future.result(timeout=max(0.01, deadline - time.monotonic()) if waiting else 1.0)
+                except FutureTimeoutError:
+                    pass
+                if cancel_event is not None and cancel_event.is_set():
+                    with self._lock:
+                        if item in self._pending:
+                            self._pending.remove(item)
+                    raise AnalysisCancelledException(f"Image analysis cancelled for ad {ad_id}")
+        finally:
+            with self._lock:
+                self._active -= 1
+
+    def _pack_size_locked(self) -> int:
+        if self._limit < 2 and self._solo_since_pack >= PACK_PROBE_EVERY:
+            return 2
+        return int(self._limit)
+
+    def _is_full_locked(self) -> bool:
+        return (len(self._pending) >= self._pack_size_locked()
+                or sum(len(item.images) for item in self._pending) >= self.max_images)
+
+    def _take_locked(self) -> List[_PackItem]:
+        """Oldest pending ads that fit the pack size and the image / token budget."""
+        size = self._pack_size_locked()
+        pack, images = [], 0
+        for item in self._pending:
+            more = images + len(item.images)
+            if pack and (len(pack) >= size or more > self.max_images
+                         or estimate_request_tokens(images=more) > self.max_tokens):
+                break
+            pack.append(item)
+            images = more
+        del self._pending[:len(pack)]
+        self._solo_since_pack = self._solo_since_pack + 1 if len(pack) == 1 else 0
+        return pack
+
+    def _send(self, pack: List[_PackItem]):
+        try:
+            self._send_pack(pack)
+        except Exception as e:
+            # A malformed packed answer must never leave callers waiting on their futures
+            print(f"DEBUG: Packed Gemini request failed ({e}), sending unanswered ads alone", file=sys.stderr)
+            for item in pack:
+                if not item.future.done():
+                    self._send_alone(item)
+
+    def _send_pack(self, pack: List[_PackItem]):
+        if len(pack) == 1:
+            self._send_alone(pack[0])
+            return
+
+        images = sum(len(item.images) for item in pack)
+        print(f"DEBUG: [Thread {threading.get_ident()}] Packing {len(pack)} ads ({images} images) into one "
+              f"Gemini request (limit {self._limit:.1f})", file=sys.stderr)
+        _notify_request(pack)
+        try:
+            body = build_multi_ad_batch_body([(item.ad_id, item.images, item.ad_text) for item in pack])
+            # The key wait is only cancellable when every ad in the pack belongs to the same cancelled run
+            events = {id(item.cancel_event): item.cancel_event for item in pack}
+            cancel_event = next(iter(events.values())) if len(events) == 1 else None
+            res_json, err_msg = _send_generate_content(body, estimate_request_tokens(images=images),
+                                                       cancel_event=cancel_event)
+        except AnalysisCancelledException as e:
+            for item in pack:
+                resolve_future(item.future, exc=e)
+            return
+        except Exception as e:
+            res_json, err_msg = None, str(e)
+        if err_msg:
+            for item in pack:
+                resolve_future(item.future, f"Error: {err_msg}")
+            return
+
+        text = generate_content_text(res_json)
+        if not res_json.get('candidates') or text.startswith(("Analysis blocked", "Error:")):
+            # One blocked creative must not cost the other ads their analysis
+            for item in pack:
+                self._send_alone(item)
+            return
+
+        failed = []
+        for item, section in zip(pack, split_ad_sections(text, [item.ad_id for item in pack])):
+            if _section_complete(section, len(item.images)):
+                resolve_future(item.future, section)
+            else:
+                failed.append(item)
+        self._record(len(pack), len(failed))
+        if failed:
+            print(f"DEBUG: {len(failed)}/{len(pack)} ads missing from packed answer, sending them alone", file=sys.stderr)
+        for item in failed:
+            self._send_alone(item)
+
+    def _send_alone(self, item: _PackItem):
+        _notify_request([item])
+        try:
+            resolve_future(item.future, analyze_images_batch_with_gemini(item.images, item.ad_text,
+                                                                         cancel_event=item.cancel_event))
+        except Exception as e:
+            resolve_future(item.future, exc=e)
+
+    def _record(self, ads: int, failed: int):
+        with self._lock:
+            self._failure_rate += PACK_FAILURE_ALPHA * (failed / ads - self._failure_rate)
+            if failed and self._failure_rate > PACK_FAILURE_TARGET:
+                self._limit = max(1.0, self._limit / 2)
+                logger.info(f"Image packing backed off to {self._limit:.1f} ads per request "
+                            f"(parse failure rate {self._failure_rate:.0%})")
+            elif not failed:
+                self._limit = min(float(self.max_ads), max(2.0, self._limit + PACK_INCREASE))
+
+
+# Module-level singleton
+image_batch_packer = ImageBatchPacker()
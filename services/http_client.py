@@ -0,0 +1,105 @@
+import os
+import logging
+import threading
+from typing import Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from dotenv import load_dotenv
+
+# Load environment variables early (pool sizes / retry policy can be tuned in .env)
+load_dotenv()
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+# ============================================================
+#  Shared HTTP session — pooled keep-alive connections
+# ============================================================
+#
+# All outbound calls (ScrapeCreators, Gemini REST, fbcdn media downloads) go through
+# one requests.Session so TCP+TLS connections are reused across threads instead of
+# doing a new handshake for every image and every Gemini call.
+
+# Per-host connection pool sizes (max simultaneous keep-alive connections per host)
+HOST_POOL_SIZES = {
+    "https://generativelanguage.googleapis.com": int(os.getenv("HTTP_POOL_SIZE_GEMINI", "32")),
+    "https://api.scrapecreators.com": int(os.getenv("HTTP_POOL_SIZE_SCRAPECREATORS", "10")),
+}
+
+# Everything else (mostly scontent-*.fbcdn.net media hosts)
+DEFAULT_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE_DEFAULT", "50"))
+# How many distinct hosts keep a pool around (fbcdn spreads media over many hostnames)
+DEFAULT_POOL_HOSTS = 32
+
+# Retry policy: connection errors are retried for every method (the request was never sent),
+# 5xx responses only for idempotent methods (GET/HEAD/DELETE...). 429 is NOT retried here —
+# ScrapeCreators raises RateLimitException and Gemini rotates keys on it.
+RETRY_TOTAL = int(os.getenv("HTTP_RETRY_TOTAL", "3"))
+RETRY_BACKOFF_FACTOR = float(os.getenv("HTTP_RETRY_BACKOFF", "0.5"))
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+
+_session: Optional[requests.Session] = None
+_session_lock = threading.Lock()
+
+
+def _build_retry() -> Retry:
+    return Retry(
+        total=RETRY_TOTAL,
+        connect=RETRY_TOTAL,
+        read=RETRY_TOTAL,
+        status=RETRY_TOTAL,
+        backoff_factor=RETRY_BACKOFF_FACTOR,
+        status_forcelist=RETRY_STATUS_CODES,
+        raise_on_status=False,  # Callers inspect status_code themselves
+        respect_retry_after_header=True,
+    )
+
+
+def _build_session() -> requests.Session:
+    session = requests.Session()
+
+    default_adapter = HTTPAdapter(
+        pool_connections=DEFAULT_POOL_HOSTS,
+        pool_maxsize=DEFAULT_POOL_SIZE,
+        max_retries=_build_retry(),
+    )
+    session.mount("https://", default_adapter)
+    session.mount("http://", default_adapter)
+
+    # Longest prefix wins in requests, so per-host adapters override the default one
+    for prefix, pool_size in HOST_POOL_SIZES.items():
+        session.mount(prefix, HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=pool_size,
+            max_retries=_build_retry(),
+        ))
+
+    logger.info(f"HTTP session initialized (default pool {DEFAULT_POOL_SIZE}, per-host: {HOST_POOL_SIZES})")
+    return session
+
+
+def get_session() -> requests.Session:
+    """Returns the process-wide pooled session (created lazily, thread-safe)."""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                _session = _build_session()
+    return _session
+
+
+def http_get(url: str, **kwargs) -> requests.Response:
+    """requests.get() replacement that reuses pooled connections."""
+    return get_session().get(url, **kwargs)
+
+
+def http_post(url: str, **kwargs) -> requests.Response:
+    """requests.post() replacement that reuses pooled connections."""
+    return get_session().post(url, **kwargs)
+
+
+def http_delete(url: str, **kwargs) -> requests.Response:
+    """requests.delete() replacement that reuses pooled connections."""
+    return get_session().delete(url, **kwargs)
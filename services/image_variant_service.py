@@ -0,0 +1,79 @@
+import io
+import os
+import logging
+from typing import Optional, Tuple
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+# Pillow does the resize / re-encode (optional: without it images are sent as downloaded)
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except Exception:
+    PIL_AVAILABLE = False
+
+# Downscale + re-encode images before they go to Gemini (set 0 to send originals)
+IMAGE_PREPROCESS = os.getenv("GEMINI_IMAGE_PREPROCESS", "1") != "0"
+# Longest side in pixels. Gemini bills large images per 768px tile, and ad text stays
+# readable well below the 1080-2048px creatives usually come in
+IMAGE_MAX_DIMENSION = int(os.getenv("GEMINI_IMAGE_MAX_DIM", "1536"))
+# 'jpeg' or 'webp'
+IMAGE_FORMAT = os.getenv("GEMINI_IMAGE_FORMAT", "jpeg").lower()
+IMAGE_QUALITY = int(os.getenv("GEMINI_IMAGE_QUALITY", "85"))
+# A variant is only used if it is at least this much smaller than the original
+MIN_SAVING_RATIO = 0.1
+
+_FORMATS = {
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+
+
+def preprocessing_enabled() -> bool:
+    return IMAGE_PREPROCESS and PIL_AVAILABLE
+
+
+def variant_key() -> str:
+    """Identifies the current settings; cached variants are looked up by it."""
+    return f"{IMAGE_FORMAT}-q{IMAGE_QUALITY}-max{IMAGE_MAX_DIMENSION}"
+
+
+def make_variant(image_bytes) -> Optional[Tuple[bytes, str]]:
+    """
+    Downscaled, re-encoded copy of an image for Gemini.
+
+    Args:
+        image_bytes: Original image (any bytes-like, e.g. an mmap)
+
+    Returns:
+        (variant bytes, MIME type), or None if Pillow is missing, the image can't be
+        decoded, or the variant wouldn't be at least MIN_SAVING_RATIO smaller
+    """
+    if not PIL_AVAILABLE:
+        return None
+    pil_format, mime_type = _FORMATS.get(IMAGE_FORMAT, _FORMATS["jpeg"])
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            img.seek(0)  # First frame of animated GIF/WebP
+            img.thumbnail((IMAGE_MAX_DIMENSION, IMAGE_MAX_DIMENSION), Image.LANCZOS)
+            if img.mode in ("RGBA", "LA", "P"):
+                img = img.convert("RGBA")
+                if pil_format == "JPEG":
+                    # JPEG has no alpha: flatten onto white like the ad would be shown
+                    background = Image.new("RGB", img.size, (255, 255, 255))
+                    background.paste(img, mask=img.getchannel("A"))
+                    img = background
+            elif img.mode != "RGB":
+                img = img.convert("RGB")
+
+            out = io.BytesIO()
+            img.save(out, pil_format, quality=IMAGE_QUALITY, optimize=True)
+    except Exception as e:
+        logger.warning(f"Image preprocessing failed: {e}")
+        return None
+
+    data = out.getvalue()
+    if len(data) > len(image_bytes) * (1 - MIN_SAVING_RATIO):
+        return None
+    return data, mime_type
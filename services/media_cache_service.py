@@ -3,10 +3,20 @@ import hashlib
 import os
 import json
 import time
+import atexit
+import mmap
+import tempfile
+import threading
 from pathlib import Path
-from typing import Dict, Any, Optional, List
+from typing import Dict, Any, Optional, List, Iterable, Callable
+from urllib.parse import urlsplit, parse_qsl, urlencode
 import logging
 
+from services.perceptual_hash_service import (
+    PerceptualIndex, PIL_AVAILABLE, FFMPEG_AVAILABLE,
+    image_dhash, video_keyframe_hashes, encode_hashes, decode_hashes,
+)
+
 logger = logging.getLogger(__name__)
 
 # Cache configuration
@@ -14,26 +24,178 @@ CACHE_DIR = Path.home() / ".cache" / "facebook-ads-mcp"
 CACHE_DB_PATH = CACHE_DIR / "media_cache.db"
 CACHE_IMAGES_DIR = CACHE_DIR / "images"
 CACHE_VIDEOS_DIR = CACHE_DIR / "videos"
-MAX_CACHE_SIZE_GB = 10  # Maximum cache size in GB (increased for videos)
+CACHE_VARIANTS_DIR = CACHE_DIR / "variants"  # Derived files (e.g. downscaled images for Gemini)
+MAX_CACHE_SIZE_GB = float(os.getenv("MEDIA_CACHE_MAX_GB", "10"))  # Maximum cache size in GB (increased for videos)
 MAX_CACHE_AGE_DAYS = 30  # Auto-cleanup media older than this
 
+# Separate budgets so a burst of videos can't push every cached image out (and vice versa)
+MEDIA_TYPE_BUDGETS_GB = {
+    'image': float(os.getenv("MEDIA_CACHE_IMAGES_GB", "2")),
+    'video': float(os.getenv("MEDIA_CACHE_VIDEOS_GB", "8")),
+}
+# Eviction frees space down to this share of the budget, so it doesn't run on every insert
+EVICTION_TARGET_RATIO = 0.9
+# Rows fetched per eviction step (oldest last_accessed first)
+EVICTION_BATCH_SIZE = 200
+
+# Cache hits record last_accessed in memory; pending times are written in one executemany
+# every ACCESS_FLUSH_INTERVAL seconds or as soon as ACCESS_FLUSH_COUNT hits are pending
+ACCESS_FLUSH_INTERVAL = 5.0
+ACCESS_FLUSH_COUNT = 500
+
+# Schema version stored in PRAGMA user_version (see _migrate)
+SCHEMA_VERSION = 4
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# SQLite tuning for the per-thread connections
+SQLITE_BUSY_TIMEOUT_MS = 5000
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+SQLITE_CACHED_STATEMENTS = 256  # Prepared statements kept per connection
+# fsync cache files before they are renamed into place (crash-safe; set 0 to trade safety for speed)
+FSYNC_WRITES = os.getenv("MEDIA_CACHE_FSYNC", "1") != "0"
+# Check every blob (size, unverified checksums, orphan/temp files) in the background on startup
+FSCK_ON_START = os.getenv("MEDIA_CACHE_FSCK_ON_START", "1") != "0"
+# Files younger than this are never treated as orphans / stale temp files (a write may be in flight)
+FSCK_MIN_FILE_AGE = 3600
+
+# Streamed downloads (videos) are cut off above this size
+MAX_VIDEO_FILE_MB = float(os.getenv("MEDIA_CACHE_MAX_VIDEO_MB", "300"))
+# Chunk size for streamed downloads (memory per in-flight download stays at this)
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+
+# URL hashes per query in get_cached_media_batch (SQLite's bound-parameter limit can be 999)
+BATCH_LOOKUP_CHUNK = 500
+
+_GB = 1024 ** 3
+
+_UPSERT_URL_SQL = """
+    INSERT OR REPLACE INTO media_cache (
+        url_hash, original_url, file_path, file_size, content_type, media_type,
+        brand_name, ad_id, analysis_results, analysis_cached_at,
+        duration_seconds, has_audio, content_hash
+    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+
+class MediaTooLargeException(Exception):
+    """A streamed download exceeded its size cutoff (nothing is cached)."""
+    pass
+
+# Facebook/Instagram CDN hosts: the same asset is served from many shard hosts
+# (scontent-fra5-1.xx.fbcdn.net, ...) with expiring signature parameters
+CDN_HOST_SUFFIXES = ('.fbcdn.net', '.cdninstagram.com')
+# Query parameters that change between fetches of the same asset (signature, expiry, routing)
+VOLATILE_URL_PARAMS = {'oh', 'oe', 'efg', 'ccb'}
+VOLATILE_URL_PARAM_PREFIXES = ('_nc_',)
+
+
+def canonicalize_media_url(url: str) -> str:
+    """
+    Cache key form of a media URL.
+
+    CDN links keep only the asset path and the parameters that select a different
+    rendition (e.g. stp=dst-jpg_s600x600); shard host, signature (oh/oe) and
+    _nc_* routing tokens are dropped, so a link fetched tomorrow hits today's cache.
+    Other URLs are only trimmed and get a lowercased scheme/host.
+    """
+    url = url.strip()
+    try:
+        parts = urlsplit(url)
+    except ValueError:
+        return url
+    host = (parts.hostname or '').lower()
+    if not host.endswith(CDN_HOST_SUFFIXES):
+        if not parts.scheme:
+            return url
+        netloc = parts.netloc.lower()
+        query = f"?{parts.query}" if parts.query else ""
+        return f"{parts.scheme.lower()}://{netloc}{parts.path}{query}"
+
+    stable = sorted(
+        (key, value) for key, value in parse_qsl(parts.query, keep_blank_values=True)
+        if key not in VOLATILE_URL_PARAMS and not key.startswith(VOLATILE_URL_PARAM_PREFIXES)
+    )
+    query = f"?{urlencode(stable)}" if stable else ""
+    return f"cdn:{parts.path}{query}"
+
 class MediaCacheService:
     """Service for managing cached ad images, videos and analysis results."""
     
     def __init__(self):
+        # One long-lived connection per thread (sqlite3 connections must not be shared across threads)
+        self._local = threading.local()
         self._ensure_cache_directory()
         self._init_database()
+
+        # Running byte totals per media type — updated on every insert/delete,
+        # so the size check never has to SUM() the whole table
+        self._size_lock = threading.Lock()
+        self._bytes: Dict[str, int] = {}
+        self._evicted = {'files': 0, 'bytes': 0}
+        self._evict_lock = threading.Lock()
+        self._evict_wakeup = threading.Event()
+        self._evictor: Optional[threading.Thread] = None
+
+        # Write-behind buffer for last_accessed: url_hash -> (unix time of the latest hit, content_hash)
+        self._access_lock = threading.Lock()
+        self._pending_access: Dict[str, tuple] = {}
+        self._flush_wakeup = threading.Event()
+        self._flusher: Optional[threading.Thread] = None
+        atexit.register(self.flush_access_times)
+
+        # Near-duplicate index (perceptual hashes of blobs), loaded from the DB on first use
+        self._phash_index = PerceptualIndex()
+        self._phash_loaded = False
+        self._phash_lock = threading.Lock()
+
+        self._load_size_totals()
+        if self._over_budget():
+            self._schedule_eviction()
+        self._start_phash_backfill()
+        if FSCK_ON_START:
+            threading.Thread(target=self._background_fsck, name="media-cache-fsck", daemon=True).start()
     
     def _ensure_cache_directory(self):
         """Create cache directories if they don't exist."""
         CACHE_DIR.mkdir(parents=True, exist_ok=True)
         CACHE_IMAGES_DIR.mkdir(parents=True, exist_ok=True)
         CACHE_VIDEOS_DIR.mkdir(parents=True, exist_ok=True)
+        CACHE_VARIANTS_DIR.mkdir(parents=True, exist_ok=True)
         logger.info(f"Cache directory initialized at {CACHE_DIR}")
     
+    def _connection(self) -> sqlite3.Connection:
+        """
+        Returns this thread's connection, opening it on first use.
+        Use as `with self._connection() as conn:` — the block is one transaction
+        (commit on success, rollback on error); the connection itself stays open.
+        """
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(
+                CACHE_DB_PATH,
+                timeout=SQLITE_BUSY_TIMEOUT_MS / 1000,
+                cached_statements=SQLITE_CACHED_STATEMENTS,
+            )
+            conn.row_factory = sqlite3.Row
+            # WAL: readers never block the writer; NORMAL sync is durable across app crashes in WAL mode
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+            conn.execute("PRAGMA temp_store=MEMORY")
+            conn.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+            self._local.conn = conn
+        return conn
+
+    def close(self):
+        """Closes the calling thread's connection (others close when their thread exits)."""
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+            self._local.conn = None
+
     def _init_database(self):
         """Initialize SQLite database with required schema."""
-        with sqlite3.connect(CACHE_DB_PATH) as conn:
+        with self._connection() as conn:
             conn.execute("""
                 CREATE TABLE IF NOT EXISTS media_cache (
                     url_hash TEXT PRIMARY KEY,
@@ -62,7 +224,81 @@ class MediaCacheService:
                     
                     -- Video-specific fields
                     duration_seconds REAL,
-                    has_audio BOOLEAN
+                    has_audio BOOLEAN,
+
+                    -- sha256 of the bytes (media_blobs key); many URLs can share one blob
+                    content_hash TEXT
+                )
+            """)
+
+            # Content-addressed store: one file per distinct content. Signed fbcdn URLs of the
+            # same creative differ only in query tokens, so they all point to the same blob.
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS media_blobs (
+                    content_hash TEXT PRIMARY KEY,  -- sha256 of the bytes
+                    file_path TEXT NOT NULL,
+                    file_size INTEGER,
+                    content_type TEXT,
+                    media_type TEXT NOT NULL DEFAULT 'image',
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    last_accessed TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+
+                    -- Analysis of this content (shared by every URL that served it)
+                    analysis_results TEXT,
+                    analysis_cached_at TIMESTAMP,
+
+                    -- Perceptual signature: hex dHash (image) or keyframe dHashes (video);
+                    -- '' = could not be hashed
+                    phash TEXT,
+
+                    -- Last time the file was checked against content_hash (NULL = never, verified on read)
+                    verified_at TIMESTAMP
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_blobs_type_last_accessed ON media_blobs(media_type, last_accessed)")
+
+            # Derived versions of a blob (e.g. downscaled JPEG sent to Gemini), one per settings key.
+            # file_path NULL = no useful variant for these settings (don't try again).
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS media_variants (
+                    content_hash TEXT NOT NULL,
+                    variant_key TEXT NOT NULL,
+                    file_path TEXT,
+                    file_size INTEGER,
+                    content_type TEXT,
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (content_hash, variant_key)
+                )
+            """)
+
+            # Videos uploaded to the Gemini File API, reusable until they expire. A file is only
+            # visible to the key that uploaded it; key_id is a fingerprint, keys aren't stored.
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS gemini_files (
+                    content_hash TEXT NOT NULL,
+                    key_id TEXT NOT NULL,
+                    file_name TEXT NOT NULL,  -- "files/abc"
+                    file_uri TEXT NOT NULL,
+                    mime_type TEXT,
+                    expires_at REAL NOT NULL,  -- unix time
+                    last_used REAL NOT NULL,   -- unix time
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (content_hash, key_id)
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_gemini_files_name ON gemini_files(file_name)")
+
+            # Gemini analyses by everything that shapes the answer. Rows outlive evicted blobs:
+            # re-downloaded bytes hash to the same content_hash and hit again.
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS analysis_cache (
+                    content_hash TEXT NOT NULL,
+                    prompt_version TEXT NOT NULL,
+                    model TEXT NOT NULL,
+                    ad_text_hash TEXT NOT NULL,  -- sha256 of the normalized ad text
+                    analysis_results TEXT NOT NULL,  -- JSON string
+                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (content_hash, prompt_version, model, ad_text_hash)
                 )
             """)
             
@@ -73,16 +309,687 @@ class MediaCacheService:
             conn.execute("CREATE INDEX IF NOT EXISTS idx_has_people ON media_cache(has_people)")
             conn.execute("CREATE INDEX IF NOT EXISTS idx_dominant_colors ON media_cache(dominant_colors)")
             conn.execute("CREATE INDEX IF NOT EXISTS idx_media_type ON media_cache(media_type)")
+            # LRU eviction per media type walks this index oldest-first
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_type_last_accessed ON media_cache(media_type, last_accessed)")
             
             conn.commit()
             logger.info("Database schema initialized")
+
+        self._migrate()
+
+    # ------------------------------------------------------------
+    #  Schema migrations (PRAGMA user_version)
+    # ------------------------------------------------------------
+
+    def _migrate(self):
+        """Brings an existing database up to SCHEMA_VERSION, one version at a time."""
+        with self._connection() as conn:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+
+        if version < 1:
+            self._migrate_v1_content_store()
+            with self._connection() as conn:
+                conn.execute("PRAGMA user_version = 1")
+
+        if version < 2:
+            # v2: perceptual hash per blob (filled on insert and by the background backfill)
+            with self._connection() as conn:
+                columns = {row['name'] for row in conn.execute("PRAGMA table_info(media_blobs)")}
+                if 'phash' not in columns:
+                    conn.execute("ALTER TABLE media_blobs ADD COLUMN phash TEXT")
+                conn.execute("PRAGMA user_version = 2")
+
+        if version < 3:
+            self._migrate_v3_canonical_url_keys()
+            with self._connection() as conn:
+                conn.execute("PRAGMA user_version = 3")
+
+        if version < 4:
+            # v4: checksum verification state; files written before atomic writes start unverified
+            with self._connection() as conn:
+                columns = {row['name'] for row in conn.execute("PRAGMA table_info(media_blobs)")}
+                if 'verified_at' not in columns:
+                    conn.execute("ALTER TABLE media_blobs ADD COLUMN verified_at TIMESTAMP")
+                conn.execute("PRAGMA user_version = 4")
+
+    def _migrate_v3_canonical_url_keys(self):
+        """
+        v3: re-keys media_cache rows by the canonical URL (see canonicalize_media_url).
+        Rows whose URLs only differed by volatile tokens collapse into one: the row with
+        analysis wins, then the most recently accessed one.
+        """
+        with self._connection() as conn:
+            rows = conn.execute("""
+                SELECT url_hash, original_url, analysis_results IS NOT NULL AS has_analysis, last_accessed
+                FROM media_cache
+            """).fetchall()
+
+            winners = {}
+            for row in rows:
+                new_hash = self._generate_url_hash(row['original_url'])
+                rank = (row['has_analysis'], row['last_accessed'] or '')
+                current = winners.get(new_hash)
+                if current is None or rank > current[0]:
+                    winners[new_hash] = (rank, row['url_hash'])
+
+            keep = {old_hash: new_hash for new_hash, (_, old_hash) in winners.items()}
+            losers = [(row['url_hash'],) for row in rows if row['url_hash'] not in keep]
+            renames = [(new_hash, old_hash) for old_hash, new_hash in keep.items() if old_hash != new_hash]
+            if not losers and not renames:
+                return
+
+            conn.executemany("DELETE FROM media_cache WHERE url_hash = ?", losers)
+            # Two passes so a new key never collides with an old key that is renamed later
+            conn.executemany("UPDATE media_cache SET url_hash = 'rekey:' || ? WHERE url_hash = ?", renames)
+            conn.execute("UPDATE media_cache SET url_hash = substr(url_hash, 7) WHERE url_hash LIKE 'rekey:%'")
+            conn.commit()
+
+        logger.info(f"Media cache re-keyed by canonical URL: {len(renames)} rows updated, {len(losers)} duplicates merged")
+
+    def _migrate_v1_content_store(self):
+        """v1: adds media_cache.content_hash and moves every url_hash-keyed file into the content store."""
+        with self._connection() as conn:
+            columns = {row['name'] for row in conn.execute("PRAGMA table_info(media_cache)")}
+            if 'content_hash' not in columns:
+                conn.execute("ALTER TABLE media_cache ADD COLUMN content_hash TEXT")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_content_hash ON media_cache(content_hash)")
+            rows = conn.execute("""
+                SELECT url_hash, file_path, content_type, media_type, last_accessed,
+                       analysis_results, analysis_cached_at
+                FROM media_cache WHERE content_hash IS NULL
+            """).fetchall()
+
+        if not rows:
+            return
+        logger.info(f"Migrating {len(rows)} cached files into the content-addressed store...")
+
+        migrated = 0
+        missing = []
+        for row in rows:
+            old_path = Path(row['file_path'])
+            if not old_path.exists():
+                missing.append((row['url_hash'],))
+                continue
+
+            content_hash = self._hash_file(old_path)
+            blob_path = self._get_file_path(content_hash, row['content_type'] or '', row['media_type'])
+            if blob_path.exists():
+                if old_path != blob_path:
+                    old_path.unlink(missing_ok=True)  # Same bytes already stored under another URL
+            else:
+                old_path.replace(blob_path)
+
+            with self._connection() as conn:
+                conn.execute("""
+                    INSERT OR IGNORE INTO media_blobs (
+                        content_hash, file_path, file_size, content_type, media_type,
+                        last_accessed, analysis_results, analysis_cached_at
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                """, (
+                    content_hash, str(blob_path), blob_path.stat().st_size, row['content_type'], row['media_type'],
+                    row['last_accessed'], row['analysis_results'], row['analysis_cached_at']
+                ))
+                conn.execute(
+                    "UPDATE media_cache SET content_hash = ?, file_path = ? WHERE url_hash = ?",
+                    (content_hash, str(blob_path), row['url_hash'])
+                )
+            migrated += 1
+
+        with self._connection() as conn:
+            conn.executemany("DELETE FROM media_cache WHERE url_hash = ?", missing)
+        logger.info(f"Content store migration done: {migrated} files migrated, {len(missing)} missing files dropped")
+
+    @staticmethod
+    def _hash_file(path: Path) -> str:
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b''):
+                digest.update(chunk)
+        return digest.hexdigest()
+
+    @staticmethod
+    def map_file(file_path) -> Any:
+        """
+        Read-only memory map of a cached file: bytes-like (hashlib, base64, memoryview)
+        without copying the file into the heap. Empty files come back as b''.
+        """
+        with open(file_path, 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                return b''
+            return mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+    @staticmethod
+    def compute_content_hash(media_data: bytes) -> str:
+        """Content address of media bytes (sha256 hex)."""
+        return hashlib.sha256(media_data).hexdigest()
     
+    # ------------------------------------------------------------
+    #  Size accounting + LRU eviction
+    # ------------------------------------------------------------
+
+    def _load_size_totals(self):
+        """(Re)load the running byte totals from the database (on start and after bulk deletes)."""
+        with self._connection() as conn:
+            rows = conn.execute(
+                "SELECT media_type, COALESCE(SUM(file_size), 0) FROM media_blobs GROUP BY media_type"
+            ).fetchall()
+        with self._size_lock:
+            self._bytes = {'image': 0, 'video': 0}
+            for media_type, size in rows:
+                self._bytes[media_type] = size
+
+    def _adjust_size(self, media_type: str, delta: int):
+        with self._size_lock:
+            self._bytes[media_type] = self._bytes.get(media_type, 0) + delta
+
+    def _budget_bytes(self, media_type: Optional[str]) -> int:
+        """Byte budget for a media type (None = whole cache)."""
+        if media_type is None:
+            return int(MAX_CACHE_SIZE_GB * _GB)
+        return int(MEDIA_TYPE_BUDGETS_GB.get(media_type, MAX_CACHE_SIZE_GB) * _GB)
+
+    def _used_bytes(self, media_type: Optional[str]) -> int:
+        with self._size_lock:
+            if media_type is None:
+                return sum(self._bytes.values())
+            return self._bytes.get(media_type, 0)
+
+    def _over_budget(self) -> bool:
+        return any(
+            self._used_bytes(media_type) > self._budget_bytes(media_type)
+            for media_type in (None, *MEDIA_TYPE_BUDGETS_GB)
+        )
+
+    def _schedule_eviction(self):
+        """Wakes the background evictor (started on first use) — inserts never wait for deletes."""
+        self._evict_wakeup.set()
+        with self._evict_lock:
+            if self._evictor is None or not self._evictor.is_alive():
+                self._evictor = threading.Thread(target=self._eviction_loop, name="media-cache-evictor", daemon=True)
+                self._evictor.start()
+
+    def _eviction_loop(self):
+        while True:
+            self._evict_wakeup.wait()
+            self._evict_wakeup.clear()
+            try:
+                self.enforce_size_limit()
+            except Exception as e:
+                logger.warning(f"Cache eviction failed: {e}")
+
+    def _evict_oldest(self, media_type: Optional[str], bytes_to_free: int) -> int:
+        """
+        Deletes least recently accessed blobs (of one media type, or any) together with every
+        URL pointing to them, until bytes_to_free is reached or one batch is done.
+        Returns the number of bytes freed.
+        """
+        query = "SELECT content_hash, file_path, file_size, media_type FROM media_blobs"
+        params: list = []
+        if media_type:
+            query += " WHERE media_type = ?"
+            params.append(media_type)
+        query += " ORDER BY last_accessed ASC LIMIT ?"
+        params.append(EVICTION_BATCH_SIZE)
+
+        freed = 0
+        evicted_hashes = []
+        with self._connection() as conn:
+            for content_hash, file_path, file_size, row_type in conn.execute(query, params).fetchall():
+                if freed >= bytes_to_free:
+                    break
+                try:
+                    Path(file_path).unlink(missing_ok=True)
+                except Exception as e:
+                    # e.g. a video still open for upload on Windows — try again next run
+                    logger.warning(f"Failed to evict cached file {file_path}: {e}")
+                    continue
+                evicted_hashes.append((content_hash,))
+                freed += file_size or 0
+                self._adjust_size(row_type, -(file_size or 0))
+
+            if evicted_hashes:
+                conn.executemany("DELETE FROM media_blobs WHERE content_hash = ?", evicted_hashes)
+                conn.executemany("DELETE FROM media_cache WHERE content_hash = ?", evicted_hashes)
+                self._drop_variants(conn, evicted_hashes)
+                conn.commit()
+
+        with self._size_lock:
+            self._evicted['files'] += len(evicted_hashes)
+            self._evicted['bytes'] += freed
+        return freed
+
+    def enforce_size_limit(self) -> Dict[str, int]:
+        """
+        Evicts least recently used media until every budget (per media type, then the
+        whole cache) is back under EVICTION_TARGET_RATIO of its limit.
+
+        Returns:
+            Dictionary with the number of bytes freed
+        """
+        # LRU order must include hits that are still buffered in memory
+        self.flush_access_times()
+
+        freed = 0
+        with self._evict_lock:
+            for media_type in (*MEDIA_TYPE_BUDGETS_GB, None):
+                target = int(self._budget_bytes(media_type) * EVICTION_TARGET_RATIO)
+                while self._used_bytes(media_type) > target:
+                    step = self._evict_oldest(media_type, self._used_bytes(media_type) - target)
+                    if not step:
+                        break
+                    freed += step
+
+        if freed:
+            logger.info(f"Cache eviction freed {freed / (1024 * 1024):.1f} MB (now {self._used_bytes(None) / _GB:.2f} GB)")
+        return {"freed_bytes": freed}
+
+    # ------------------------------------------------------------
+    #  Write-behind last_accessed updates
+    # ------------------------------------------------------------
+
+    def _record_access(self, url_hash: str, content_hash: Optional[str]):
+        """Remembers a cache hit; the DB write happens later in a batch (a hit stays a pure read)."""
+        with self._access_lock:
+            self._pending_access[url_hash] = (time.time(), content_hash)
+            pending = len(self._pending_access)
+            if self._flusher is None or not self._flusher.is_alive():
+                self._flusher = threading.Thread(target=self._flush_loop, name="media-cache-access-flusher", daemon=True)
+                self._flusher.start()
+        if pending >= ACCESS_FLUSH_COUNT:
+            self._flush_wakeup.set()
+
+    def _flush_loop(self):
+        while True:
+            self._flush_wakeup.wait(ACCESS_FLUSH_INTERVAL)
+            self._flush_wakeup.clear()
+            try:
+                self.flush_access_times()
+            except Exception as e:
+                logger.warning(f"Failed to flush cache access times: {e}")
+
+    def flush_access_times(self) -> int:
+        """
+        Writes buffered last_accessed times with a single executemany.
+
+        Returns:
+            Number of rows updated
+        """
+        with self._access_lock:
+            if not self._pending_access:
+                return 0
+            pending, self._pending_access = self._pending_access, {}
+
+        try:
+            with self._connection() as conn:
+                conn.executemany(
+                    "UPDATE media_cache SET last_accessed = datetime(?, 'unixepoch') WHERE url_hash = ?",
+                    [(accessed_at, url_hash) for url_hash, (accessed_at, _) in pending.items()],
+                )
+                # LRU eviction works on blobs: a blob is as fresh as its most recent URL
+                conn.executemany(
+                    "UPDATE media_blobs SET last_accessed = datetime(?, 'unixepoch') WHERE content_hash = ?",
+                    [(accessed_at, content_hash) for accessed_at, content_hash in pending.values() if content_hash],
+                )
+        except Exception:
+            # Put the times back (newer hits win) so the next flush retries them
+            with self._access_lock:
+                for url_hash, entry in pending.items():
+                    if entry[0] > self._pending_access.get(url_hash, (0, None))[0]:
+                        self._pending_access[url_hash] = entry
+            raise
+        return len(pending)
+
+    # ------------------------------------------------------------
+    #  Integrity check (fsck)
+    # ------------------------------------------------------------
+
+    def fsck(self, full: bool = False) -> Dict[str, int]:
+        """
+        Checks every blob against its row and repairs what doesn't match.
+
+        - Missing or wrong-size files, and files whose sha256 differs from content_hash,
+          are deleted together with their rows (the next request downloads them again).
+        - Blobs never verified are checksummed; full=True re-checksums all of them.
+        - Files no row points to (crash between rename and commit) and leftover .part
+          temp files older than FSCK_MIN_FILE_AGE are removed.
+
+        Returns:
+            Counters: checked, verified, missing, damaged, orphan_files, temp_files
+        """
+        stats = {'checked': 0, 'verified': 0, 'missing': 0, 'damaged': 0, 'orphan_files': 0, 'temp_files': 0}
+
+        with self._connection() as conn:
+            rows = conn.execute(
+                "SELECT content_hash, file_path, file_size, media_type, verified_at, NULL AS url_hash FROM media_blobs"
+            ).fetchall()
+
+        known_files = set()
+        with self._connection() as conn:
+            # Variants whose blob is gone (blob never committed or removed behind our back)
+            self._drop_variants(conn, conn.execute("""
+                SELECT DISTINCT content_hash FROM media_variants
+                WHERE created_at < datetime(?, 'unixepoch')
+                  AND content_hash NOT IN (SELECT content_hash FROM media_blobs)
+            """, (time.time() - FSCK_MIN_FILE_AGE,)).fetchall())
+            for variant in conn.execute(
+                "SELECT content_hash, variant_key, file_path FROM media_variants WHERE file_path IS NOT NULL"
+            ).fetchall():
+                if Path(variant['file_path']).exists():
+                    known_files.add(Path(variant['file_path']).name)
+                else:
+                    conn.execute(
+                        "DELETE FROM media_variants WHERE content_hash = ? AND variant_key = ?",
+                        (variant['content_hash'], variant['variant_key'])
+                    )
+
+        for row in rows:
+            stats['checked'] += 1
+            file_path = Path(row['file_path'])
+            known_files.add(file_path.name)
+            if not file_path.exists():
+                problem = 'missing'
+            elif not self._file_has_size(file_path, row['file_size']):
+                problem = 'damaged'
+            elif (full or row['verified_at'] is None) and self._hash_file(file_path) != row['content_hash']:
+                problem = 'damaged'
+            else:
+                if full or row['verified_at'] is None:
+                    with self._connection() as conn:
+                        conn.execute(
+                            "UPDATE media_blobs SET verified_at = CURRENT_TIMESTAMP WHERE content_hash = ?",
+                            (row['content_hash'],)
+                        )
+                    stats['verified'] += 1
+                continue
+
+            stats[problem] += 1
+            with self._connection() as conn:
+                self._drop_blob(conn, row, problem)
+
+        cutoff = time.time() - FSCK_MIN_FILE_AGE
+        for directory in (CACHE_IMAGES_DIR, CACHE_VIDEOS_DIR, CACHE_VARIANTS_DIR):
+            if not directory.exists():
+                continue
+            for file_path in directory.iterdir():
+                try:
+                    if not file_path.is_file() or file_path.name in known_files or file_path.stat().st_mtime > cutoff:
+                        continue
+                    file_path.unlink()
+                    stats['temp_files' if file_path.suffix == '.part' else 'orphan_files'] += 1
+                except OSError as e:
+                    logger.warning(f"fsck could not remove {file_path}: {e}")
+
+        logger.info(f"Media cache fsck: {stats}")
+        return stats
+
+    def _background_fsck(self):
+        try:
+            self.fsck()
+        except Exception as e:
+            logger.warning(f"Media cache fsck failed: {e}")
+
+    # ------------------------------------------------------------
+    #  Perceptual near-duplicate index
+    # ------------------------------------------------------------
+
+    @staticmethod
+    def _compute_signature(media_type: str, file_path: Path, media_data: Optional[bytes] = None) -> Optional[List[int]]:
+        """Perceptual signature of a blob: [dHash] for images, keyframe dHashes for videos."""
+        if media_type == 'video':
+            return video_keyframe_hashes(str(file_path))
+        dhash = image_dhash(media_data if media_data is not None else file_path.read_bytes())
+        return [dhash] if dhash is not None else None
+
+    @staticmethod
+    def _can_hash(media_type: str) -> bool:
+        return FFMPEG_AVAILABLE if media_type == 'video' else PIL_AVAILABLE
+
+    def _index_blob(self, content_hash: str, media_type: str, file_path: Path, media_data: Optional[bytes] = None):
+        """Computes, stores and indexes the perceptual signature of a new blob."""
+        self._index_blobs([(content_hash, media_type, file_path, media_data)])
+
+    def _index_blobs(self, blobs: List[tuple]):
+        """
+        Perceptual signatures for new blobs, written in one statement.
+
+        Args:
+            blobs: (content_hash, media_type, file_path, media_data or None) tuples
+        """
+        updates = []
+        for content_hash, media_type, file_path, media_data in blobs:
+            if not self._can_hash(media_type):
+                continue  # Left NULL, the backfill picks it up once Pillow/ffmpeg is installed
+            signature = self._compute_signature(media_type, file_path, media_data)
+            updates.append((encode_hashes(signature) if signature else '', content_hash))
+            if signature and self._phash_loaded:
+                self._phash_index.add(content_hash, media_type, signature)
+        if updates:
+            with self._connection() as conn:
+                conn.executemany("UPDATE media_blobs SET phash = ? WHERE content_hash = ?", updates)
+
+    def _ensure_phash_index(self):
+        """Loads every stored signature into the in-memory BK-trees (once)."""
+        if self._phash_loaded:
+            return
+        with self._phash_lock:
+            if self._phash_loaded:
+                return
+            with self._connection() as conn:
+                rows = conn.execute(
+                    "SELECT content_hash, media_type, phash FROM media_blobs WHERE phash IS NOT NULL AND phash != ''"
+                ).fetchall()
+            for row in rows:
+                self._phash_index.add(row['content_hash'], row['media_type'], decode_hashes(row['phash']))
+            self._phash_loaded = True
+            logger.info(f"Perceptual index loaded: {len(self._phash_index)} signatures")
+
+    def _start_phash_backfill(self):
+        """Hashes blobs cached before the index existed, in a background thread."""
+        if not (PIL_AVAILABLE or FFMPEG_AVAILABLE):
+            return
+        threading.Thread(target=self._backfill_phashes, name="media-cache-phash-backfill", daemon=True).start()
+
+    def _backfill_phashes(self):
+        try:
+            with self._connection() as conn:
+                rows = conn.execute(
+                    "SELECT content_hash, media_type, file_path FROM media_blobs WHERE phash IS NULL"
+                ).fetchall()
+            done = 0
+            for row in rows:
+                file_path = Path(row['file_path'])
+                if self._can_hash(row['media_type']) and file_path.exists():
+                    self._index_blob(row['content_hash'], row['media_type'], file_path)
+                    done += 1
+            if done:
+                logger.info(f"Perceptual hash backfill: {done} blobs hashed")
+        except Exception as e:
+            logger.warning(f"Perceptual hash backfill failed: {e}")
+
+    # ------------------------------------------------------------
+    #  Analysis cache keyed by (content, prompt, model, ad_text)
+    # ------------------------------------------------------------
+
+    @staticmethod
+    def normalize_ad_text(ad_text: Optional[str]) -> str:
+        """Whitespace-insensitive form of the ad text that goes into the analysis key."""
+        return " ".join((ad_text or "").split())
+
+    @classmethod
+    def _ad_text_hash(cls, ad_text: Optional[str]) -> str:
+        return hashlib.sha256(cls.normalize_ad_text(ad_text).encode()).hexdigest()
+
+    def get_analysis(self, content_hash: str, prompt_version: str, model: str,
+                     ad_text: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        Cached analysis of exactly this content under this prompt, model and ad text.
+
+        Args:
+            content_hash: Content hash of the analyzed media
+            prompt_version: Version tag of the prompt that produced the analysis
+            model: Gemini model name
+            ad_text: Ad text that was sent as context ('' / None = none)
+
+        Returns:
+            Analysis results dict or None
+        """
+        with self._connection() as conn:
+            row = conn.execute("""
+                SELECT analysis_results FROM analysis_cache
+                WHERE content_hash = ? AND prompt_version = ? AND model = ? AND ad_text_hash = ?
+            """, (content_hash, prompt_version, model, self._ad_text_hash(ad_text))).fetchone()
+        return json.loads(row['analysis_results']) if row else None
+
+    def store_analysis(self, content_hash: str, prompt_version: str, model: str,
+                       ad_text: Optional[str], analysis_results: Dict[str, Any]):
+        """Stores an analysis under its (content, prompt, model, ad_text) key."""
+        with self._connection() as conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO analysis_cache
+                    (content_hash, prompt_version, model, ad_text_hash, analysis_results)
+                VALUES (?, ?, ?, ?, ?)
+            """, (content_hash, prompt_version, model, self._ad_text_hash(ad_text), json.dumps(analysis_results)))
+            conn.commit()
+
+    def find_similar_analysis(self, content_hash: str, media_type: str, prompt_version: str, model: str,
+                              ad_text: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        """
+        Finds cached analysis (same prompt, model and ad text) for the same content or a
+        near-duplicate of it (resized / recompressed re-upload of the same creative).
+
+        Args:
+            content_hash: Content hash of the media to analyze
+            media_type: 'image' or 'video'
+            prompt_version, model, ad_text: Analysis key (see get_analysis)
+
+        Returns:
+            {'analysis_results', 'content_hash', 'distance'} of the closest analyzed match, or None
+        """
+        exact = self.get_analysis(content_hash, prompt_version, model, ad_text)
+        if exact is not None:
+            return {'analysis_results': exact, 'content_hash': content_hash, 'distance': 0}
+
+        with self._connection() as conn:
+            row = conn.execute("SELECT phash FROM media_blobs WHERE content_hash = ?", (content_hash,)).fetchone()
+            if row is None or not row['phash']:
+                return None
+
+            self._ensure_phash_index()
+            ad_text_hash = self._ad_text_hash(ad_text)
+            for distance, match_hash in self._phash_index.find_similar(media_type, decode_hashes(row['phash'])):
+                if match_hash == content_hash:
+                    continue
+                match = conn.execute("""
+                    SELECT analysis_results FROM analysis_cache
+                    WHERE content_hash = ? AND prompt_version = ? AND model = ? AND ad_text_hash = ?
+                """, (match_hash, prompt_version, model, ad_text_hash)).fetchone()
+                if match:
+                    logger.info(f"Near-duplicate {media_type} found (distance {distance}): {content_hash[:12]} ~ {match_hash[:12]}")
+                    return {'analysis_results': json.loads(match['analysis_results']), 'content_hash': match_hash, 'distance': distance}
+        return None
+
+    # ------------------------------------------------------------
+    #  Derived variants (downscaled images for Gemini)
+    # ------------------------------------------------------------
+
+    def get_variant(self, content_hash: str, variant_key: str) -> Optional[Dict[str, Any]]:
+        """
+        Cached variant of a blob.
+
+        Returns:
+            None if never computed; otherwise {'file_path', 'file_size', 'content_type'}
+            where file_path is None if no useful variant exists for these settings
+        """
+        with self._connection() as conn:
+            row = conn.execute("""
+                SELECT file_path, file_size, content_type FROM media_variants
+                WHERE content_hash = ? AND variant_key = ?
+            """, (content_hash, variant_key)).fetchone()
+        if row is None:
+            return None
+        if row['file_path'] and not Path(row['file_path']).exists():
+            return None  # Recomputed and overwritten by the caller
+        return dict(row)
+
+    def store_variant(self, content_hash: str, variant_key: str, data: Optional[bytes],
+                      content_type: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Stores a variant next to its blob (data None records that there is no useful variant).
+        Variant files are small and are removed together with their blob.
+        """
+        file_path = None
+        if data is not None:
+            ext = {'image/jpeg': '.jpg', 'image/webp': '.webp', 'image/png': '.png'}.get(content_type, '.bin')
+            file_path = CACHE_VARIANTS_DIR / f"{content_hash}.{variant_key}{ext}"
+            self._atomic_write(file_path, data)
+        with self._connection() as conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO media_variants (content_hash, variant_key, file_path, file_size, content_type)
+                VALUES (?, ?, ?, ?, ?)
+            """, (content_hash, variant_key, str(file_path) if file_path else None,
+                  len(data) if data is not None else None, content_type))
+        return {'file_path': str(file_path) if file_path else None,
+                'file_size': len(data) if data is not None else None,
+                'content_type': content_type}
+
+    def _drop_variants(self, conn: sqlite3.Connection, content_hashes: List[tuple]):
+        """Deletes the variant files and rows of the given (content_hash,) tuples."""
+        for (content_hash,) in content_hashes:
+            for variant in conn.execute(
+                "SELECT file_path FROM media_variants WHERE content_hash = ? AND file_path IS NOT NULL", (content_hash,)
+            ).fetchall():
+                try:
+                    Path(variant['file_path']).unlink(missing_ok=True)
+                except OSError as e:
+                    logger.warning(f"Failed to delete variant {variant['file_path']}: {e}")
+        conn.executemany("DELETE FROM media_variants WHERE content_hash = ?", content_hashes)
+
+    # ------------------------------------------------------------
+    #  Gemini remote files (uploaded videos reused across analyses)
+    # ------------------------------------------------------------
+
+    def get_gemini_files(self, content_hash: str, valid_until: float) -> List[Dict[str, Any]]:
+        """Uploaded copies of a blob that stay valid at least until valid_until, most recently used first."""
+        with self._connection() as conn:
+            rows = conn.execute("""
+                SELECT content_hash, key_id, file_name, file_uri, mime_type, expires_at, last_used
+                FROM gemini_files WHERE content_hash = ? AND expires_at > ?
+                ORDER BY last_used DESC
+            """, (content_hash, valid_until)).fetchall()
+        return [dict(row) for row in rows]
+
+    def store_gemini_file(self, content_hash: str, key_id: str, file_name: str, file_uri: str,
+                          mime_type: Optional[str], expires_at: float):
+        with self._connection() as conn:
+            conn.execute("""
+                INSERT OR REPLACE INTO gemini_files (content_hash, key_id, file_name, file_uri, mime_type, expires_at, last_used)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (content_hash, key_id, file_name, file_uri, mime_type, expires_at, time.time()))
+
+    def touch_gemini_file(self, file_name: str):
+        with self._connection() as conn:
+            conn.execute("UPDATE gemini_files SET last_used = ? WHERE file_name = ?", (time.time(), file_name))
+
+    def gemini_files_to_sweep(self, expired_before: float, idle_before: float) -> List[Dict[str, Any]]:
+        """Files that have expired (or are about to) or haven't been used since idle_before."""
+        with self._connection() as conn:
+            rows = conn.execute("""
+                SELECT content_hash, key_id, file_name, expires_at, last_used FROM gemini_files
+                WHERE expires_at <= ? OR last_used < ?
+            """, (expired_before, idle_before)).fetchall()
+        return [dict(row) for row in rows]
+
+    def forget_gemini_files(self, file_names: List[str]) -> int:
+        with self._connection() as conn:
+            return conn.executemany("DELETE FROM gemini_files WHERE file_name = ?",
+                                    [(name,) for name in file_names]).rowcount
+
     def _generate_url_hash(self, url: str) -> str:
-        """Generate a consistent hash for the URL."""
-        return hashlib.md5(url.encode()).hexdigest()
+        """Generate a consistent hash for the URL (volatile CDN tokens don't change it)."""
+        return hashlib.md5(canonicalize_media_url(url).encode()).hexdigest()
     
-    def _get_file_path(self, url_hash: str, content_type: str, media_type: str = 'image') -> Path:
-        """Generate file path for cached media."""
+    def _get_file_path(self, content_hash: str, content_type: str, media_type: str = 'image') -> Path:
+        """Generate file path for cached media (files are named by content hash)."""
         # Determine file extension from content type
         image_ext_map = {
             'image/jpeg': '.jpg',
@@ -102,10 +1009,159 @@ class MediaCacheService:
         
         if media_type == 'video':
             ext = video_ext_map.get(content_type.lower(), '.mp4')
-            return CACHE_VIDEOS_DIR / f"{url_hash}{ext}"
+            return CACHE_VIDEOS_DIR / f"{content_hash}{ext}"
         else:
             ext = image_ext_map.get(content_type.lower(), '.jpg')
-            return CACHE_IMAGES_DIR / f"{url_hash}{ext}"
+            return CACHE_IMAGES_DIR / f"{content_hash}{ext}"
+
+    def _store_blob(self, conn: sqlite3.Connection, media_data: bytes, content_type: str, media_type: str) -> tuple:
+        """
+        Stores bytes in the content store unless the same content is already there.
+
+        Returns:
+            (content_hash, file_path, is_new) — is_new means the blob still needs a perceptual hash
+        """
+        content_hash = self.compute_content_hash(media_data)
+        return self._place_blob(conn, content_hash, len(media_data), content_type, media_type,
+                                lambda path: self._atomic_write(path, media_data))
+
+    @staticmethod
+    def _fsync_dir(directory: Path):
+        """Makes a rename durable (POSIX only; Windows can't open directories)."""
+        if not FSYNC_WRITES:
+            return
+        try:
+            fd = os.open(directory, os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(fd)
+        except OSError:
+            pass
+        finally:
+            os.close(fd)
+
+    @classmethod
+    def _atomic_write(cls, path: Path, data: bytes):
+        """Temp file + fsync + rename: after a crash the path holds either nothing or all of data."""
+        fd, tmp_name = tempfile.mkstemp(dir=path.parent, suffix='.part')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+                if FSYNC_WRITES:
+                    f.flush()
+                    os.fsync(f.fileno())
+            os.replace(tmp_name, path)
+        except BaseException:
+            Path(tmp_name).unlink(missing_ok=True)
+            raise
+        cls._fsync_dir(path.parent)
+
+    @staticmethod
+    def _file_has_size(path: Path, expected_size: Optional[int]) -> bool:
+        try:
+            actual = path.stat().st_size
+        except OSError:
+            return False
+        return expected_size is None or actual == expected_size
+
+    def _place_blob(self, conn: sqlite3.Connection, content_hash: str, file_size: int, content_type: str,
+                    media_type: str, write_file: Callable[[Path], Any]) -> tuple:
+        """
+        Registers a blob of known hash; write_file(path) is only called if the content isn't stored yet.
+
+        Returns:
+            (content_hash, file_path, is_new)
+        """
+        file_path, pending = self._write_blob_file(conn, content_hash, file_size, content_type, media_type, write_file)
+        if pending is None:
+            return content_hash, file_path, False
+        return content_hash, file_path, self._register_blob(conn, content_hash, file_path, file_size,
+                                                            content_type, media_type, refresh=pending)
+
+    def _write_blob_file(self, conn: sqlite3.Connection, content_hash: str, file_size: int, content_type: str,
+                         media_type: str, write_file: Callable[[Path], Any]) -> tuple:
+        """
+        First half of _place_blob, without writing to the database (no lock is taken, so the
+        fsyncs of write_file don't happen inside a write transaction).
+
+        Returns:
+            (file_path, pending): pending is None if the blob is already stored, else whether its
+            row exists and only needs refreshing (pass it to _register_blob as refresh)
+        """
+        existing = conn.execute(
+            "SELECT file_path FROM media_blobs WHERE content_hash = ?", (content_hash,)
+        ).fetchone()
+        if existing and self._file_has_size(Path(existing['file_path']), file_size):
+            return Path(existing['file_path']), None
+
+        # Files are written (atomically) before the row is committed: a crash in between
+        # leaves an orphan file for fsck, never a row pointing to a partial file
+        file_path = self._get_file_path(content_hash, content_type, media_type)
+        write_file(file_path)
+        return file_path, bool(existing)
+
+    def _register_blob(self, conn: sqlite3.Connection, content_hash: str, file_path: Path, file_size: int,
+                       content_type: str, media_type: str, refresh: bool) -> bool:
+        """Second half of _place_blob: the media_blobs row of a written file. Returns is_new."""
+        if refresh:
+            # Row outlived its file (or the file was damaged): refresh it without counting the bytes twice
+            conn.execute(
+                "UPDATE media_blobs SET file_path = ?, verified_at = CURRENT_TIMESTAMP WHERE content_hash = ?",
+                (str(file_path), content_hash)
+            )
+            return False
+
+        # The bytes were hashed on the way in, so the new file starts out verified
+        inserted = conn.execute("""
+            INSERT OR IGNORE INTO media_blobs (content_hash, file_path, file_size, content_type, media_type, verified_at)
+            VALUES (?, ?, ?, ?, ?, CURRENT_TIMESTAMP)
+        """, (content_hash, str(file_path), file_size, content_type, media_type)).rowcount
+        if inserted:
+            self._adjust_size(media_type, file_size)
+        return bool(inserted)
+
+    def _blob_is_valid(self, conn: sqlite3.Connection, row) -> bool:
+        """
+        Lazy integrity check on a cache hit: the file must exist with the recorded size;
+        a blob that was never verified (written before atomic writes) is checksummed once.
+        """
+        file_path = Path(row['file_path'])
+        if not self._file_has_size(file_path, row['blob_file_size']):
+            return False
+        if row['content_hash'] and row['blob_verified_at'] is None:
+            if self._hash_file(file_path) != row['content_hash']:
+                return False
+            conn.execute(
+                "UPDATE media_blobs SET verified_at = CURRENT_TIMESTAMP WHERE content_hash = ?", (row['content_hash'],)
+            )
+        return True
+
+    def _drop_blob(self, conn: sqlite3.Connection, row, reason: str = "missing") -> None:
+        """The blob file of a row is missing or damaged: delete it and forget every URL pointing to it."""
+        if reason != "missing":
+            Path(row['file_path']).unlink(missing_ok=True)
+        if row['content_hash']:
+            blob = conn.execute(
+                "SELECT file_size, media_type FROM media_blobs WHERE content_hash = ?", (row['content_hash'],)
+            ).fetchone()
+            conn.execute("DELETE FROM media_blobs WHERE content_hash = ?", (row['content_hash'],))
+            conn.execute("DELETE FROM media_cache WHERE content_hash = ?", (row['content_hash'],))
+            self._drop_variants(conn, [(row['content_hash'],)])
+            if blob:
+                self._adjust_size(blob['media_type'], -(blob['file_size'] or 0))
+        else:
+            conn.execute("DELETE FROM media_cache WHERE url_hash = ?", (row['url_hash'],))
+        logger.warning(f"Cached file {reason}, removed from database: {row['file_path']}")
+
+    @staticmethod
+    def _merge_blob_analysis(result: Dict[str, Any]):
+        """Falls back to the analysis attached to the content when this URL has none of its own."""
+        result.pop('blob_file_size', None)
+        result.pop('blob_verified_at', None)
+        blob_analysis = result.pop('blob_analysis_results', None)
+        if not result.get('analysis_results') and blob_analysis:
+            result['analysis_results'] = blob_analysis
     
     def get_cached_media(self, url: str, media_type: str = None) -> Optional[Dict[str, Any]]:
         """
@@ -120,14 +1176,18 @@ class MediaCacheService:
         """
         url_hash = self._generate_url_hash(url)
         
-        with sqlite3.connect(CACHE_DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
+        with self._connection() as conn:
             
-            query = "SELECT * FROM media_cache WHERE url_hash = ?"
+            query = """
+                SELECT m.*, b.analysis_results AS blob_analysis_results,
+                       b.file_size AS blob_file_size, b.verified_at AS blob_verified_at
+                FROM media_cache m LEFT JOIN media_blobs b ON b.content_hash = m.content_hash
+                WHERE m.url_hash = ?
+            """
             params = [url_hash]
             
             if media_type:
-                query += " AND media_type = ?"
+                query += " AND m.media_type = ?"
                 params.append(media_type)
             
             cursor = conn.execute(query, params)
@@ -136,25 +1196,18 @@ class MediaCacheService:
             if not row:
                 return None
             
-            # Check if file still exists
-            file_path = Path(row['file_path'])
-            if not file_path.exists():
-                # File was deleted, remove from database
-                conn.execute("DELETE FROM media_cache WHERE url_hash = ?", (url_hash,))
+            # Check that the file still exists and is intact (never serve a truncated file)
+            if not self._blob_is_valid(conn, row):
+                self._drop_blob(conn, row, "missing" if not Path(row['file_path']).exists() else "damaged")
                 conn.commit()
-                logger.warning(f"Cached file missing, removed from database: {file_path}")
                 return None
             
-            # Update last accessed time
-            conn.execute("""
-                UPDATE media_cache 
-                SET last_accessed = CURRENT_TIMESTAMP 
-                WHERE url_hash = ?
-            """, (url_hash,))
-            conn.commit()
+            # Update last accessed time (buffered, flushed in batches)
+            self._record_access(url_hash, row['content_hash'])
             
             # Convert row to dictionary
             result = dict(row)
+            self._merge_blob_analysis(result)
             
             # Parse JSON analysis results if available
             if result['analysis_results']:
@@ -195,10 +1248,6 @@ class MediaCacheService:
             File path where media was cached
         """
         url_hash = self._generate_url_hash(url)
-        file_path = self._get_file_path(url_hash, content_type, media_type)
-        
-        # Save media file
-        file_path.write_bytes(media_data)
         
         # Prepare analysis results for storage
         analysis_json = None
@@ -207,24 +1256,102 @@ class MediaCacheService:
             analysis_json = json.dumps(analysis_results)
             analysis_cached_at = time.time()
         
-        # Save metadata to database
-        with sqlite3.connect(CACHE_DB_PATH) as conn:
-            conn.execute("""
-                INSERT OR REPLACE INTO media_cache (
-                    url_hash, original_url, file_path, file_size, content_type, media_type,
-                    brand_name, ad_id, analysis_results, analysis_cached_at,
-                    duration_seconds, has_audio
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
+        # Save media file (once per distinct content) and metadata to database
+        with self._connection() as conn:
+            content_hash, file_path, is_new = self._store_blob(conn, media_data, content_type, media_type)
+            conn.execute(_UPSERT_URL_SQL, (
                 url_hash, url, str(file_path), len(media_data), content_type, media_type,
                 brand_name, ad_id, analysis_json, analysis_cached_at,
-                duration_seconds, has_audio
+                duration_seconds, has_audio, content_hash
             ))
+            if analysis_json:
+                conn.execute(
+                    "UPDATE media_blobs SET analysis_results = ?, analysis_cached_at = ? WHERE content_hash = ?",
+                    (analysis_json, analysis_cached_at, content_hash)
+                )
             conn.commit()
+
+        # Hashing happens outside the write transaction (ffmpeg on videos can take a moment)
+        if is_new:
+            self._index_blob(content_hash, media_type, file_path, media_data)
+        if self._over_budget():
+            self._schedule_eviction()
         
         logger.info(f"Cached {media_type}: {url} -> {file_path}")
         return str(file_path)
 
+    def cache_media_stream(self, url: str, chunks: Iterable[bytes], content_type: str,
+                           media_type: str = 'video', brand_name: str = None, ad_id: str = None,
+                           max_bytes: Optional[int] = None) -> str:
+        """
+        Cache media from a chunk iterator (e.g. resp.iter_content()) without holding it in memory.
+
+        Chunks go to a temp file next to the final location while being hashed; the file is
+        then renamed into the content store in one step, so readers never see a partial file.
+
+        Args:
+            url: Original media URL
+            chunks: Iterable of byte chunks
+            content_type: MIME type of the media
+            media_type: Type of media ('image' or 'video')
+            brand_name: Optional brand name for metadata
+            ad_id: Optional ad ID for metadata
+            max_bytes: Size cutoff (default MAX_VIDEO_FILE_MB for videos, none for images)
+
+        Returns:
+            File path where media was cached
+
+        Raises:
+            MediaTooLargeException: The download exceeded max_bytes (the partial file is removed)
+        """
+        if max_bytes is None and media_type == 'video':
+            max_bytes = int(MAX_VIDEO_FILE_MB * 1024 * 1024)
+        target_dir = CACHE_VIDEOS_DIR if media_type == 'video' else CACHE_IMAGES_DIR
+        target_dir.mkdir(parents=True, exist_ok=True)
+        fd, tmp_name = tempfile.mkstemp(dir=target_dir, suffix='.part')
+        tmp_path = Path(tmp_name)
+
+        try:
+            digest = hashlib.sha256()
+            file_size = 0
+            with os.fdopen(fd, 'wb') as f:
+                for chunk in chunks:
+                    if not chunk:
+                        continue
+                    file_size += len(chunk)
+                    if max_bytes and file_size > max_bytes:
+                        raise MediaTooLargeException(
+                            f"{media_type} larger than {max_bytes // (1024 * 1024)} MB, not cached: {url}"
+                        )
+                    digest.update(chunk)
+                    f.write(chunk)
+                if FSYNC_WRITES:
+                    f.flush()
+                    os.fsync(f.fileno())
+            content_hash = digest.hexdigest()
+
+            with self._connection() as conn:
+                content_hash, file_path, is_new = self._place_blob(
+                    conn, content_hash, file_size, content_type, media_type,
+                    lambda path: (os.replace(tmp_path, path), self._fsync_dir(path.parent))
+                )
+                conn.execute(_UPSERT_URL_SQL, (
+                    self._generate_url_hash(url), url, str(file_path), file_size, content_type, media_type,
+                    brand_name, ad_id, None, None, None, None, content_hash
+                ))
+                conn.commit()
+        finally:
+            # Already renamed on success; leftover when the content was cached before or on error
+            tmp_path.unlink(missing_ok=True)
+
+        if is_new:
+            self._index_blob(content_hash, media_type, file_path)
+        if self._over_budget():
+            self._schedule_eviction()
+
+        logger.info(f"Cached {media_type} (streamed, {file_size / (1024 * 1024):.1f} MB): {url} -> {file_path}")
+        return str(file_path)
+
     # Backward compatibility method
     def cache_image(self, url: str, image_data: bytes, content_type: str, 
                    brand_name: str = None, ad_id: str = None, 
@@ -249,7 +1376,7 @@ class MediaCacheService:
         has_people = self._extract_has_people(analysis_results)
         text_elements = self._extract_text_elements(analysis_results)
         
-        with sqlite3.connect(CACHE_DB_PATH) as conn:
+        with self._connection() as conn:
             conn.execute("""
                 UPDATE media_cache 
                 SET analysis_results = ?, 
@@ -259,6 +1386,12 @@ class MediaCacheService:
                     text_elements = ?
                 WHERE url_hash = ?
             """, (analysis_json, dominant_colors, has_people, text_elements, url_hash))
+            # Same content under any other URL reuses this analysis
+            conn.execute("""
+                UPDATE media_blobs
+                SET analysis_results = ?, analysis_cached_at = CURRENT_TIMESTAMP
+                WHERE content_hash = (SELECT content_hash FROM media_cache WHERE url_hash = ?)
+            """, (analysis_json, url_hash))
             conn.commit()
         
         logger.info(f"Updated analysis results for: {url}")
@@ -302,21 +1435,29 @@ class MediaCacheService:
         """
         cutoff_time = time.time() - (max_age_days * 24 * 60 * 60)
         
-        with sqlite3.connect(CACHE_DB_PATH) as conn:
-            # Get files to delete
-            cursor = conn.execute("""
-                SELECT file_path, media_type FROM media_cache 
+        with self._connection() as conn:
+            # Remove old URL entries first; their blobs may still be shared with newer URLs
+            conn.execute("""
+                DELETE FROM media_cache 
                 WHERE downloaded_at < datetime(?, 'unixepoch')
             """, (cutoff_time,))
+
+            # Get blobs no URL points to anymore
+            cursor = conn.execute("""
+                SELECT content_hash, file_path, media_type FROM media_blobs
+                WHERE content_hash NOT IN (SELECT content_hash FROM media_cache WHERE content_hash IS NOT NULL)
+            """)
             
             files_to_delete = cursor.fetchall()
             
             # Delete files
             deleted_images = 0
             deleted_videos = 0
-            for file_path, media_type in files_to_delete:
+            deleted_hashes = []
+            for content_hash, file_path, media_type in files_to_delete:
                 try:
                     Path(file_path).unlink(missing_ok=True)
+                    deleted_hashes.append((content_hash,))
                     if media_type == 'video':
                         deleted_videos += 1
                     else:
@@ -325,19 +1466,29 @@ class MediaCacheService:
                     logger.warning(f"Failed to delete cached file {file_path}: {e}")
             
             # Remove database entries
+            conn.executemany("DELETE FROM media_blobs WHERE content_hash = ?", deleted_hashes)
+            self._drop_variants(conn, deleted_hashes)
+            self._drop_variants(conn, conn.execute("""
+                SELECT DISTINCT content_hash FROM media_variants
+                WHERE created_at < datetime(?, 'unixepoch')
+                  AND content_hash NOT IN (SELECT content_hash FROM media_blobs)
+            """, (cutoff_time,)).fetchall())
+
+            # Old analyses of content that is no longer cached
             conn.execute("""
-                DELETE FROM media_cache 
-                WHERE downloaded_at < datetime(?, 'unixepoch')
+                DELETE FROM analysis_cache
+                WHERE created_at < datetime(?, 'unixepoch')
+                  AND content_hash NOT IN (SELECT content_hash FROM media_blobs)
             """, (cutoff_time,))
             
             conn.commit()
-            
+
+        self._load_size_totals()
         logger.info(f"Cleanup completed: removed {deleted_images} images and {deleted_videos} videos")
     
     def get_cache_stats(self) -> Dict[str, Any]:
         """Get cache statistics for both images and videos."""
-        with sqlite3.connect(CACHE_DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
+        with self._connection() as conn:
             
             # Overall stats
             cursor = conn.execute("""
@@ -377,11 +1528,40 @@ class MediaCacheService:
             # Combine stats
             combined_stats = {**stats, **image_stats, **video_stats}
             
+            # SUM() is NULL on an empty table
+            for key in ('total_size_bytes', 'images_size_bytes', 'videos_size_bytes'):
+                combined_stats[key] = combined_stats.get(key) or 0
+
+            # Sizes above count every URL; what is on disk is one blob per distinct content
+            logical_size = combined_stats['total_size_bytes']
+            cursor = conn.execute("""
+                SELECT
+                    COUNT(*) as unique_files,
+                    COALESCE(SUM(file_size), 0) as total_size_bytes,
+                    COALESCE(SUM(CASE WHEN media_type = 'image' THEN file_size END), 0) as images_size_bytes,
+                    COALESCE(SUM(CASE WHEN media_type = 'video' THEN file_size END), 0) as videos_size_bytes
+                FROM media_blobs
+            """)
+            combined_stats.update(dict(cursor.fetchone()))
+            combined_stats['dedup_saved_mb'] = round((logical_size - combined_stats['total_size_bytes']) / (1024 * 1024), 2)
+            combined_stats['cached_analyses'] = conn.execute("SELECT COUNT(*) FROM analysis_cache").fetchone()[0]
+            combined_stats['gemini_files'] = conn.execute(
+                "SELECT COUNT(*) FROM gemini_files WHERE expires_at > ?", (time.time(),)
+            ).fetchone()[0]
+
             # Convert to more readable format
-            combined_stats['total_size_mb'] = round(combined_stats.get('total_size_bytes', 0) / (1024 * 1024), 2)
+            combined_stats['total_size_mb'] = round(combined_stats['total_size_bytes'] / (1024 * 1024), 2)
             combined_stats['total_size_gb'] = round(combined_stats['total_size_mb'] / 1024, 2)
-            combined_stats['images_size_mb'] = round(combined_stats.get('images_size_bytes', 0) / (1024 * 1024), 2)
-            combined_stats['videos_size_mb'] = round(combined_stats.get('videos_size_bytes', 0) / (1024 * 1024), 2)
+            combined_stats['images_size_mb'] = round(combined_stats['images_size_bytes'] / (1024 * 1024), 2)
+            combined_stats['videos_size_mb'] = round(combined_stats['videos_size_bytes'] / (1024 * 1024), 2)
+
+            # Size budgets and LRU eviction counters
+            combined_stats['max_size_gb'] = MAX_CACHE_SIZE_GB
+            combined_stats['images_budget_gb'] = MEDIA_TYPE_BUDGETS_GB['image']
+            combined_stats['videos_budget_gb'] = MEDIA_TYPE_BUDGETS_GB['video']
+            with self._size_lock:
+                combined_stats['evicted_files'] = self._evicted['files']
+                combined_stats['evicted_mb'] = round(self._evicted['bytes'] / (1024 * 1024), 2)
             
             return combined_stats
     
@@ -420,8 +1600,7 @@ class MediaCacheService:
         
         query += " ORDER BY last_accessed DESC"
         
-        with sqlite3.connect(CACHE_DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
+        with self._connection() as conn:
             cursor = conn.execute(query, params)
             
             results = []
@@ -456,46 +1635,49 @@ class MediaCacheService:
         if not urls:
             return {}
             
-        # Generate URL hashes for batch lookup
-        url_hash_map = {self._generate_url_hash(url): url for url in urls}
+        # Generate URL hashes for batch lookup (several URLs can share one canonical key)
+        url_hash_map: Dict[str, List[str]] = {}
+        for url in urls:
+            url_hash_map.setdefault(self._generate_url_hash(url), []).append(url)
         
-        with sqlite3.connect(CACHE_DB_PATH) as conn:
-            conn.row_factory = sqlite3.Row
+        with self._connection() as conn:
             
-            # Build query with placeholders for all hashes
-            placeholders = ','.join(['?' for _ in url_hash_map.keys()])
-            query = f"SELECT * FROM media_cache WHERE url_hash IN ({placeholders})"
-            params = list(url_hash_map.keys())
-            
-            if media_type:
-                query += " AND media_type = ?"
-                params.append(media_type)
-            
-            cursor = conn.execute(query, params)
+            # One query per BATCH_LOOKUP_CHUNK hashes (SQLite caps the number of bound parameters)
+            rows = []
+            url_hashes = list(url_hash_map.keys())
+            for start in range(0, len(url_hashes), BATCH_LOOKUP_CHUNK):
+                chunk = url_hashes[start:start + BATCH_LOOKUP_CHUNK]
+                placeholders = ','.join(['?' for _ in chunk])
+                query = f"""
+                    SELECT m.*, b.analysis_results AS blob_analysis_results,
+                           b.file_size AS blob_file_size, b.verified_at AS blob_verified_at
+                    FROM media_cache m LEFT JOIN media_blobs b ON b.content_hash = m.content_hash
+                    WHERE m.url_hash IN ({placeholders})
+                """
+                params = list(chunk)
+                
+                if media_type:
+                    query += " AND m.media_type = ?"
+                    params.append(media_type)
+                
+                rows.extend(conn.execute(query, params).fetchall())
             
             # Initialize results with None for all URLs
             results = {url: None for url in urls}
             
-            for row in cursor.fetchall():
-                original_url = url_hash_map[row['url_hash']]
+            for row in rows:
                 
-                # Check if file still exists
-                file_path = Path(row['file_path'])
-                if not file_path.exists():
-                    # File was deleted, remove from database
-                    conn.execute("DELETE FROM media_cache WHERE url_hash = ?", (row['url_hash'],))
-                    logger.warning(f"Cached file missing, removed from database: {file_path}")
+                # Check that the file still exists and is intact (never serve a truncated file)
+                if not self._blob_is_valid(conn, row):
+                    self._drop_blob(conn, row, "missing" if not Path(row['file_path']).exists() else "damaged")
                     continue
                 
-                # Update last accessed time
-                conn.execute("""
-                    UPDATE media_cache 
-                    SET last_accessed = CURRENT_TIMESTAMP 
-                    WHERE url_hash = ?
-                """, (row['url_hash'],))
+                # Update last accessed time (buffered, flushed in batches)
+                self._record_access(row['url_hash'], row['content_hash'])
                 
                 # Convert row to dictionary
                 result = dict(row)
+                self._merge_blob_analysis(result)
                 
                 # Parse JSON analysis results if available
                 if result['analysis_results']:
@@ -504,7 +1686,8 @@ class MediaCacheService:
                     except json.JSONDecodeError:
                         result['analysis_results'] = None
                 
-                results[original_url] = result
+                for url in url_hash_map[row['url_hash']]:
+                    results[url] = result
             
             conn.commit()
             
@@ -535,47 +1718,62 @@ class MediaCacheService:
             
         file_paths = []
         db_entries = []
+        new_blobs = []
         
-        # Process each media item and save files
-        for media_info in media_data_list:
-            url = media_info['url']
-            media_data = media_info['media_data']
-            content_type = media_info['content_type']
-            media_type = media_info.get('media_type', 'image')
-            
-            url_hash = self._generate_url_hash(url)
-            file_path = self._get_file_path(url_hash, content_type, media_type)
-            
-            # Save media file
-            file_path.write_bytes(media_data)
-            file_paths.append(str(file_path))
-            
-            # Prepare analysis results for storage
-            analysis_json = None
-            analysis_cached_at = None
-            analysis_results = media_info.get('analysis_results')
-            if analysis_results:
-                analysis_json = json.dumps(analysis_results)
-                analysis_cached_at = time.time()
-            
-            # Prepare database entry
-            db_entries.append((
-                url_hash, url, str(file_path), len(media_data), content_type, media_type,
-                media_info.get('brand_name'), media_info.get('ad_id'), 
-                analysis_json, analysis_cached_at,
-                media_info.get('duration_seconds'), media_info.get('has_audio')
-            ))
-        
-        # Batch insert into database
-        with sqlite3.connect(CACHE_DB_PATH) as conn:
-            conn.executemany("""
-                INSERT OR REPLACE INTO media_cache (
-                    url_hash, original_url, file_path, file_size, content_type, media_type,
-                    brand_name, ad_id, analysis_results, analysis_cached_at,
-                    duration_seconds, has_audio
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-            """, db_entries)
+        with self._connection() as conn:
+            # 1. Hash and write the files (once per distinct content) before any database write:
+            #    the fsyncs must not hold the write lock other download workers are waiting for.
+            #    A crash before the commit below only leaves orphan files for fsck.
+            hashes = [self.compute_content_hash(media_info['media_data']) for media_info in media_data_list]
+            blobs = {}  # content_hash -> (file_path, pending)
+            for media_info, content_hash in zip(media_data_list, hashes):
+                media_data = media_info['media_data']
+                if content_hash not in blobs:
+                    blobs[content_hash] = self._write_blob_file(
+                        conn, content_hash, len(media_data), media_info['content_type'],
+                        media_info.get('media_type', 'image'), lambda path, data=media_data: self._atomic_write(path, data)
+                    )
+
+            # 2. One short transaction for every row
+            registered = set()
+            for media_info, content_hash in zip(media_data_list, hashes):
+                url = media_info['url']
+                media_data = media_info['media_data']
+                content_type = media_info['content_type']
+                media_type = media_info.get('media_type', 'image')
+                
+                url_hash = self._generate_url_hash(url)
+                file_path, pending = blobs[content_hash]
+                if pending is not None and content_hash not in registered:
+                    registered.add(content_hash)
+                    if self._register_blob(conn, content_hash, file_path, len(media_data),
+                                           content_type, media_type, refresh=pending):
+                        new_blobs.append((content_hash, media_type, file_path, media_data))
+                file_paths.append(str(file_path))
+                
+                # Prepare analysis results for storage
+                analysis_json = None
+                analysis_cached_at = None
+                analysis_results = media_info.get('analysis_results')
+                if analysis_results:
+                    analysis_json = json.dumps(analysis_results)
+                    analysis_cached_at = time.time()
+                
+                # Prepare database entry
+                db_entries.append((
+                    url_hash, url, str(file_path), len(media_data), content_type, media_type,
+                    media_info.get('brand_name'), media_info.get('ad_id'), 
+                    analysis_json, analysis_cached_at,
+                    media_info.get('duration_seconds'), media_info.get('has_audio'), content_hash
+                ))
+            
+            # Batch insert into database
+            conn.executemany(_UPSERT_URL_SQL, db_entries)
             conn.commit()
+
+        self._index_blobs(new_blobs)
+        if self._over_budget():
+            self._schedule_eviction()
         
         logger.info(f"Batch cached {len(media_data_list)} media files")
         return file_paths
@@ -0,0 +1,216 @@
+import io
+import os
+import shutil
+import logging
+import subprocess
+import threading
+from typing import Any, Dict, List, Optional, Tuple
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+# Pillow decodes images for dHash (optional: without it images are only deduped by exact content)
+try:
+    from PIL import Image
+    PIL_AVAILABLE = True
+except Exception:
+    PIL_AVAILABLE = False
+
+# ffmpeg grabs video keyframes (optional: without it videos are only deduped by exact content)
+FFMPEG_PATH = shutil.which("ffmpeg")
+FFPROBE_PATH = shutil.which("ffprobe")
+FFMPEG_AVAILABLE = FFMPEG_PATH is not None
+
+# Max Hamming distance (out of 64 bits) that still counts as the same creative.
+# Resizes / recompression stay well below this, different creatives are usually > 20.
+IMAGE_MATCH_DISTANCE = int(os.getenv("PHASH_IMAGE_DISTANCE", "6"))
+# For videos every keyframe has to be within this distance of its counterpart
+VIDEO_MATCH_DISTANCE = int(os.getenv("PHASH_VIDEO_DISTANCE", "8"))
+
+# Relative positions of the video keyframes that make up a video signature
+VIDEO_KEYFRAME_POSITIONS = (0.1, 0.5, 0.9)
+
+_HASH_W, _HASH_H = 9, 8  # dHash compares 8 horizontal neighbour pairs on 8 rows -> 64 bits
+
+
+# ============================================================
+#  dHash
+# ============================================================
+
+def _dhash_pixels(pixels: bytes) -> int:
+    """64-bit difference hash from a 9x8 grayscale bitmap (row-major, 1 byte per pixel)."""
+    value = 0
+    for row in range(_HASH_H):
+        offset = row * _HASH_W
+        for col in range(_HASH_W - 1):
+            value = (value << 1) | (pixels[offset + col] < pixels[offset + col + 1])
+    return value
+
+
+def image_dhash(image_bytes: bytes) -> Optional[int]:
+    """dHash of an image, or None if Pillow is missing or the image can't be decoded."""
+    if not PIL_AVAILABLE:
+        return None
+    try:
+        with Image.open(io.BytesIO(image_bytes)) as img:
+            small = img.convert("L").resize((_HASH_W, _HASH_H), Image.LANCZOS)
+            return _dhash_pixels(small.tobytes())
+    except Exception as e:
+        logger.warning(f"dHash failed for image: {e}")
+        return None
+
+
+def video_duration(video_path: str) -> Optional[float]:
+    """Duration in seconds via ffprobe, or None."""
+    if not FFPROBE_PATH:
+        return None
+    try:
+        out = subprocess.run(
+            [FFPROBE_PATH, "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", video_path],
+            capture_output=True, timeout=30, check=True,
+        ).stdout
+        return float(out.strip())
+    except Exception:
+        return None
+
+
+def _frame_dhash(video_path: str, at_seconds: float) -> Optional[int]:
+    """Grabs one frame, already scaled to 9x8 gray by ffmpeg, and hashes it."""
+    try:
+        pixels = subprocess.run(
+            [FFMPEG_PATH, "-v", "error", "-ss", f"{at_seconds:.2f}", "-i", video_path, "-frames:v", "1",
+             "-vf", f"scale={_HASH_W}:{_HASH_H},format=gray", "-f", "rawvideo", "-"],
+            capture_output=True, timeout=60, check=True,
+        ).stdout
+    except Exception as e:
+        logger.warning(f"ffmpeg keyframe grab failed for {video_path}: {e}")
+        return None
+    if len(pixels) < _HASH_W * _HASH_H:
+        return None
+    return _dhash_pixels(pixels)
+
+
+def video_keyframe_hashes(video_path: str) -> Optional[List[int]]:
+    """dHashes of the keyframes at VIDEO_KEYFRAME_POSITIONS, or None if ffmpeg is missing / fails."""
+    if not FFMPEG_AVAILABLE:
+        return None
+    duration = video_duration(video_path)
+    # Without ffprobe fall back to fixed timestamps (typical ad videos are 15-60s)
+    times = [duration * p for p in VIDEO_KEYFRAME_POSITIONS] if duration else [1.0, 5.0, 10.0]
+    hashes = []
+    for t in times:
+        h = _frame_dhash(video_path, t)
+        if h is None:
+            return None
+        hashes.append(h)
+    return hashes
+
+
+def hamming(a: int, b: int) -> int:
+    return bin(a ^ b).count("1")
+
+
+def encode_hashes(hashes: List[int]) -> str:
+    """Hashes as comma-separated 16-char hex (SQLite INTEGER is signed, 64-bit hashes don't fit)."""
+    return ",".join(f"{h:016x}" for h in hashes)
+
+
+def decode_hashes(value: str) -> List[int]:
+    return [int(part, 16) for part in value.split(",") if part]
+
+
+# ============================================================
+#  BK-tree — Hamming-distance nearest neighbours
+# ============================================================
+
+class BKTree:
+    """
+    Burkhard-Keller tree over 64-bit hashes. Lookups within a small radius only visit
+    children whose edge distance is in [d - radius, d + radius], so they stay far
+    below a linear scan even with hundreds of thousands of hashes.
+    """
+
+    def __init__(self):
+        self._root: Optional[list] = None  # [hash, [items], {distance: child_node}]
+        self.size = 0
+
+    def add(self, value: int, item: Any):
+        self.size += 1
+        if self._root is None:
+            self._root = [value, [item], {}]
+            return
+        node = self._root
+        while True:
+            d = hamming(value, node[0])
+            if d == 0:
+                node[1].append(item)
+                return
+            child = node[2].get(d)
+            if child is None:
+                node[2][d] = [value, [item], {}]
+                return
+            node = child
+
+    def search(self, value: int, radius: int) -> List[Tuple[int, Any]]:
+        """All (distance, item) within radius, nearest first."""
+        if self._root is None:
+            return []
+        found = []
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            d = hamming(value, node[0])
+            if d <= radius:
+                found.extend((d, item) for item in node[1])
+            for edge, child in node[2].items():
+                if d - radius <= edge <= d + radius:
+                    stack.append(child)
+        found.sort(key=lambda pair: pair[0])
+        return found
+
+
+class PerceptualIndex:
+    """
+    In-memory near-duplicate index: one BK-tree per media type.
+    Images are indexed by their dHash; videos by the dHash of the middle keyframe,
+    and candidates are confirmed against every keyframe.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._trees: Dict[str, BKTree] = {"image": BKTree(), "video": BKTree()}
+        self._signatures: Dict[str, List[int]] = {}
+
+    def __len__(self) -> int:
+        return len(self._signatures)
+
+    def add(self, content_hash: str, media_type: str, hashes: List[int]):
+        if not hashes:
+            return
+        with self._lock:
+            if content_hash in self._signatures:
+                return
+            self._signatures[content_hash] = hashes
+            self._trees.setdefault(media_type, BKTree()).add(hashes[len(hashes) // 2], content_hash)
+
+    def find_similar(self, media_type: str, hashes: List[int]) -> List[Tuple[int, str]]:
+        """
+        Near-duplicates of a signature as (distance, content_hash), nearest first.
+        Distance is the worst keyframe distance for videos.
+        """
+        radius = VIDEO_MATCH_DISTANCE if media_type == "video" else IMAGE_MATCH_DISTANCE
+        with self._lock:
+            tree = self._trees.get(media_type)
+            if tree is None:
+                return []
+            candidates = tree.search(hashes[len(hashes) // 2], radius)
+            matches = []
+            for _, content_hash in candidates:
+                other = self._signatures.get(content_hash)
+                if other is None or len(other) != len(hashes):
+                    continue
+                worst = max(hamming(a, b) for a, b in zip(hashes, other))
+                if worst <= radius:
+                    matches.append((worst, content_hash))
+        matches.sort(key=lambda pair: pair[0])
+        return matches
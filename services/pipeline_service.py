@@ -0,0 +1,160 @@
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple, Type
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+# End-of-stream marker passed between stages
+_STOP = object()
+
+
+# ============================================================
+#  Async pipeline engine — bounded stages connected by queues
+# ============================================================
+
+class Stage:
+    """
+    One pipeline stage with its own concurrency limit.
+
+    Args:
+        name: Stage name (used in logs and stats)
+        func: Callable taking one item. Coroutine functions are awaited on the event loop,
+              sync callables run in the pipeline's thread pool (blocking I/O).
+              Returning None drops the item.
+        concurrency: Max items this stage processes at the same time
+        fan_out: func returns an iterable; every element is passed to the next stage
+        inline: Run a cheap sync func directly on the event loop (no thread hop)
+        finish_on_cancel: Keep processing items after cancellation (e.g. persisting work
+                          that is already done) instead of dropping them
+    """
+
+    def __init__(self, name: str, func: Callable[[Any], Any], concurrency: int = 1,
+                 fan_out: bool = False, inline: bool = False, finish_on_cancel: bool = False):
+        self.name = name
+        self.func = func
+        self.concurrency = max(1, int(concurrency))
+        self.fan_out = fan_out
+        self.inline = inline
+        self.finish_on_cancel = finish_on_cancel
+        self.is_async = asyncio.iscoroutinefunction(func)
+
+    @property
+    def needs_threads(self) -> bool:
+        return not self.is_async and not self.inline
+
+
+class AsyncPipeline:
+    """
+    Runs items through a chain of stages (e.g. fetch → filter → download → analyze → persist).
+
+    - Stages are connected by bounded asyncio queues, so a slow stage applies
+      backpressure instead of letting work pile up in memory.
+    - Each stage has its own concurrency limit; blocking sync stages share one thread
+      pool sized to the sum of their limits, so the thread count is bounded by design.
+    - If cancel_event is set, remaining items are drained without being processed
+      (except by stages marked finish_on_cancel).
+    - Exceptions listed in drop_exceptions drop just that item; any other exception
+      stops the pipeline and is re-raised from run().
+    """
+
+    def __init__(self, stages: List[Stage], cancel_event: Optional[threading.Event] = None,
+                 drop_exceptions: Tuple[Type[BaseException], ...] = ()):
+        if not stages:
+            raise ValueError("Pipeline needs at least one stage")
+        self.stages = stages
+        self.cancel_event = cancel_event
+        self.drop_exceptions = tuple(drop_exceptions)
+        self.stats: Dict[str, Dict[str, int]] = {s.name: {"in": 0, "out": 0, "dropped": 0} for s in stages}
+        self._error: Optional[BaseException] = None
+
+    @property
+    def cancelled(self) -> bool:
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    async def run(self, items: Iterable[Any]) -> List[Any]:
+        """Feeds items into the first stage and returns everything the last stage produced."""
+        loop = asyncio.get_running_loop()
+        results: List[Any] = []
+        thread_count = sum(s.concurrency for s in self.stages if s.needs_threads) or 1
+
+        with ThreadPoolExecutor(max_workers=thread_count, thread_name_prefix="pipeline") as executor:
+            queues = [asyncio.Queue(maxsize=s.concurrency * 2) for s in self.stages]
+            runners = []
+            for i, stage in enumerate(self.stages):
+                out_queue = queues[i + 1] if i + 1 < len(self.stages) else None
+                next_workers = self.stages[i + 1].concurrency if out_queue is not None else 0
+                runners.append(asyncio.create_task(
+                    self._run_stage(stage, queues[i], out_queue, next_workers, results, loop, executor)
+                ))
+
+            for item in items:
+                await queues[0].put(item)
+            for _ in range(self.stages[0].concurrency):
+                await queues[0].put(_STOP)
+
+            await asyncio.gather(*runners)
+
+        logger.info(f"Pipeline finished: {self.stats}")
+        if self._error is not None:
+            raise self._error
+        return results
+
+    def run_sync(self, items: Iterable[Any]) -> List[Any]:
+        """Blocking wrapper around run() for sync callers (tools run on worker threads)."""
+        return asyncio.run(self.run(items))
+
+    async def _run_stage(self, stage: Stage, in_queue: asyncio.Queue, out_queue: Optional[asyncio.Queue],
+                         next_workers: int, results: List[Any], loop, executor):
+        await asyncio.gather(*[
+            self._worker(stage, in_queue, out_queue, results, loop, executor)
+            for _ in range(stage.concurrency)
+        ])
+        # All workers of this stage are done: close the next stage
+        if out_queue is not None:
+            for _ in range(next_workers):
+                await out_queue.put(_STOP)
+
+    async def _worker(self, stage: Stage, in_queue: asyncio.Queue, out_queue: Optional[asyncio.Queue],
+                      results: List[Any], loop, executor):
+        stats = self.stats[stage.name]
+        while True:
+            item = await in_queue.get()
+            if item is _STOP:
+                return
+
+            # Keep draining after an error or cancellation so upstream never blocks on a full queue
+            if self._error is not None or (self.cancelled and not stage.finish_on_cancel):
+                stats["dropped"] += 1
+                continue
+
+            stats["in"] += 1
+            try:
+                if stage.is_async:
+                    output = await stage.func(item)
+                elif stage.inline:
+                    output = stage.func(item)
+                else:
+                    output = await loop.run_in_executor(executor, stage.func, item)
+            except self.drop_exceptions as e:
+                logger.info(f"Stage '{stage.name}' dropped item: {e}")
+                stats["dropped"] += 1
+                continue
+            except Exception as e:
+                logger.error(f"Stage '{stage.name}' failed: {e}")
+                if self._error is None:
+                    self._error = e
+                continue
+
+            if output is None:
+                stats["dropped"] += 1
+                continue
+
+            for out in (output if stage.fan_out else (output,)):
+                stats["out"] += 1
+                if out_queue is None:
+                    results.append(out)
+                else:
+                    await out_queue.put(out)
@@ -6,6 +6,7 @@ import re
 from datetime import datetime
 from typing import Dict, Any, List, Optional, Union
 from urllib.parse import urlparse, parse_qs
+from services.http_client import http_get
 
 # Set up logger
 logger = logging.getLogger(__name__)
@@ -144,7 +145,7 @@ def get_platform_id(brand_name: str) -> Dict[str, str]:
     """
     api_key = get_scrapecreators_api_key()
     
-    response = requests.get(
+    response = http_get(
         SEARCH_API_URL,
         headers={"x-api-key": api_key},
         params={
@@ -216,7 +217,7 @@ def get_ads(
             params['cursor'] = cursor
         
         try:
-            response = requests.get(
+            response = http_get(
                 ADS_API_URL, 
                 headers=headers, 
                 params=params,
@@ -323,7 +324,7 @@ def search_ads_by_keyword(
         params['limit'] = limit
         
         logger.info(f"Searching ScrapeCreators for query '{query}' (limit={limit})")
-        response = requests.get(
+        response = http_get(
             SEARCH_ADS_API_URL, 
             headers=headers, 
             params=params,
@@ -0,0 +1,114 @@
+import os
+import logging
+import subprocess
+from typing import Any, Dict, List, Optional
+
+from services.perceptual_hash_service import FFMPEG_PATH, FFMPEG_AVAILABLE, video_duration
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+# Video analysis mode: 'upload' (whole file via the Files API), 'frames' (keyframes + audio
+# sent inline, no upload / ACTIVE polling) or 'auto' (frames for videos up to FRAMES_MAX_SECONDS)
+VIDEO_MODE = os.getenv("GEMINI_VIDEO_MODE", "upload").lower()
+VIDEO_MODES = ("upload", "frames", "auto")
+# Keyframes per video in frames mode, spread evenly over its duration
+FRAMES_PER_VIDEO = int(os.getenv("GEMINI_VIDEO_FRAMES", "8"))
+# 'auto' only switches to frames for videos up to this long (longer ones lose too much)
+FRAMES_MAX_SECONDS = float(os.getenv("GEMINI_FRAMES_MAX_SECONDS", "60"))
+# Longest side of an extracted keyframe in pixels
+FRAME_MAX_DIMENSION = int(os.getenv("GEMINI_FRAME_MAX_DIM", "768"))
+# Audio is sent as mono AAC at this bitrate: plenty for speech, ~180 KB per minute
+AUDIO_BITRATE = "24k"
+
+
+def frames_available() -> bool:
+    return FFMPEG_AVAILABLE
+
+
+def resolve_video_mode(mode: Optional[str], video_path: Optional[str] = None) -> str:
+    """
+    'upload' or 'frames' for one video.
+
+    Args:
+        mode: Requested mode (None = GEMINI_VIDEO_MODE)
+        video_path: Local file, needed to decide 'auto' by duration
+
+    Returns:
+        'frames' only if ffmpeg is available, otherwise always 'upload'
+    """
+    mode = (mode or VIDEO_MODE).lower()
+    if mode not in VIDEO_MODES:
+        logger.warning(f"Unknown video mode '{mode}', using 'upload'")
+        mode = "upload"
+    if mode == "upload" or not FFMPEG_AVAILABLE:
+        return "upload"
+    if mode == "auto":
+        duration = video_duration(video_path) if video_path else None
+        return "frames" if duration is not None and duration <= FRAMES_MAX_SECONDS else "upload"
+    return "frames"
+
+
+def _grab_frame(video_path: str, at_seconds: float) -> Optional[bytes]:
+    """One JPEG keyframe, scaled down by ffmpeg to FRAME_MAX_DIMENSION."""
+    scale = (f"scale='if(gt(iw,ih),min({FRAME_MAX_DIMENSION},iw),-2)':"
+             f"'if(gt(iw,ih),-2,min({FRAME_MAX_DIMENSION},ih))'")
+    try:
+        data = subprocess.run(
+            [FFMPEG_PATH, "-v", "error", "-ss", f"{at_seconds:.2f}", "-i", video_path, "-frames:v", "1",
+             "-vf", scale, "-q:v", "4", "-f", "image2", "-c:v", "mjpeg", "-"],
+            capture_output=True, timeout=60, check=True,
+        ).stdout
+    except Exception as e:
+        logger.warning(f"ffmpeg frame grab failed for {video_path} at {at_seconds:.1f}s: {e}")
+        return None
+    return data or None
+
+
+def _extract_audio(video_path: str) -> Optional[bytes]:
+    """Audio track as mono AAC (ADTS), or None if the video has no audio."""
+    try:
+        data = subprocess.run(
+            [FFMPEG_PATH, "-v", "error", "-i", video_path, "-vn", "-ac", "1", "-ar", "16000",
+             "-c:a", "aac", "-b:a", AUDIO_BITRATE, "-f", "adts", "-"],
+            capture_output=True, timeout=120, check=True,
+        ).stdout
+    except Exception as e:
+        logger.warning(f"ffmpeg audio extraction failed for {video_path}: {e}")
+        return None
+    return data or None
+
+
+def extract_video_frames(video_path: str, num_frames: Optional[int] = None) -> Optional[Dict[str, Any]]:
+    """
+    Keyframes and audio track of a local video for inline analysis.
+
+    Args:
+        video_path: Local video file
+        num_frames: Keyframes to take (None = GEMINI_VIDEO_FRAMES)
+
+    Returns:
+        {'duration', 'frames': [{'bytes', 'mime_type', 'label'}], 'audio': {...} or None},
+        or None if ffmpeg is missing or no frame could be extracted
+    """
+    if not FFMPEG_AVAILABLE:
+        return None
+    num_frames = max(1, num_frames or FRAMES_PER_VIDEO)
+    duration = video_duration(video_path)
+    # Frame i sits in the middle of the i-th of num_frames equal slices (skips black first/last frames)
+    if duration:
+        times = [duration * (i + 0.5) / num_frames for i in range(num_frames)]
+    else:
+        times = [float(i * 2) for i in range(num_frames)]
+
+    frames = []
+    for t in times:
+        data = _grab_frame(video_path, t)
+        if data:
+            frames.append({"bytes": data, "mime_type": "image/jpeg", "label": f"FRAME {len(frames) + 1} ({t:.1f}s):"})
+    if not frames:
+        return None
+
+    audio_bytes = _extract_audio(video_path)
+    audio = {"bytes": audio_bytes, "mime_type": "audio/aac", "label": "AUDIO TRACK:"} if audio_bytes else None
+    return {"duration": duration, "frames": frames, "audio": audio}